@@ -5,13 +5,15 @@ Arquitetura: Vendedor (Agente Único)
 Versão 6.0 - Single Agent Architecture
 """
 
-from typing import Dict, Any, TypedDict, Annotated, List, Literal
+from typing import Dict, Any, TypedDict, Annotated, List, Literal, Callable, Optional
+import contextvars
 import re
 import operator
 from langchain_openai import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, AIMessage
 from langchain_core.tools import tool
+from langchain_core.callbacks import BaseCallbackHandler
 from langgraph.graph import StateGraph, END, START
 from langgraph.prebuilt import create_react_agent
 from langgraph.checkpoint.memory import MemorySaver
@@ -20,13 +22,17 @@ import json
 
 from config.settings import settings
 from config.logger import setup_logger
-from tools.http_tools import estoque, pedidos, alterar, estoque_preco, consultar_encarte
+from tools.http_tools import estoque, pedidos, alterar, estoque_preco, estoque_preco_many, consultar_encarte
 
 from tools.time_tool import get_current_time, search_message_history
+from tools import blob_store
+from tools import checkout, order_outbox
+from tools.result_format import render_estoque, render_products
 from tools.redis_tools import (
     mark_order_sent, 
     add_item_to_cart, 
     get_cart_items, 
+    get_cart_totals,
     remove_item_from_cart, 
     clear_cart,
     set_comprovante,
@@ -36,13 +42,14 @@ from tools.redis_tools import (
     save_address,
     get_order_session,
     normalize_phone,
-    acquire_agent_lock,
-    release_agent_lock,
+    begin_agent_turn,
+    finish_agent_turn,
     clear_order_session,
     start_order_session,
     clear_suggestions
 )
 from memory.hybrid_memory import HybridChatMessageHistory
+from memory.redis_memory import session_memory_key
 
 logger = setup_logger(__name__)
 
@@ -72,8 +79,8 @@ def busca_produto_tool(telefone: str, query: str) -> str:
     Busca produtos e preços. Tenta ser inteligente: se não achar de primeira,
     refaz a busca com termos mais genéricos automaticamente.
 
-    Retorna um JSON list com os dados dos produtos:
-    [{"nome": "...", "categoria": "...", "preco": 10.0, "estoque": 5}]
+    Retorna uma tabela (settings.tool_result_format = "compact") ou um JSON list:
+    id|nome|preco|unidade|estoque|match_ok
 
     Usa chamadas na API FastAPI local.
     """
@@ -106,7 +113,6 @@ def busca_produto_tool(telefone: str, query: str) -> str:
                 score_retry = max([r.get("match_score", 0.0) for r in resultados_retry])
             
             if score_retry > melhor_score:
-                resultado_json = resultado_retry_json
                 resultados = resultados_retry
 
     # 3. Análise de Ambiguidade de Categoria
@@ -137,9 +143,8 @@ def busca_produto_tool(telefone: str, query: str) -> str:
                  "aviso": f"Encontrei produtos de categorias diferentes ({', '.join(categorias)}). PERGUNTE ao cliente qual ele deseja antes de adicionar."
              }
              resultados.insert(0, warning)
-             resultado_json = json.dumps(resultados, ensure_ascii=False)
 
-    return resultado_json
+    return render_products(resultados)
 
 @tool
 def add_item_tool(telefone: str, produto: str, quantidade: float = 1.0, observacao: str = "", preco: float = 0.0, unidades: int = 0) -> str:
@@ -159,38 +164,18 @@ def add_item_tool(telefone: str, produto: str, quantidade: float = 1.0, observac
     """
     
     # IMPORTAR AQUI para evitar ciclo de importação
-    from tools.redis_tools import get_suggestions
-    import difflib
+    from tools.redis_tools import find_suggestion
 
-    prod_lower = produto.lower().strip()
+    # Uma consulta ao índice de sugestões (trigramas) serve para o preço e para o match_ok
+    sugestao, match_substring = find_suggestion(telefone, produto)
     
     # 0. TENTATIVA DE RECUPERAÇÃO DE PREÇO (Auto-Healing)
     # Se o agente esqueceu o preço (0.0), tentamos achar nas sugestões recentes
-    if preco <= 0.01:
-        sugestoes = get_suggestions(telefone)
-        if sugestoes:
-            # Tentar match exato ou fuzzy
-            melhor_match = None
-            maior_score = 0
-            
-            for sug in sugestoes:
-                nome_sug = sug.get("nome", "").lower()
-                # Match exato de substring
-                if prod_lower in nome_sug or nome_sug in prod_lower:
-                    melhor_match = sug
-                    break
-                
-                # Match fuzzy (difflib)
-                ratio = difflib.SequenceMatcher(None, prod_lower, nome_sug).ratio()
-                if ratio > 0.6 and ratio > maior_score:
-                    maior_score = ratio
-                    melhor_match = sug
-            
-            if melhor_match:
-                preco_recuperado = float(melhor_match.get("preco", 0.0))
-                if preco_recuperado > 0:
-                    preco = preco_recuperado
-                    logger.info(f"✨ [AUTO-HEAL] Preço recuperado para '{produto}': R$ {preco:.2f} (baseado em '{melhor_match.get('nome')}')")
+    if preco <= 0.01 and sugestao:
+        preco_recuperado = float(sugestao.get("preco", 0.0))
+        if preco_recuperado > 0:
+            preco = preco_recuperado
+            logger.info(f"✨ [AUTO-HEAL] Preço recuperado para '{produto}': R$ {preco:.2f} (baseado em '{sugestao.get('nome')}')")
     
     # BLOQUEIO: Não permitir adicionar item sem preço válido
     if preco <= 0.01:
@@ -198,15 +183,9 @@ def add_item_tool(telefone: str, produto: str, quantidade: float = 1.0, observac
         return f"❌ Não consegui encontrar o preço de '{produto}'. Use busca_produto_tool para verificar o preço antes de adicionar."
     
     # Validar match_ok nas sugestões — se o produto não passou na validação, avisar
-    sugestoes_validacao = get_suggestions(telefone)
-    if sugestoes_validacao:
-        for sug in sugestoes_validacao:
-            nome_sug = sug.get("nome", "").lower()
-            if prod_lower in nome_sug or nome_sug in prod_lower:
-                if not sug.get("match_ok", True):
-                    logger.warning(f"⚠️ [ADD_ITEM] Produto '{produto}' tem match_ok=false. Pedindo confirmação.")
-                    return f"⚠️ '{produto}' não parece ser uma correspondência exata. Confirme com o cliente qual opção ele deseja antes de adicionar."
-                break
+    if sugestao and match_substring and not sugestao.get("match_ok", True):
+        logger.warning(f"⚠️ [ADD_ITEM] Produto '{produto}' tem match_ok=false. Pedindo confirmação.")
+        return f"⚠️ '{produto}' não parece ser uma correspondência exata. Confirme com o cliente qual opção ele deseja antes de adicionar."
     
     if unidades > 0 and quantidade <= 0.01:
          logger.warning(f"⚠️ [ADD_ITEM] Item '{produto}' com unidades={unidades} mas peso zerado. O LLM deveria ter calculado.")
@@ -316,8 +295,12 @@ def ean_tool_alias(query: str) -> str:
 
 @tool("estoque")
 def estoque_preco_alias(ean: str) -> str:
-    """Consulta preço e disponibilidade pelo EAN (apenas dígitos)."""
-    return estoque_preco(ean)
+    """Consulta preço e disponibilidade pelo EAN (apenas dígitos). Vários EANs: separe por vírgula (consulta única)."""
+    eans = [e for e in re.split(r"[,;\s]+", ean or "") if e]
+    if len(eans) <= 1:
+        return render_estoque(estoque_preco(ean))
+    # Cache de todos numa ida ao Redis e as faltas em paralelo
+    return "\n\n".join(f"EAN {k}:\n{render_estoque(v)}" for k, v in estoque_preco_many(eans).items())
 
 
 # ============================================
@@ -338,23 +321,12 @@ def calcular_total_tool(telefone: str, taxa_entrega: float = 0.0) -> str:
     - telefone: Telefone do cliente
     - taxa_entrega: Valor da taxa de entrega a ser somada (se houver)
     """
-    items = get_cart_items(telefone)
-    if not items:
+    # Agregados mantidos pelo carrinho (O(1), sem ler os itens)
+    totals = get_cart_totals(telefone)
+    if not totals["itens"]:
         return "❌ Pedido vazio. Não é possível calcular total."
     
-    subtotal = 0.0
-    item_details = []
-    
-    for i, item in enumerate(items):
-        preco = float(item.get("preco", 0.0))
-        qtd = float(item.get("quantidade", 1.0))
-        nome = item.get("produto", "Item")
-        
-        valor_item = round(preco * qtd, 2)
-        subtotal += valor_item
-        item_details.append(f"- {nome}: R$ {valor_item:.2f}")
-        
-    subtotal = round(subtotal, 2)
+    subtotal = round(totals["subtotal"], 2)
     taxa_entrega = round(float(taxa_entrega), 2)
     total_final = round(subtotal + taxa_entrega, 2)
     
@@ -378,68 +350,41 @@ def salvar_endereco_tool(telefone: str, endereco: str) -> str:
     return "❌ Erro ao salvar endereço."
 
 @tool
-def finalizar_pedido_tool(cliente: str, telefone: str, endereco: str, forma_pagamento: str, itens_json: str, observacao: str = "", comprovante: str = "", taxa_entrega: float = 0.0) -> str:
+def finalizar_pedido_tool(cliente: str, telefone: str, endereco: str, forma_pagamento: str, itens: str = "", observacao: str = "", comprovante: str = "", taxa_entrega: float = 0.0, itens_json: str = "") -> str:
     """
     Finalizar o pedido enviando TODOS os itens confirmados.
-    Use quando o cliente confirmar que quer fechar a compra e repasse todos os itens do contexto da conversa.
+    Use quando o cliente confirmar que quer fechar a compra.
     
     Args:
     - cliente: Nome do cliente
     - telefone: Telefone (com DDD)
     - endereco: Endereço de entrega completo
     - forma_pagamento: Pix, Cartão ou Dinheiro
-    - itens_json: String em formato JSON com todos os itens, ex: [{"produto": "Arroz", "quantidade": 2.0, "preco": 20.0}]
+    - itens: Itens compactos "id:quantidade" separados por vírgula, com o "id" retornado pela busca_produto_tool.
+      Para itens por KG: "id:peso_kg:unidades" (decimal com ponto). Observação do item depois de "#" (sem vírgula).
+      Ex: "8812:2, 9931:0.45:3#sem gordura". Nome e preço vêm da busca.
+      Deixe vazio se os itens já estão no carrinho (add_item_tool).
     - observacao: Observações extras (troco, etc)
     - comprovante: URL do comprovante PIX (se houver)
     - taxa_entrega: Valor da taxa de entrega em reais (opcional, padrão 0)
+    - itens_json: (opcional, só se não houver id ou a observação tiver vírgula) JSON com os itens,
+      ex: [{"produto": "Arroz", "quantidade": 2.0, "preco": 20.0, "observacao": ""}]
     """
     import json as json_lib
     
-    try:
-        items = json_lib.loads(itens_json)
-    except Exception as e:
-        return f"❌ Erro ao ler os itens do pedido: erro de formato JSON - {e}. Corrija o JSON e tente novamente."
+    items, origem = checkout.resolve_order_items(telefone, itens, itens_json)
+    if items is None:
+        return origem
         
     if not items:
-        return "❌ O pedido está vazio! Você deve repassar a lista de produtos confirmados."
+        return "❌ O pedido está vazio! Informe os itens confirmados em `itens` (id:quantidade da busca)."
+    logger.info(f"🧾 Pedido de {telefone}: {len(items)} itens (origem: {origem})")
     
     comprovante_salvo = get_comprovante(telefone)
-    comprovante_final = comprovante or comprovante_salvo or ""
+    # Referência do blob store vira URL pública (ou data URI lido do disco) só aqui, no envio
+    comprovante_final = blob_store.resolve_comprovante(comprovante or comprovante_salvo) or ""
     
-    total = 0.0
-    itens_formatados = []
-    
-    for item in items:
-        preco = float(item.get("preco", 0.0))
-        quantidade = float(item.get("quantidade", 1.0))
-        unidades = int(item.get("unidades", 0))
-        obs_item = item.get("observacao", "")
-        total += preco * quantidade
-        
-        nome_produto = item.get("produto", item.get("nome_produto", "Produto"))
-        
-        if unidades > 0:
-            qtd_api = unidades
-            valor_estimado = round(preco * quantidade, 2)
-            preco_unitario_api = round(valor_estimado / unidades, 2)
-            obs_peso = f"Peso estimado: {quantidade:.3f}kg (~R${valor_estimado:.2f}). PESAR para confirmar valor."
-            if obs_item:
-                obs_item = f"{obs_item}. {obs_peso}"
-            else:
-                obs_item = obs_peso
-        else:
-            if quantidade < 1 or quantidade != int(quantidade):
-                qtd_api = 1
-            else:
-                qtd_api = int(quantidade)
-            preco_unitario_api = round(preco, 2)
-        
-        itens_formatados.append({
-            "nome_produto": nome_produto,
-            "quantidade": qtd_api,
-            "preco_unitario": preco_unitario_api,
-            "observacao": obs_item
-        })
+    itens_formatados, total = checkout.format_order_lines(items)
     
     payload = {
         "nome_cliente": cliente,
@@ -456,28 +401,41 @@ def finalizar_pedido_tool(cliente: str, telefone: str, endereco: str, forma_paga
     if taxa_entrega > 0:
         total += taxa_entrega
     
-    json_body = json_lib.dumps(payload, ensure_ascii=False)
+    # AUDIT LOG: Registrar payload completo (gravado em lote pelo outbox)
+    audit_entry = {
+        "telefone": telefone,
+        "cliente": cliente,
+        "total": round(total, 2),
+        "itens_count": len(itens_formatados),
+        "payload": payload
+    }
     
-    # AUDIT LOG: Registrar payload completo antes de enviar
-    try:
-        from datetime import datetime
-        audit_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "telefone": telefone,
-            "cliente": cliente,
-            "total": round(total, 2),
-            "itens_count": len(itens_formatados),
-            "payload": payload
-        }
-        import os
-        os.makedirs("logs", exist_ok=True)
-        with open("logs/pedidos_audit.jsonl", "a", encoding="utf-8") as f:
-            f.write(json_lib.dumps(audit_entry, ensure_ascii=False) + "\n")
+    # Outbox: o pedido vai para o stream e é entregue ao dashboard em segundo plano
+    # (retry/backoff), sem segurar o turno do LLM esperando a API
+    # Sessão do pedido na chave: o mesmo pedido repetido numa sessão nova é outro pedido
+    session_id = (get_order_session(telefone) or {}).get("started_at") or ""
+    queued = order_outbox.enqueue_order(telefone, payload, total, session_id)
+    if queued is not None:
+        idem, duplicate = queued
+        if duplicate:
+            return (
+                f"ℹ️ Este pedido já tinha sido registrado (protocolo {idem[:8]}). "
+                f"Nada foi enviado de novo.\n\n"
+                f"💰 **Valor Total Processado:** R$ {total:.2f}\n(O agente DEVE usar este valor na resposta)"
+            )
+        order_outbox.audit({**audit_entry, "status": "queued", "idem": idem})
         logger.info(f"📋 [AUDIT] Pedido registrado para {telefone} - R$ {total:.2f}")
-    except Exception as audit_err:
-        logger.warning(f"⚠️ Falha no audit log: {audit_err}")
+        mark_order_sent(telefone, f"outbox:{idem}")
+        return (
+            f"✅ Pedido registrado! Está em envio para a loja (protocolo {idem[:8]}).\n\n"
+            f"💰 **Valor Total Processado:** R$ {total:.2f}\n(O agente DEVE usar este valor na resposta)"
+        )
     
-    result = pedidos(json_body)
+    # Sem Redis / outbox desligado: envio síncrono
+    order_outbox.audit({**audit_entry, "status": "sending"})
+    order_outbox.flush_audit()
+    logger.info(f"📋 [AUDIT] Pedido registrado para {telefone} - R$ {total:.2f}")
+    result = pedidos(json_lib.dumps(payload, ensure_ascii=False))
     
     if "sucesso" in result.lower() or "✅" in result:
         # NÃO LIMPAR O CARRINHO AQUI!
@@ -622,6 +580,39 @@ def _extract_response(result: Any) -> str:
 
 
 
+# ============================================
+# Preempção (mensagem nova do cliente durante o turno)
+# ============================================
+
+class TurnPreempted(Exception):
+    """O cliente mandou mensagem nova durante o turno: o run atual é abortado e refeito."""
+
+    def __init__(self, tokens_saved_est: int = 0):
+        super().__init__("turno preemptado por mensagem nova")
+        self.tokens_saved_est = tokens_saved_est
+
+
+_preempt_check: contextvars.ContextVar[Optional[Callable[[], bool]]] = contextvars.ContextVar("preempt_check", default=None)
+
+
+class _PreemptionCallback(BaseCallbackHandler):
+    """Checa a preempção antes de cada chamada ao LLM (entre os passos do ReAct)."""
+
+    raise_error = True
+
+    def __init__(self, check: Callable[[], bool]):
+        self.check = check
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        if self.check():
+            # Estimativa grosseira (~4 caracteres por token) do prompt que deixou de ser enviado
+            raise TurnPreempted(sum(len(str(m.content)) for batch in messages for m in batch) // 4)
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        if self.check():
+            raise TurnPreempted(sum(len(p) for p in prompts) // 4)
+
+
 def vendedor_node(state: AgentState) -> dict:
     """
     Nó Vendedor: Agente especializado em vendas com prompt completo.
@@ -643,6 +634,9 @@ def vendedor_node(state: AgentState) -> dict:
         "configurable": {"thread_id": state["phone"]},
         "recursion_limit": 25
     }
+    check = _preempt_check.get()
+    if check is not None:
+        config["callbacks"] = [_PreemptionCallback(check)]
     
     def _check_hallucination(agent_result: dict, agent_response: str) -> tuple[bool, str, set]:
         messages_local = agent_result.get("messages", []) if isinstance(agent_result, dict) else []
@@ -766,13 +760,21 @@ def build_multi_agent_graph():
 # Função Principal
 # ============================================
 
-def run_agent_langgraph(telefone: str, mensagem: str) -> Dict[str, Any]:
+def run_agent_langgraph(telefone: str, mensagem: str, preempt_check: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
     """
     Executa o agente multi-agente. Suporta texto e imagem (via tag [MEDIA_URL: ...]).
+
+    preempt_check: consultado antes de cada chamada ao LLM; se retornar True o run é
+    abortado e o retorno vem com error="preempted" (efeitos das tools já executadas,
+    como itens no carrinho, ficam no Redis). Consultado de novo antes de gravar a
+    resposta: se disparar, a resposta não vai para o histórico e o retorno vem com
+    error="preempted_send" (o worker descarta a resposta e refaz o turno).
     """
     telefone = normalize_phone(telefone)
     logger.info(f"[MULTI-AGENT] Telefone: {telefone} | Msg: {mensagem[:50]}...")
-    lock_token = acquire_agent_lock(telefone)
+    # Lock + snapshot do turno (sessão, carrinho, sugestões, endereço, comprovante,
+    # cooldown e histórico) em uma única ida ao Redis
+    lock_token, turn_ctx = begin_agent_turn(telefone, history_key=session_memory_key(telefone))
     if not lock_token:
         return {
             "output": "Estou finalizando sua última solicitação. Me manda só um instante e eu já te respondo.",
@@ -892,7 +894,11 @@ def run_agent_langgraph(telefone: str, mensagem: str) -> Dict[str, Any]:
         config = {"configurable": {"thread_id": telefone}}
         
         # 5. Executar o grafo
-        result = graph.invoke(initial_state, config)
+        preempt_token = _preempt_check.set(preempt_check)
+        try:
+            result = graph.invoke(initial_state, config)
+        finally:
+            _preempt_check.reset(preempt_token)
         
         # 6. Extrair resposta final
         output = result.get("final_response", "")
@@ -906,7 +912,13 @@ def run_agent_langgraph(telefone: str, mensagem: str) -> Dict[str, Any]:
         
         logger.info(f"✅ [MULTI-AGENT] Resposta: {output[:200]}...")
         
-        # 7. Salvar histórico (IA)
+        # 7. Mensagem nova chegou antes do envio: o worker descarta esta resposta e refaz o
+        # turno, então ela não pode entrar no histórico como se tivesse sido enviada
+        if preempt_check is not None and preempt_check():
+            logger.info(f"⏭️ [MULTI-AGENT] Resposta de {telefone} descartada antes do envio (mensagem nova)")
+            return {"output": output, "error": "preempted_send"}
+
+        # 8. Salvar histórico (IA)
         if history_handler:
             try:
                 history_handler.add_ai_message(output)
@@ -915,12 +927,16 @@ def run_agent_langgraph(telefone: str, mensagem: str) -> Dict[str, Any]:
 
         return {"output": output, "error": None}
         
+    except TurnPreempted as e:
+        logger.info(f"⏭️ [MULTI-AGENT] Turno de {telefone} preemptado por mensagem nova (~{e.tokens_saved_est} tokens poupados)")
+        return {"output": "", "error": "preempted", "tokens_saved_est": e.tokens_saved_est}
     except Exception as e:
         logger.error(f"Falha agente: {e}", exc_info=True)
         return {"output": "Tive um problema técnico, tente novamente.", "error": str(e)}
     finally:
         try:
-            release_agent_lock(telefone, lock_token)
+            # Escritas adiadas (histórico, TTLs) + liberação do lock em lote
+            finish_agent_turn(telefone, lock_token, turn_ctx)
         except Exception:
             pass
 
@@ -30,13 +30,19 @@ class Settings(BaseSettings):
     openai_api_base: Optional[str] = None # Para usar Grok (xAI) ou outros compatíveis
     moonshot_api_key: Optional[str] = None
     moonshot_api_url: str = "https://api.moonshot.ai/anthropic"
+    tool_result_format: str = "compact"  # Busca/estoque para o LLM: "compact" (tabela com |, menos tokens) ou "json" (formato antigo)
     
     # Postgres
     postgres_connection_string: str
     postgres_table_name: str = "memoria"
     postgres_products_table_name: str = "produtos-sp-queiroz"  # Nova variável para tabela de produtos
     postgres_message_limit: int = 5
-    
+
+    # Particionamento mensal da tabela de memória (job diário no APScheduler)
+    memoria_partitions_ahead: int = 2  # Meses futuros com partição pré-criada
+    memoria_archive_after_months: int = 3  # Partições mais antigas vão para o arquivo (0 = não arquivar)
+    memoria_retention_months: int = 12  # Dados (partição ou arquivo) mais antigos são removidos
+
     # Banco Vetorial de Produtos (Postgres - pgvector)
     vector_db_connection_string: Optional[str] = None
     vector_search_mode: str = "exact"
@@ -49,6 +55,24 @@ class Settings(BaseSettings):
     redis_port: int = 6379
     redis_password: Optional[str] = None
     redis_db: int = 0
+    redis_max_connections: int = 50  # Pool compartilhado (por processo)
+    redis_pool_timeout: int = 5  # Segundos esperando conexão livre quando o pool está cheio
+    redis_health_check_interval: int = 30
+    redis_memory_max_messages: int = 40  # Limite da lista session:memory:{phone} (LTRIM)
+    redis_memory_compression: str = "none"  # "none" ou "zlib" (mensagens grandes)
+    redis_customer_hash: bool = False  # Endereço/comprovante/cooldown num único HASH cust:{phone} (-24% de used_memory em 10k clientes; scripts/bench_customer_state.py)
+
+    # Comprovantes (blobs em disco por SHA-256; no Redis só a referência)
+    blob_store_dir: str = "data/blobs"
+    blob_store_retention_hours: int = 72  # Depois disso o GC apaga o arquivo
+    blob_public_base_url: Optional[str] = None  # Ex: https://agente.exemplo.com -> painel recebe URL /blobs/<sha>
+    blob_url_secret: Optional[str] = None  # Chave HMAC das URLs /blobs assinadas (padrão: SUPERMERCADO_AUTH_TOKEN)
+
+    # Cache em disco das imagens de produto enviadas ao cliente (LRU)
+    image_cache_enabled: bool = True
+    image_cache_dir: str = "data/image_cache"
+    image_cache_max_mb: int = 256  # Acima disso, as menos usadas são apagadas
+    image_cache_prewarm_top: int = 50  # Imagens mais pedidas baixadas após cada sincronização do catálogo
     
     # API do Supermercado
     supermercado_base_url: str
@@ -56,6 +80,15 @@ class Settings(BaseSettings):
 
     # Consulta de EAN (estoque/preço)
     estoque_ean_base_url: str = "http://45.178.95.233:5001/api/Produto/GetProdutosEAN"
+    estoque_cache_fresh_seconds: int = 300  # Cache de EAN mais velho que isso é servido e revalidado em segundo plano
+    estoque_bulk_concurrency: int = 8  # Consultas simultâneas no estoque_preco_many
+    supermercado_http_pool_size: int = 10  # Conexões keep-alive por host nas ferramentas HTTP
+    supermercado_http_retries: int = 2  # Retry com backoff em falha de conexão / 502-504 (GET e PUT)
+    order_outbox_enabled: bool = True  # Pedido vai para o stream orders:outbox e é entregue em segundo plano
+    order_outbox_max_attempts: int = 8  # Tentativas de entrega ao dashboard (backoff 5 s -> 5 min) antes de desistir
+    order_outbox_dedup_ttl: int = 7200  # Janela de idempotência (telefone + carrinho) e do estado do pedido
+    order_failure_alert_phone: Optional[str] = None  # WhatsApp do atendente avisado quando um pedido não chega ao dashboard
+    order_sync_quiet_ms: int = 1500  # Alterações em pedido já enviado: sincroniza 1x depois desse silêncio; 0 = desliga (PUT a cada alteração)
 
     # EAN Smart Responder (Supabase Functions)
     smart_responder_url: Optional[str] = None
@@ -70,6 +103,13 @@ class Settings(BaseSettings):
     # Documentação: https://docs.uazapi.com/
     uazapi_base_url: Optional[str] = None  # Ex: https://aimerc.uazapi.com
     uazapi_token: Optional[str] = None     # Token da instância
+    uazapi_http_max_connections: int = 20  # Pool keep-alive do cliente async (worker)
+    uazapi_http_retries: int = 2  # Novas tentativas em falha transitória (envios: só se não chegou à UAZAPI)
+    uazapi_rate_per_sec: float = 5.0  # Token bucket global de envios (texto/mídia) para a UAZAPI; 0 = sem limite
+    uazapi_rate_burst: int = 10  # Rajada máxima do token bucket
+    uazapi_coalesce_window_ms: int = 300  # Confirmações de leitura do mesmo chat nessa janela viram um único POST
+    outbound_dispatcher: bool = True  # Worker entrega a resposta ao despachante (fila por telefone) e libera o slot
+    outbound_fast_mode: bool = False  # Sem atrasos "humanos" (lendo/digitando/entre mensagens): só a ordem é mantida
     
     # Human Takeover - Tempo de pausa quando atendente humano assume (em segundos)
     human_takeover_ttl: int = 2400  # 40 minutos padrão
@@ -77,6 +117,8 @@ class Settings(BaseSettings):
     # Queue Workers (ARQ)
     workers_max_jobs: int = 15  # Aumentado de 5 para 15 (suportado pela nova chave com billing)
     worker_retry_attempts: int = 3  # Tentativas de retry em caso de falha
+    worker_phone_serialization: bool = True  # Um job por telefone na fila; mensagens extras esperam estacionadas
+    agent_preemption: bool = True  # Mensagem nova durante o turno aborta e refaz o turno (1x) com os textos juntos
     
     # Servidor
     server_host: str = "0.0.0.0"
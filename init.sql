@@ -1,28 +1,65 @@
 -- Script de inicialização do banco de dados PostgreSQL
 -- Cria a tabela de memória de conversação
 
--- Criar tabela de histórico de mensagens
+-- Criar tabela de histórico de mensagens (particionada por mês em created_at)
+-- As partições mensais são criadas/arquivadas/removidas pelo job
+-- scripts/memoria_partitions.py (agendado no APScheduler do server.py).
+-- Para bancos que já têm a tabela antiga (heap único), rode:
+--   python scripts/memoria_partitions.py --migrate
 CREATE TABLE IF NOT EXISTS memoria (
-    id SERIAL PRIMARY KEY,
+    id BIGSERIAL,
     session_id TEXT NOT NULL,
     message JSONB NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Partição padrão: recebe qualquer linha fora das partições mensais
+CREATE TABLE IF NOT EXISTS memoria_default PARTITION OF memoria DEFAULT;
+
+-- Partições do mês atual e do próximo (o job cria as seguintes)
+DO $$
+DECLARE
+    inicio DATE;
+BEGIN
+    FOR i IN 0..1 LOOP
+        inicio := (date_trunc('month', CURRENT_DATE) + make_interval(months => i))::DATE;
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF memoria FOR VALUES FROM (%L) TO (%L)',
+            'memoria_p' || to_char(inicio, 'YYYY_MM'),
+            inicio,
+            (inicio + INTERVAL '1 month')::DATE
+        );
+    END LOOP;
+END $$;
 
 -- Criar índice para melhorar performance de consultas por session_id
-CREATE INDEX IF NOT EXISTS idx_session_id ON memoria(session_id);
+-- (índices no pai são propagados para todas as partições)
+CREATE INDEX IF NOT EXISTS idx_session_id ON memoria(session_id, created_at);
 
 -- Criar índice para consultas por data
 CREATE INDEX IF NOT EXISTS idx_created_at ON memoria(created_at);
 
+-- Arquivo compactado: uma linha por sessão/mês com as mensagens agregadas
+-- (JSONB grande é comprimido via TOAST)
+CREATE TABLE IF NOT EXISTS memoria_arquivo (
+    session_id TEXT NOT NULL,
+    mes DATE NOT NULL,
+    mensagens JSONB NOT NULL,
+    total INTEGER NOT NULL,
+    arquivado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (session_id, mes)
+);
+
 -- Comentários
-COMMENT ON TABLE memoria IS 'Histórico de mensagens do agente de supermercado';
-COMMENT ON COLUMN memoria IS 'Identificador da sessão (telefone do cliente)';
-COMMENT ON COLUMN memoria IS 'Mensagem em formato JSON';
-COMMENT ON COLUMN memoria IS 'Data e hora de criação da mensagem';
+COMMENT ON TABLE memoria IS 'Histórico de mensagens do agente de supermercado (particionado por mês)';
+COMMENT ON COLUMN memoria.session_id IS 'Identificador da sessão (telefone do cliente)';
+COMMENT ON COLUMN memoria.message IS 'Mensagem em formato JSON';
+COMMENT ON COLUMN memoria.created_at IS 'Data e hora de criação da mensagem';
+COMMENT ON TABLE memoria_arquivo IS 'Mensagens de partições antigas de memoria, agregadas por sessão e mês';
 
 -- Inserir mensagem de teste (opcional)
--- INSERT INTO basemercadaokLkGG (session_id, message) 
+-- INSERT INTO basemercadaokLkGG (session_id, message)
 -- VALUES ('5511999998888', '{"type": "system", "content": "Histórico iniciado"}');
 
 -- Exibir confirmação
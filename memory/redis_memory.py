@@ -1,84 +1,195 @@
+import base64
 import json
-import time
-from typing import List, Optional
+import zlib
+from typing import Any, Dict, List, Optional
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import (
     BaseMessage,
     HumanMessage,
     AIMessage,
     SystemMessage,
+    ToolMessage,
     messages_from_dict,
-    message_to_dict
 )
 from config.settings import settings
-import redis
+from tools.redis_tools import get_redis_pool, CountingRedis
+from tools.turn_context import current_turn
+
+# ============================================
+# Codec compacto das mensagens da sessão
+# ============================================
+# Formato novo: {"r": "h|a|s|t", "c": "texto", "tc": ["tool", ...], "id": "tool_call_id"}
+# - Sem additional_kwargs / response_metadata / usage_metadata / payload de tool calls
+# - Com compressão opcional (zlib): "z:" + base64(zlib(json)) quando compensar
+# Formato antigo (message_to_dict) continua legível: {"type": "...", "data": {...}}
+
+_ROLE_CODES = {"human": "h", "ai": "a", "system": "s", "tool": "t"}
+_ZLIB_PREFIX = "z:"
+_ZLIB_MIN_BYTES = 512  # Mensagens curtas não compensam (base64 infla 33%)
+
+
+def _content_to_text(content: Any) -> str:
+    """Converte content (str ou lista de blocos) em texto puro, descartando blocos 'thinking'."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for block in content:
+            if isinstance(block, str):
+                parts.append(block)
+            elif isinstance(block, dict) and block.get("type") != "thinking" and "text" in block:
+                parts.append(str(block["text"]))
+        return "\n".join(parts)
+    return str(content) if content else ""
+
+
+def encode_message(message: BaseMessage, compress: Optional[bool] = None) -> str:
+    """Serializa a mensagem no formato compacto (role, texto e resumo das tool calls)."""
+    data: Dict[str, Any] = {
+        "r": _ROLE_CODES.get(message.type, "h"),
+        "c": _content_to_text(message.content),
+    }
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        data["tc"] = [call.get("name", "") for call in tool_calls]
+    tool_call_id = getattr(message, "tool_call_id", None)
+    if tool_call_id:
+        data["id"] = tool_call_id
+
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+    if compress is None:
+        compress = settings.redis_memory_compression == "zlib"
+    if compress and len(raw.encode("utf-8")) >= _ZLIB_MIN_BYTES:
+        packed = _ZLIB_PREFIX + base64.b64encode(zlib.compress(raw.encode("utf-8"), 6)).decode("ascii")
+        if len(packed) < len(raw.encode("utf-8")):
+            return packed
+    return raw
+
+
+def decode_message(raw: str) -> Optional[BaseMessage]:
+    """Lê uma mensagem no formato compacto, comprimido ou antigo (message_to_dict)."""
+    if raw.startswith(_ZLIB_PREFIX):
+        raw = zlib.decompress(base64.b64decode(raw[len(_ZLIB_PREFIX):])).decode("utf-8")
+    data = json.loads(raw)
+    if not isinstance(data, dict):
+        return None
+
+    # Formato antigo: {"type": "human", "data": {...}}
+    if "type" in data and "data" in data:
+        return messages_from_dict([data])[0]
+
+    role = data.get("r", "h")
+    content = data.get("c", "")
+    if role == "a":
+        msg = AIMessage(content=content)
+        if data.get("tc"):
+            # Resumo apenas informativo (response_metadata não é reenviado ao provedor do LLM)
+            msg.response_metadata["tool_names"] = data["tc"]
+        return msg
+    if role == "s":
+        return SystemMessage(content=content)
+    if role == "t":
+        return ToolMessage(content=content, tool_call_id=data.get("id") or "")
+    return HumanMessage(content=content)
+
+
+def session_memory_key(session_id: str) -> str:
+    """Chave da lista de mensagens da sessão no Redis."""
+    return f"session:memory:{session_id}"
+
 
 class RedisChatMessageHistory(BaseChatMessageHistory):
     """
     Histórico de chat baseado em Redis com TTL estrito (Sessão).
-    
+
     Lógica:
     - Armazena todas as mensagens da sessão atual em uma lista Redis.
     - TTL de 15 minutos (900s): renovado a cada interação.
     - Se o TTL expirar, a memória é apagada automaticamente (fim da sessão).
+    - Mensagens no formato compacto (encode_message) e lista limitada a
+      settings.redis_memory_max_messages (LTRIM no mesmo pipeline do RPUSH).
     """
-    
-    def __init__(self, session_id: str, ttl: int = 900):
+
+    def __init__(self, session_id: str, ttl: int = 900, max_messages: Optional[int] = None):
         self.session_id = session_id
-        self.key = f"session:memory:{session_id}"
+        self.key = session_memory_key(session_id)
         self.ttl = ttl
-        
-        # Conexão Redis
-        self.redis_client = redis.from_url(settings.redis_url, decode_responses=True)
+        self.max_messages = max_messages if max_messages is not None else settings.redis_memory_max_messages
+
+        # Conexão Redis (pool compartilhado do processo)
+        self.redis_client = CountingRedis(connection_pool=get_redis_pool())
+
+    def _turn(self):
+        """Contexto do turno ativo que já carregou esta lista de histórico."""
+        ctx = current_turn()
+        if ctx is not None and ctx.get("history_key") == self.key and ctx.has("history"):
+            return ctx
+        return None
 
     @property
     def messages(self) -> List[BaseMessage]:
         """Recupera todas as mensagens da sessão atual do Redis."""
         try:
-            # Ler lista completa
-            raw_messages = self.redis_client.lrange(self.key, 0, -1)
+            # Ler lista completa (do snapshot do turno, se carregado junto com o lock)
+            ctx = self._turn()
+            if ctx is not None:
+                raw_messages = ctx.get("history")
+            else:
+                raw_messages = self.redis_client.lrange(self.key, 0, -1)
             if not raw_messages:
                 return []
-            
-            # Converter JSON -> Dict -> Messages
-            messages_dicts = [json.loads(m) for m in raw_messages]
-            return messages_from_dict(messages_dicts)
-            
+
+            # JSON (compacto, comprimido ou antigo) -> Messages
+            messages = []
+            for raw in raw_messages:
+                try:
+                    msg = decode_message(raw)
+                except Exception:
+                    continue
+                if msg is not None:
+                    messages.append(msg)
+            return messages
+
         except Exception as e:
             print(f"❌ Erro ao ler memória Redis para {self.session_id}: {e}")
             return []
 
     def add_message(self, message: BaseMessage) -> None:
-        """Adiciona uma mensagem à sessão e renova o TTL."""
+        """Adiciona uma mensagem à sessão, aplica o limite de tamanho e renova o TTL."""
         try:
-            # Converter Message -> Dict -> JSON
-            msg_dict = message_to_dict(message)
-            
-            # CRITICAL: Remove thinking blocks to avoid Claude/Anthropic signature issues
-            # When extended thinking is enabled, Claude returns thinking blocks with a
-            # 'signature' field. If this field is missing when sending history back to
-            # the API, it causes HTTP 400: "thinking.signature: Field required"
-            # Since we're using Grok as main model, we can safely strip these blocks.
-            if isinstance(msg_dict.get("data", {}).get("content"), list):
-                msg_dict["data"]["content"] = [
-                    block for block in msg_dict["data"]["content"]
-                    if not isinstance(block, dict) or block.get("type") != "thinking"
-                ]
-            
-            msg_json = json.dumps(msg_dict)
-            
+            # Formato compacto: só role, texto e nomes das tools (sem blocos 'thinking',
+            # que causariam HTTP 400 "thinking.signature: Field required" no Claude)
+            msg_json = encode_message(message)
+
+            # Dentro de um turno do agente: vai para o flush do fim do turno
+            ctx = self._turn()
+            if ctx is not None:
+                ctx.get("history").append(msg_json)
+                ctx.defer_append("rpush", self.key, msg_json)
+                if self.max_messages and self.max_messages > 0:
+                    ctx.defer(f"ltrim:{self.key}", "ltrim", self.key, -self.max_messages, -1)
+                ctx.defer(f"expire:{self.key}", "expire", self.key, self.ttl)
+                return
+
             # Pipeline para atomicidade
             pipe = self.redis_client.pipeline()
             pipe.rpush(self.key, msg_json)
+            if self.max_messages and self.max_messages > 0:
+                pipe.ltrim(self.key, -self.max_messages, -1)
             pipe.expire(self.key, self.ttl) # Renova TTL (15min)
             pipe.execute()
-            
+
         except Exception as e:
             print(f"❌ Erro ao salvar mensagem no Redis para {self.session_id}: {e}")
 
     def clear(self) -> None:
         """Limpa a memória da sessão explicitamente."""
         try:
+            ctx = self._turn()
+            if ctx is not None:
+                ctx.set("history", [])
+                ctx.discard_key(self.key)
             self.redis_client.delete(self.key)
         except Exception as e:
             print(f"❌ Erro ao limpar memória Redis para {self.session_id}: {e}")
@@ -0,0 +1,140 @@
+"""
+Mede o custo de saída do finalizar_pedido_tool: itens_json ecoado pelo LLM vs
+ids compactos ("id:quantidade") vs carrinho (itens montados no servidor).
+
+Para pedidos de 5, 20 e 50 itens reporta:
+- tokens de saída dos argumentos da chamada (tiktoken cl100k_base se
+  instalado; senão ~4 caracteres por token)
+- latência estimada do turno: tokens x ms_por_token (geração) + tempo de
+  montagem das linhas no servidor (format_order_lines, medido)
+- com --live e GOOGLE_API_KEY, mede de verdade: o modelo ecoa os argumentos
+  e o script lê output_tokens e o tempo de parede da resposta
+
+Uso: python scripts/bench_checkout_payload.py [ms_por_token] [--live]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from config.settings import settings
+from tools.checkout import format_order_lines, parse_compact_items
+
+SIZES = (5, 20, 50)
+BUILD_ROUNDS = 200
+PHONE = "5585999990000"
+
+
+def _sample_items(n: int):
+    items = []
+    for i in range(n):
+        if i % 5 == 4:
+            items.append({"id": str(30000 + i), "produto": f"TOMATE SALADA KG {i}", "quantidade": 0.45, "preco": 7.9, "unidades": 3})
+        else:
+            items.append({"id": str(10000 + i), "produto": f"LEITE INTEGRAL ITALAC 1L CX {i}", "quantidade": 2, "preco": 5.49, "unidades": 0})
+    return items
+
+
+def _base_args():
+    return {
+        "cliente": "Maria Souza",
+        "telefone": PHONE,
+        "endereco": "Rua das Flores, 120 - Centro",
+        "forma_pagamento": "pix",
+    }
+
+
+def _call_args(items, mode: str):
+    args = _base_args()
+    if mode == "itens_json":
+        legacy = [{k: v for k, v in i.items() if k != "id"} for i in items]
+        args["itens_json"] = json.dumps(legacy, ensure_ascii=False)
+    elif mode == "ids":
+        args["itens"] = ",".join(
+            f"{i['id']}:{i['quantidade']:g}" + (f":{i['unidades']}" if i["unidades"] else "") for i in items
+        )
+    return json.dumps(args, ensure_ascii=False)
+
+
+def _token_counter():
+    try:
+        import tiktoken
+
+        enc = tiktoken.get_encoding("cl100k_base")
+        return (lambda text: len(enc.encode(text))), "tiktoken cl100k_base"
+    except Exception:
+        return (lambda text: max(1, len(text) // 4)), "aprox. 4 chars/token"
+
+
+def _build_ms(items, mode: str) -> float:
+    """Tempo de servidor para chegar às linhas do pedido (parse + formatação)."""
+    by_id = {i["id"]: i for i in items}
+    spec = json.loads(_call_args(items, "ids"))["itens"]
+    raw = json.loads(_call_args(items, "itens_json"))["itens_json"]
+    start = time.perf_counter()
+    for _ in range(BUILD_ROUNDS):
+        if mode == "itens_json":
+            resolved = json.loads(raw)
+        elif mode == "ids":
+            resolved = [dict(by_id[pid], quantidade=q, unidades=u, observacao=obs)
+                        for pid, q, u, obs in parse_compact_items(spec)]
+        else:
+            resolved = items
+        format_order_lines(resolved)
+    return (time.perf_counter() - start) * 1000 / BUILD_ROUNDS
+
+
+def _live(args_json: str):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    llm = ChatGoogleGenerativeAI(
+        model=settings.llm_model or "gemini-2.5-flash",
+        api_key=settings.google_api_key,
+        temperature=0,
+        timeout=120,
+    )
+    prompt = f"Repita exatamente o JSON abaixo, sem comentários nem markdown:\n{args_json}"
+    start = time.perf_counter()
+    resp = llm.invoke(prompt)
+    elapsed = (time.perf_counter() - start) * 1000
+    usage = getattr(resp, "usage_metadata", None) or {}
+    return usage.get("output_tokens"), elapsed
+
+
+def main():
+    positional = [a for a in sys.argv[1:] if not a.startswith("--")]
+    ms_per_token = float(positional[0]) if positional else 12.0
+    live = "--live" in sys.argv and bool(settings.google_api_key)
+    count, counter_name = _token_counter()
+
+    print(f"Tokens: {counter_name} | geração estimada: {ms_per_token:g} ms/token")
+    if "--live" in sys.argv and not live:
+        print("⚠️ --live ignorado: GOOGLE_API_KEY não configurada")
+
+    for n in SIZES:
+        items = _sample_items(n)
+        print(f"\n=== Pedido com {n} itens ===")
+        baseline = None
+        for mode in ("itens_json", "ids", "carrinho"):
+            args_json = _call_args(items, mode)
+            tokens = count(args_json)
+            build = _build_ms(items, mode)
+            turn = tokens * ms_per_token + build
+            baseline = baseline or turn
+            line = (
+                f"  {mode:<10} {tokens:>5} tokens de saída | montagem {build:6.3f} ms | "
+                f"turno ~{turn:7.0f} ms ({turn / baseline:5.1%} do itens_json)"
+            )
+            if live:
+                try:
+                    live_tokens, live_ms = _live(args_json)
+                    line += f" | live: {live_tokens} tokens em {live_ms:.0f} ms"
+                except Exception as e:
+                    line += f" | live falhou: {e}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
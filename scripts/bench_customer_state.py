@@ -0,0 +1,209 @@
+"""
+Mede a memória do estado pequeno por cliente: chaves separadas vs HASH cust:{phone}.
+
+Para N clientes (padrão 10k) com endereço, comprovante e cooldown:
+- chaves no keyspace e comandos de leitura por turno
+- bytes de payload (sempre) e, se o Redis estiver acessível, a variação de
+  used_memory (INFO memory) para cada layout — cada chave tem ~50-70 B de
+  overhead fixo (dictEntry + redisObject + TTL), que o hash elimina. Mediana
+  de MEASURE_ROUNDS rodadas, cada uma depois do used_memory estabilizar (o
+  serverCron redimensiona os dicts da rodada anterior aos poucos)
+- sem Redis, uma ESTIMATIVA pelo modelo de alocação do Redis 7 (jemalloc,
+  64 bits; hash pequeno em listpack, TTL por campo emulado): não é medição
+
+As chaves de teste usam o prefixo "bench:" e são removidas no fim.
+
+Uso: python scripts/bench_customer_state.py [num_clientes]
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from config.settings import settings
+from tools.customer_state import EXP_SUFFIX
+
+BENCH_PREFIX = "bench:"
+PIPELINE_BATCH = 1000
+MEASURE_ROUNDS = 3
+SETTLE_MAX_SECONDS = 10
+JEMALLOC_CLASSES = (8, 16, 24, 32, 48, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384, 448, 512)
+DICT_ENTRY = 24  # dictEntry (chave, valor, próximo)
+ROBJ = 16  # redisObject
+BUCKET = 8  # ponteiro da tabela do dict (fator de carga ~1)
+
+
+def _customer_state(i: int):
+    phone = f"55859{i:08d}"
+    fields = {
+        "address": f"Rua das Flores, {i % 900 + 1} - Centro, Fortaleza/CE",
+        "comprovante": f"https://cdn.exemplo.com/comprovantes/{phone}.jpg",
+        "cooldown": "1",
+    }
+    ttls = {"address": 7200, "comprovante": 7200, "cooldown": 2400}
+    return phone, fields, ttls
+
+
+def _fill_legacy(pipe, phone, fields, ttls):
+    for field, value in fields.items():
+        pipe.set(f"{BENCH_PREFIX}{field}:{phone}", value, ex=ttls[field])
+
+
+def _fill_hash(pipe, phone, fields, ttls):
+    now_ms = int(time.time() * 1000)
+    mapping = dict(fields)
+    for field, ttl in ttls.items():
+        mapping[field + EXP_SUFFIX] = now_ms + ttl * 1000
+    key = f"{BENCH_PREFIX}cust:{phone}"
+    pipe.hset(key, mapping=mapping)
+    pipe.pexpire(key, max(ttls.values()) * 1000)
+
+
+def _payload_bytes(n: int, layout: str) -> int:
+    total = 0
+    now_ms = str(int(time.time() * 1000))
+    for i in range(n):
+        phone, fields, _ = _customer_state(i)
+        if layout == "legacy":
+            total += sum(len(f"{BENCH_PREFIX}{f}:{phone}") + len(v.encode("utf-8")) for f, v in fields.items())
+        else:
+            total += len(f"{BENCH_PREFIX}cust:{phone}")
+            total += sum(len(f) + len(v.encode("utf-8")) + len(f + EXP_SUFFIX) + len(now_ms) for f, v in fields.items())
+    return total
+
+
+def _alloc(size: int) -> int:
+    """Tamanho real da alocação (classe do jemalloc)."""
+    for cls in JEMALLOC_CLASSES:
+        if size <= cls:
+            return cls
+    return (size + 127) // 128 * 128
+
+
+def _sds(length: int) -> int:
+    return _alloc(length + (3 if length < 256 else 5))  # cabeçalho sdshdr8/16 + '\0'
+
+
+def _string_value(value: str) -> int:
+    if value.isdigit() and int(value) < 10000:
+        return 0  # inteiro compartilhado (shared.integers)
+    length = len(value.encode("utf-8"))
+    if length <= 44:
+        return _alloc(ROBJ + 3 + length + 1)  # EMBSTR: robj e sds numa alocação
+    return ROBJ + _sds(length)
+
+
+def _listpack_entry(value: str) -> int:
+    if value.lstrip("-").isdigit() and len(value) < 19:
+        v = abs(int(value))
+        data = 1 if v < 128 else 2 if v < 4096 else 3 if v < 2 ** 15 else 4 if v < 2 ** 23 else 5 if v < 2 ** 31 else 9
+        return data + 1  # codificação inteira + backlen
+    length = len(value.encode("utf-8"))
+    header = 1 if length < 64 else 2 if length < 4096 else 5
+    return header + length + (1 if header + length < 128 else 2)
+
+
+def _estimate_bytes(n: int, layout: str) -> int:
+    """Estimativa de used_memory (chave no dict principal + TTL no dict de expires)."""
+    total = 0
+    now_ms = str(int(time.time() * 1000))
+    for i in range(n):
+        phone, fields, _ = _customer_state(i)
+        if layout == "legacy":
+            for field, value in fields.items():
+                key = f"{BENCH_PREFIX}{field}:{phone}"
+                total += 2 * (DICT_ENTRY + BUCKET) + _sds(len(key)) + _string_value(value)
+        else:
+            key = f"{BENCH_PREFIX}cust:{phone}"
+            listpack = 6 + 1  # cabeçalho + terminador
+            for field, value in fields.items():
+                listpack += _listpack_entry(field) + _listpack_entry(value)
+                listpack += _listpack_entry(field + EXP_SUFFIX) + _listpack_entry(now_ms)
+            total += 2 * (DICT_ENTRY + BUCKET) + _sds(len(key)) + ROBJ + _alloc(listpack)
+    return total
+
+
+def _settle(client) -> int:
+    """used_memory depois do serverCron redimensionar os dicts da rodada anterior (estável por 1 s)."""
+    last = client.info("memory")["used_memory"]
+    for _ in range(SETTLE_MAX_SECONDS):
+        time.sleep(1)
+        current = client.info("memory")["used_memory"]
+        if current == last:
+            break
+        last = current
+    return last
+
+
+def _measure(client, n: int, fill) -> int:
+    """Mediana da variação de used_memory ao gravar N clientes (MEASURE_ROUNDS rodadas, chaves apagadas em seguida)."""
+    return int(statistics.median(_measure_once(client, n, fill) for _ in range(MEASURE_ROUNDS)))
+
+
+def _measure_once(client, n: int, fill) -> int:
+    before = _settle(client)
+    pipe = client.pipeline(transaction=False)
+    for i in range(n):
+        fill(pipe, *_customer_state(i))
+        if (i + 1) % PIPELINE_BATCH == 0:
+            pipe.execute()
+    pipe.execute()
+    used = client.info("memory")["used_memory"] - before
+    _cleanup(client)
+    return used
+
+
+def _cleanup(client) -> None:
+    batch = []
+    for key in client.scan_iter(match=f"{BENCH_PREFIX}*", count=PIPELINE_BATCH):
+        batch.append(key)
+        if len(batch) >= PIPELINE_BATCH:
+            client.unlink(*batch)
+            batch = []
+    if batch:
+        client.unlink(*batch)
+
+
+def _redis():
+    try:
+        import redis
+        client = redis.from_url(settings.redis_url, decode_responses=True, socket_connect_timeout=2)
+        client.ping()
+        return client
+    except Exception:
+        return None
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    client = _redis()
+
+    layouts = {
+        "chaves separadas": ("legacy", _fill_legacy, 3 * n, 3),
+        "hash cust:{phone}": ("hash", _fill_hash, n, 1),
+    }
+
+    print(f"📊 Estado pequeno de {n} clientes (endereço, comprovante, cooldown)")
+    if client is not None:
+        server = client.info("server")
+        allocator = client.info("memory").get("mem_allocator")
+        print(f"   Redis {server.get('redis_version')} (alocador {allocator}), mediana de {MEASURE_ROUNDS} rodadas")
+    print("")
+    for name, (layout, fill, keys, reads) in layouts.items():
+        payload = _payload_bytes(n, layout)
+        line = f"- {name:18s}: {keys:7d} chaves | {reads} leitura(s)/turno | payload {payload / 1024:8.1f} KiB"
+        if client is not None:
+            used = _measure(client, n, fill)
+            line += f" | used_memory +{used / 1024:8.1f} KiB ({used / n:6.1f} B/cliente)"
+        else:
+            est = _estimate_bytes(n, layout)
+            line += f" | estimativa {est / 1024:8.1f} KiB ({est / n:6.1f} B/cliente)"
+        print(line)
+    if client is None:
+        print("\n⚠️ Redis inacessível: used_memory não medido; a coluna estimativa vem do modelo de alocação")
+
+
+if __name__ == "__main__":
+    main()
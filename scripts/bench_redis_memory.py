@@ -0,0 +1,82 @@
+"""
+Mede o tamanho da memória de sessão no Redis: formato antigo (message_to_dict) vs compacto.
+
+Reporta, para uma conversa típica:
+- bytes por sessão ativa (soma dos valores da lista e, se o Redis estiver acessível, MEMORY USAGE)
+- bytes trafegados por turno (LRANGE completo da lista no início do turno)
+
+Uso: python scripts/bench_redis_memory.py [num_turnos]
+"""
+import json
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from langchain_core.messages import HumanMessage, AIMessage, message_to_dict
+
+from memory.redis_memory import encode_message
+from config.settings import settings
+
+
+def _sample_conversation(turns: int):
+    msgs = []
+    for i in range(turns):
+        msgs.append(HumanMessage(content=f"[TELEFONE_CLIENTE: 5585999990000]\n[HORÁRIO_ATUAL: 18/10/2026 às 10:{i:02d}]\n\nquero 2 leite integral e 1kg de tomate | {i}"))
+        ai = AIMessage(
+            content=[
+                {"type": "thinking", "thinking": "x" * 300, "signature": "sig" * 20},
+                {"type": "text", "text": f"Adicionei 2x LEITE INTEGRAL 1L (R$ 5,49) e TOMATE KG (~R$ 7,90). Total parcial R$ {18.88 + i:.2f}. Algo mais?"},
+            ],
+            additional_kwargs={"function_call": None},
+            response_metadata={"model_name": "gemini-2.5-flash", "finish_reason": "STOP", "safety_ratings": [{"category": "HARM", "probability": "NEGLIGIBLE"}] * 4},
+            usage_metadata={"input_tokens": 5400 + i * 120, "output_tokens": 85, "total_tokens": 5485 + i * 120},
+            tool_calls=[{"name": "busca_produto_tool", "args": {"telefone": "5585999990000", "query": "leite integral"}, "id": f"call_{i}"}],
+        )
+        msgs.append(ai)
+    return msgs
+
+
+def _legacy_encode(message) -> str:
+    return json.dumps(message_to_dict(message))
+
+
+def _memory_usage(values):
+    """MEMORY USAGE real de uma lista com os valores (None se o Redis não estiver acessível)."""
+    try:
+        import redis
+        client = redis.from_url(settings.redis_url, decode_responses=True, socket_connect_timeout=2)
+        key = "bench:session:memory"
+        client.delete(key)
+        client.rpush(key, *values)
+        usage = client.memory_usage(key)
+        client.delete(key)
+        return usage
+    except Exception:
+        return None
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    msgs = _sample_conversation(turns)
+    limit = settings.redis_memory_max_messages
+
+    variants = {
+        "antigo (message_to_dict)": [_legacy_encode(m) for m in msgs],
+        "compacto": [encode_message(m, compress=False) for m in msgs][-limit:],
+        "compacto + zlib": [encode_message(m, compress=True) for m in msgs][-limit:],
+    }
+
+    print(f"📊 Conversa de {turns} turnos ({len(msgs)} mensagens), limite LTRIM={limit}\n")
+    base = None
+    for name, values in variants.items():
+        total = sum(len(v.encode("utf-8")) for v in values)
+        per_turn = total  # cada turno faz LRANGE 0 -1 da lista inteira
+        base = base or total
+        usage = _memory_usage(values)
+        usage_txt = f" | MEMORY USAGE: {usage} B" if usage is not None else ""
+        print(f"- {name:26s}: {len(values):3d} msgs | {total:7d} B/sessão | {per_turn:7d} B/turno (LRANGE) | {100 * total / base:5.1f}%{usage_txt}")
+
+
+if __name__ == "__main__":
+    main()
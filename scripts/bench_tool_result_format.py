@@ -0,0 +1,141 @@
+"""
+Mede os tokens de entrada gastos com resultados de ferramenta: JSON (formato
+antigo) vs tabela compacta (settings.tool_result_format = "compact").
+
+Para um conjunto fixo de buscas (GOLDEN_QUERIES):
+- tokens de cada resultado da busca_produto_tool nos dois formatos (usa o
+  Postgres de verdade se estiver acessível; senão, produtos sintéticos no
+  formato do search_products_db, 8 por busca)
+- tokens por turno: num turno com N buscas seguidas, o resultado da busca i
+  volta como entrada em todos os passos seguintes do ReAct (i+1 .. N+1)
+- o mesmo para a consulta de estoque por EAN (indent=2 antigo vs tabela)
+
+Tokens: tiktoken cl100k_base se instalado; senão ~4 caracteres por token.
+
+Uso: python scripts/bench_tool_result_format.py [buscas_por_turno]
+"""
+import json
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from config.settings import settings
+from tools import result_format
+
+GOLDEN_QUERIES = [
+    "arroz tipo 1 5kg", "feijao carioca", "leite integral 1l", "coca cola 2l", "oleo de soja",
+    "acucar cristal", "cafe 500g", "detergente", "sabao em po", "papel higienico",
+    "frango kg", "carne moida", "tomate", "cebola", "banana prata",
+    "queijo mussarela", "presunto", "manteiga", "sorvete 2l", "cerveja lata",
+]
+
+
+def _token_counter():
+    try:
+        import tiktoken
+
+        enc = tiktoken.get_encoding("cl100k_base")
+        return (lambda text: len(enc.encode(text))), "tiktoken cl100k_base"
+    except Exception:
+        return (lambda text: max(1, len(text) // 4)), "aprox. 4 chars/token"
+
+
+def _synthetic_results(query: str, n: int = 8):
+    base = query.upper()
+    por_kg = any(w in query for w in ("kg", "frango", "carne", "tomate", "cebola", "banana"))
+    return [
+        {
+            "id": str(10000 + (sum(map(ord, query)) * 8 + i) % 90000),
+            "nome": f"{base} {['TIO JOAO', 'CAMIL', 'PREDILECTA', 'ITALAC', 'DA CASA', 'NORDESTE', 'PREMIUM', 'ECONOMICO'][i % 8]}"
+                    + (" KG" if por_kg else f" {(i % 3 + 1) * 500}G"),
+            "categoria": "HORTIFRUTI" if por_kg else "MERCEARIA SALGADA",
+            "preco": round(3.49 + i * 1.37, 2),
+            "estoque": 100.0 if por_kg else float(5 + i * 7),
+            "unidade": "KG" if por_kg else "UN",
+            "match_score": round(0.93 - i * 0.07, 4),
+            "match_ok": i == 0,
+        }
+        for i in range(n)
+    ]
+
+
+def _search_results(query: str):
+    """(resultados, origem): Postgres se responder com produtos, senão sintético."""
+    try:
+        from tools.db_search import search_products_db
+
+        rows = json.loads(search_products_db(query))
+        if rows:
+            return rows, "postgres"
+    except Exception:
+        pass
+    return _synthetic_results(query), "sintético"
+
+
+def _ean_sample(n: int = 3):
+    return [
+        {
+            "id_loja": 1, "id": 7891149103300 + i, "produto": f"REFRIGERANTE COCA COLA PET 2L {i}",
+            "preco": 9.99, "vl_produto": 9.99, "vl_produto_normal": 11.49, "qtd_produto": 48.0,
+            "dt_cadastro": "2021-03-15T00:00:00", "classificacao01": "BEBIDAS", "classificacao02": "REFRIGERANTES",
+            "classificacao03": "COLA", "fracionado": False, "ativo": True, "fracionamento": 1, "emb": "UN",
+            "disponibilidade": True,
+        }
+        for i in range(n)
+    ]
+
+
+def _render(items, fmt: str) -> str:
+    settings.tool_result_format = fmt
+    return result_format.render_products(items)
+
+
+def main():
+    per_turn = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    count, counter_name = _token_counter()
+    original_format = settings.tool_result_format
+
+    totals = {"json": 0, "compact": 0}
+    origins = set()
+    per_query = []
+    for query in GOLDEN_QUERIES:
+        items, origin = _search_results(query)
+        origins.add(origin)
+        tokens = {fmt: count(_render(items, fmt)) for fmt in totals}
+        for fmt in totals:
+            totals[fmt] += tokens[fmt]
+        per_query.append(tokens)
+
+    n = len(GOLDEN_QUERIES)
+    print(f"Tokens: {counter_name} | resultados: {', '.join(sorted(origins))} | {n} buscas")
+    print(f"\n=== Por resultado da busca_produto_tool (média de {n}) ===")
+    for fmt, total in totals.items():
+        print(f"  {fmt:<8} {total / n:7.1f} tokens")
+    print(f"  redução {1 - totals['compact'] / totals['json']:7.1%}")
+
+    # Turno com per_turn buscas: o resultado i entra em per_turn + 1 - i passos
+    print(f"\n=== Tokens de entrada por turno ({per_turn} buscas + resposta final) ===")
+    turns = [per_query[i:i + per_turn] for i in range(0, n, per_turn)]
+    turn_cost = {
+        fmt: sum(r[fmt] * (per_turn + 1 - i) for turn in turns for i, r in enumerate(turn, 1)) / len(turns)
+        for fmt in totals
+    }
+    for fmt, cost in turn_cost.items():
+        print(f"  {fmt:<8} {cost:7.0f} tokens/turno")
+    saved = turn_cost["json"] - turn_cost["compact"]
+    print(f"  redução {saved / turn_cost['json']:7.1%} ({saved:.0f} tokens/turno)")
+
+    sample = _ean_sample()
+    legacy = json.dumps(sample, indent=2, ensure_ascii=False)
+    settings.tool_result_format = "compact"
+    compact = result_format.render_estoque(json.dumps(sample, ensure_ascii=False))
+    print(f"\n=== Estoque por EAN ({len(sample)} itens) ===")
+    print(f"  json indent=2 {count(legacy):5} tokens")
+    print(f"  compact       {count(compact):5} tokens ({1 - count(compact) / count(legacy):.1%} menos)")
+
+    settings.tool_result_format = original_format
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,7 @@ def _inspect_raw_keys(raw_phone: str):
     candidates = {
         "cart_raw": f"cart:{raw_phone}",
         "cart_norm": f"cart:{norm}",
+        "cart_idx_norm": f"cart_idx:{norm}",
         "order_session_raw": f"order_session:{raw_phone}",
         "order_session_norm": f"order_session:{norm}",
         "suggestions_raw": f"suggestions:{raw_phone}",
@@ -53,6 +54,10 @@ def _inspect_raw_keys(raw_phone: str):
             extra = ""
             if t == "list":
                 extra = f" | len={client.llen(key)}"
+            elif t == "hash":
+                extra = f" | fields={client.hlen(key)}"
+            elif t == "zset":
+                extra = f" | len={client.zcard(key)}"
             elif t == "string":
                 val = client.get(key)
                 extra = f" | value_preview={str(val)[:80]}"
@@ -0,0 +1,383 @@
+"""
+Manutenção das partições mensais da tabela de memória (settings.postgres_table_name)
+
+O job diário (agendado no APScheduler do server.py) faz três coisas:
+1. Cria as partições dos próximos meses (settings.memoria_partitions_ahead)
+2. Compacta partições antigas em <tabela>_arquivo: uma linha por sessão/mês
+   com as mensagens agregadas em JSONB (comprimido via TOAST) e remove a partição
+3. Remove partições e linhas de arquivo fora da retenção (settings.memoria_retention_months)
+
+Uso:
+    python scripts/memoria_partitions.py            # roda a manutenção
+    python scripts/memoria_partitions.py --migrate  # converte a tabela antiga (heap único) em particionada
+"""
+import os
+import re
+import sys
+import time
+from datetime import date
+from typing import Dict, Optional
+
+import psycopg2
+from psycopg2 import sql
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.settings import settings
+from config.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+MIGRATION_BATCH_SIZE = 50000
+
+
+def _month_start(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def _add_months(d: date, months: int) -> date:
+    idx = d.year * 12 + (d.month - 1) + months
+    return date(idx // 12, idx % 12 + 1, 1)
+
+
+def _partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+
+def _archive_name(table: str) -> str:
+    return f"{table}_arquivo"
+
+
+def _default_name(table: str) -> str:
+    return f"{table}_default"
+
+
+def _relkind(cur, name: str) -> Optional[str]:
+    """Retorna o relkind ('r' = heap, 'p' = particionada) ou None se não existir."""
+    cur.execute("SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass(quote_ident(%s))", (name,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    kind = row[0]
+    return kind.decode() if isinstance(kind, bytes) else kind
+
+
+def _list_partitions(cur, table: str) -> Dict[date, str]:
+    """Partições mensais existentes ({mês: nome}); a partição DEFAULT é ignorada."""
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(quote_ident(%s))
+        """,
+        (table,),
+    )
+    pattern = re.compile(rf"^{re.escape(table)}_p(\d{{4}})_(\d{{2}})$")
+    parts: Dict[date, str] = {}
+    for (name,) in cur.fetchall():
+        m = pattern.match(name)
+        if m:
+            parts[date(int(m.group(1)), int(m.group(2)), 1)] = name
+    return parts
+
+
+def _create_parent(cur, table: str) -> None:
+    """Cria a tabela particionada, a partição DEFAULT, os índices e a tabela de arquivo."""
+    t = sql.Identifier(table)
+    cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {t} (
+            id BIGSERIAL,
+            session_id TEXT NOT NULL,
+            message JSONB NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """).format(t=t))
+    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {d} PARTITION OF {t} DEFAULT").format(
+        d=sql.Identifier(_default_name(table)), t=t,
+    ))
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS idx_session_id ON {t}(session_id, created_at)").format(t=t))
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS idx_created_at ON {t}(created_at)").format(t=t))
+    _ensure_archive_table(cur, table)
+
+
+def _ensure_archive_table(cur, table: str) -> None:
+    cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {a} (
+            session_id TEXT NOT NULL,
+            mes DATE NOT NULL,
+            mensagens JSONB NOT NULL,
+            total INTEGER NOT NULL,
+            arquivado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (session_id, mes)
+        )
+    """).format(a=sql.Identifier(_archive_name(table))))
+
+
+def _create_partition(cur, table: str, month: date) -> None:
+    """
+    Cria a partição do mês. Se a partição DEFAULT já tiver linhas desse intervalo
+    (ex: job ficou parado), as linhas são movidas antes do ATTACH.
+    """
+    name = sql.Identifier(_partition_name(table, month))
+    t = sql.Identifier(table)
+    start, end = month, _add_months(month, 1)
+
+    pending = 0
+    if _relkind(cur, _default_name(table)):
+        cur.execute(
+            sql.SQL("SELECT count(*) FROM {d} WHERE created_at >= %s AND created_at < %s").format(
+                d=sql.Identifier(_default_name(table))
+            ),
+            (start, end),
+        )
+        pending = cur.fetchone()[0]
+
+    if not pending:
+        cur.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {p} PARTITION OF {t} FOR VALUES FROM ({s}) TO ({e})").format(
+                p=name, t=t, s=sql.Literal(start), e=sql.Literal(end),
+            )
+        )
+        return
+
+    d = sql.Identifier(_default_name(table))
+    cur.execute(sql.SQL("CREATE TABLE {p} (LIKE {t} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(p=name, t=t))
+    cur.execute(
+        sql.SQL("INSERT INTO {p} SELECT * FROM {d} WHERE created_at >= %s AND created_at < %s").format(p=name, d=d),
+        (start, end),
+    )
+    cur.execute(sql.SQL("DELETE FROM {d} WHERE created_at >= %s AND created_at < %s").format(d=d), (start, end))
+    cur.execute(
+        sql.SQL("ALTER TABLE {t} ATTACH PARTITION {p} FOR VALUES FROM ({s}) TO ({e})").format(
+            t=t, p=name, s=sql.Literal(start), e=sql.Literal(end),
+        )
+    )
+    logger.info(f"📦 {pending} mensagens movidas da partição DEFAULT para {_partition_name(table, month)}")
+
+
+def _drop_partition(cur, table: str, name: str) -> None:
+    cur.execute(sql.SQL("ALTER TABLE {t} DETACH PARTITION {p}").format(t=sql.Identifier(table), p=sql.Identifier(name)))
+    cur.execute(sql.SQL("DROP TABLE {p}").format(p=sql.Identifier(name)))
+
+
+def create_future_partitions(conn, table: str, ahead: int) -> int:
+    """Garante partições do mês atual até `ahead` meses à frente. Retorna quantas foram criadas."""
+    current = _month_start(date.today())
+    created = 0
+    with conn.cursor() as cur:
+        existing = _list_partitions(cur, table)
+        for i in range(max(0, ahead) + 1):
+            month = _add_months(current, i)
+            if month in existing:
+                continue
+            _create_partition(cur, table, month)
+            created += 1
+            logger.info(f"🗓️ Partição criada: {_partition_name(table, month)}")
+    conn.commit()
+    return created
+
+
+def archive_old_partitions(conn, table: str, older_than_months: int) -> int:
+    """
+    Compacta partições com mais de `older_than_months` meses em <tabela>_arquivo
+    (uma linha por sessão/mês) e remove a partição. Cada partição é uma transação.
+    """
+    if older_than_months <= 0:
+        return 0
+    cutoff = _add_months(_month_start(date.today()), -older_than_months)
+    archived = 0
+    with conn.cursor() as cur:
+        _ensure_archive_table(cur, table)
+        conn.commit()
+        for month, name in sorted(_list_partitions(cur, table).items()):
+            if month >= cutoff:
+                continue
+            a = sql.Identifier(_archive_name(table))
+            cur.execute(
+                sql.SQL("""
+                    INSERT INTO {a} AS arq (session_id, mes, mensagens, total)
+                    SELECT session_id, %s, jsonb_agg(message ORDER BY created_at, id), count(*)
+                    FROM {p}
+                    GROUP BY session_id
+                    ON CONFLICT (session_id, mes) DO UPDATE SET
+                        mensagens = arq.mensagens || EXCLUDED.mensagens,
+                        total = arq.total + EXCLUDED.total,
+                        arquivado_em = CURRENT_TIMESTAMP
+                """).format(a=a, p=sql.Identifier(name)),
+                (month,),
+            )
+            sessions = cur.rowcount
+            _drop_partition(cur, table, name)
+            conn.commit()
+            archived += 1
+            logger.info(f"🗜️ Partição {name} arquivada ({sessions} sessões) e removida")
+    return archived
+
+
+def drop_expired(conn, table: str, retention_months: int) -> int:
+    """Remove partições e linhas de arquivo mais antigas que `retention_months`."""
+    if retention_months <= 0:
+        return 0
+    cutoff = _add_months(_month_start(date.today()), -retention_months)
+    dropped = 0
+    with conn.cursor() as cur:
+        for month, name in sorted(_list_partitions(cur, table).items()):
+            if month >= cutoff:
+                continue
+            _drop_partition(cur, table, name)
+            dropped += 1
+            logger.info(f"🗑️ Partição {name} removida (fora da retenção)")
+        if _relkind(cur, _archive_name(table)):
+            cur.execute(
+                sql.SQL("DELETE FROM {a} WHERE mes < %s").format(a=sql.Identifier(_archive_name(table))),
+                (cutoff,),
+            )
+            if cur.rowcount:
+                logger.info(f"🗑️ {cur.rowcount} linhas de arquivo removidas (anteriores a {cutoff})")
+    conn.commit()
+    return dropped
+
+
+def maintain_memoria_partitions() -> Optional[Dict[str, int]]:
+    """Job agendado: cria partições futuras, arquiva as antigas e aplica a retenção."""
+    table = settings.postgres_table_name
+    started = time.monotonic()
+    conn = None
+    try:
+        conn = psycopg2.connect(settings.postgres_connection_string)
+        with conn.cursor() as cur:
+            kind = _relkind(cur, table)
+        if kind != "p":
+            logger.warning(
+                f"⚠️ Tabela '{table}' não é particionada; manutenção ignorada. "
+                f"Rode: python scripts/memoria_partitions.py --migrate"
+            )
+            return None
+
+        summary = {
+            "created": create_future_partitions(conn, table, settings.memoria_partitions_ahead),
+            "archived": archive_old_partitions(conn, table, settings.memoria_archive_after_months),
+            "dropped": drop_expired(conn, table, settings.memoria_retention_months),
+        }
+        logger.info(f"✅ Manutenção de partições '{table}' concluída em {time.monotonic() - started:.1f}s: {summary}")
+        return summary
+    except Exception as e:
+        logger.error(f"❌ Falha na manutenção de partições de '{table}': {e}")
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+
+def migrate_to_partitioned(batch_size: int = MIGRATION_BATCH_SIZE, keep_legacy: bool = False) -> bool:
+    """
+    Converte a tabela antiga (heap único) em particionada, online:
+    1. Transação curta: renomeia a tabela para <tabela>_legacy e cria a particionada
+       (reaproveitando a sequence do id). Novas mensagens já caem na nova tabela.
+    2. Cria partições cobrindo o histórico e copia os dados em lotes por id (commit por lote).
+    3. Remove a tabela antiga (a menos que keep_legacy=True).
+    """
+    table = settings.postgres_table_name
+    legacy = f"{table}_legacy"
+    conn = psycopg2.connect(settings.postgres_connection_string)
+    try:
+        with conn.cursor() as cur:
+            kind = _relkind(cur, table)
+            if kind == "p" and not _relkind(cur, legacy):
+                logger.info(f"Tabela '{table}' já é particionada. Nada a migrar.")
+                return True
+
+            if kind == "r":
+                cur.execute(sql.SQL("LOCK TABLE {t} IN ACCESS EXCLUSIVE MODE").format(t=sql.Identifier(table)))
+                cur.execute("SELECT pg_get_serial_sequence(quote_ident(%s), 'id')", (table,))
+                seq = cur.fetchone()[0]
+                cur.execute(sql.SQL("ALTER TABLE {t} RENAME TO {l}").format(t=sql.Identifier(table), l=sql.Identifier(legacy)))
+                # Nomes de índice são globais no schema: liberar para a nova tabela
+                cur.execute("ALTER INDEX IF EXISTS idx_session_id RENAME TO idx_session_id_legacy")
+                cur.execute("ALTER INDEX IF EXISTS idx_created_at RENAME TO idx_created_at_legacy")
+                _create_parent(cur, table)
+                if seq:
+                    # Continua a numeração antiga em vez da sequence nova do BIGSERIAL
+                    cur.execute("SELECT pg_get_serial_sequence(quote_ident(%s), 'id')", (table,))
+                    new_seq = cur.fetchone()[0]
+                    cur.execute(
+                        sql.SQL("ALTER TABLE {t} ALTER COLUMN id SET DEFAULT nextval({s}::regclass)").format(
+                            t=sql.Identifier(table), s=sql.Literal(seq),
+                        )
+                    )
+                    cur.execute(sql.SQL("ALTER SEQUENCE {s} OWNED BY {t}.id").format(
+                        s=sql.SQL(seq), t=sql.Identifier(table),
+                    ))
+                    if new_seq and new_seq != seq:
+                        cur.execute(sql.SQL("DROP SEQUENCE IF EXISTS {s}").format(s=sql.SQL(new_seq)))
+                conn.commit()
+                logger.info(f"🔁 '{table}' renomeada para '{legacy}'; tabela particionada criada")
+            elif kind is None:
+                _create_parent(cur, table)
+                conn.commit()
+                create_future_partitions(conn, table, settings.memoria_partitions_ahead)
+                logger.info(f"✅ Tabela particionada '{table}' criada do zero")
+                return True
+
+            # Partições cobrindo todo o histórico antigo
+            l = sql.Identifier(legacy)
+            cur.execute(sql.SQL("SELECT min(created_at), min(id), max(id), count(*) FROM {l}").format(l=l))
+            min_created, min_id, max_id, total = cur.fetchone()
+            month = _month_start(min_created.date()) if min_created else _month_start(date.today())
+            existing = _list_partitions(cur, table)
+            current = _month_start(date.today())
+            while month <= current:
+                if month not in existing:
+                    _create_partition(cur, table, month)
+                month = _add_months(month, 1)
+            conn.commit()
+        create_future_partitions(conn, table, settings.memoria_partitions_ahead)
+
+        copied = 0
+        started = time.monotonic()
+        if total:
+            last_id = min_id - 1
+            with conn.cursor() as cur:
+                while last_id < max_id:
+                    upper = last_id + batch_size
+                    cur.execute(
+                        sql.SQL("""
+                            INSERT INTO {t} (id, session_id, message, created_at)
+                            SELECT id, session_id, message::jsonb, COALESCE(created_at, CURRENT_TIMESTAMP)
+                            FROM {l}
+                            WHERE id > %s AND id <= %s
+                            ON CONFLICT DO NOTHING
+                        """).format(t=sql.Identifier(table), l=l),
+                        (last_id, upper),
+                    )
+                    copied += max(cur.rowcount, 0)
+                    conn.commit()
+                    last_id = upper
+                    elapsed = max(time.monotonic() - started, 1e-6)
+                    logger.info(f"📥 Migração: {copied}/{total} mensagens ({copied / elapsed:.0f} msg/s)")
+
+        if not keep_legacy:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("DROP TABLE {l}").format(l=l))
+            conn.commit()
+            logger.info(f"🗑️ Tabela antiga '{legacy}' removida")
+
+        logger.info(f"✅ Migração concluída: {copied} mensagens copiadas para '{table}' particionada")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Falha na migração de '{table}': {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    if "--migrate" in sys.argv:
+        ok = migrate_to_partitioned(keep_legacy="--keep-legacy" in sys.argv)
+        sys.exit(0 if ok else 1)
+    maintain_memoria_partitions()
@@ -0,0 +1,216 @@
+"""
+Migração one-shot das chaves Redis com telefone não normalizado
+
+Percorre o keyspace com SCAN (em lotes) e renomeia as chaves
+cart:, order_session:, suggestions:, comprovante: e address: cujo sufixo
+não é o telefone normalizado (ex: "cart:+55 85 9999-0000" -> "cart:558599990000").
+Carrinhos ainda no formato antigo (LIST) são convertidos para o hash.
+
+Pode rodar com o sistema no ar: RENAMENX é atômico e não sobrescreve a chave
+normalizada (conflitos são apenas reportados). Ao terminar sem conflitos, grava
+o marcador PHONE_KEYS_MIGRATION_MARKER e as funções de redis_tools deixam de
+chamar _maybe_migrate_key.
+
+Com --customer-hash, move endereço, comprovante e cooldown das
+chaves separadas para o HASH cust:{phone} (settings.redis_customer_hash),
+preservando o TTL restante. Rodar logo após ligar a flag; campos que já
+existem no hash (mais novos) não são sobrescritos.
+
+Uso:
+    python scripts/migrate_redis_keys.py             # migra e grava o marcador
+    python scripts/migrate_redis_keys.py --dry-run   # só conta o que seria migrado
+    python scripts/migrate_redis_keys.py --batch 2000
+    python scripts/migrate_redis_keys.py --customer-hash [--dry-run]
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.logger import setup_logger
+from tools import customer_state
+from tools.redis_tools import (
+    PHONE_KEYS_MIGRATION_MARKER,
+    PHONE_KEY_PREFIXES,
+    get_redis_client,
+    migrate_cart_list,
+    normalize_phone,
+    registered_script,
+)
+
+logger = setup_logger(__name__)
+
+SCAN_BATCH_SIZE = 1000
+PROGRESS_EVERY_SECONDS = 5
+
+
+def _target_key(key: str) -> Tuple[str, str]:
+    """Retorna (chave_normalizada, telefone_normalizado) para uma chave com prefixo conhecido."""
+    prefix, _, suffix = key.partition(":")
+    phone = normalize_phone(suffix)
+    return f"{prefix}:{phone}", phone
+
+
+def migrate_phone_keys(batch_size: int = SCAN_BATCH_SIZE, dry_run: bool = False) -> Dict[str, int]:
+    """
+    Executa a migração. Retorna o resumo:
+    scanned, renamed, conflicts, carts_converted, seconds.
+    """
+    client = get_redis_client()
+    if client is None:
+        logger.error("❌ Redis indisponível: migração não executada")
+        return {}
+
+    stats = {"scanned": 0, "renamed": 0, "conflicts": 0, "carts_converted": 0}
+    start = time.monotonic()
+    last_report = start
+
+    for prefix in PHONE_KEY_PREFIXES:
+        batch: List[str] = []
+        for key in client.scan_iter(match=f"{prefix}*", count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                _process_batch(client, prefix, batch, stats, dry_run)
+                batch = []
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_EVERY_SECONDS:
+                last_report = now
+                rate = stats["scanned"] / max(now - start, 1e-6)
+                logger.info(f"⏳ {prefix} scanned={stats['scanned']} renamed={stats['renamed']} conflicts={stats['conflicts']} ({rate:.0f} chaves/s)")
+        if batch:
+            _process_batch(client, prefix, batch, stats, dry_run)
+
+    stats["seconds"] = round(time.monotonic() - start, 2)
+    rate = stats["scanned"] / max(stats["seconds"], 1e-6)
+    logger.info(f"📊 Migração {'(dry-run) ' if dry_run else ''}concluída: {stats} | {rate:.0f} chaves/s")
+
+    if not dry_run and stats["conflicts"] == 0:
+        client.set(PHONE_KEYS_MIGRATION_MARKER, json.dumps({**stats, "finished_at": datetime.now().isoformat()}))
+        logger.info(f"✅ Marcador {PHONE_KEYS_MIGRATION_MARKER} gravado: checagens por chamada desativadas")
+    elif stats["conflicts"]:
+        logger.warning("⚠️ Há conflitos (chave bruta e normalizada coexistem): marcador NÃO gravado")
+    return stats
+
+
+def _process_batch(client, prefix: str, keys: List[str], stats: Dict[str, int], dry_run: bool) -> None:
+    stats["scanned"] += len(keys)
+    renames = []
+    for key in keys:
+        target, _ = _target_key(key)
+        if target != key:
+            renames.append((key, target))
+
+    # Carrinhos: converter os que ainda são LIST (já considerando o nome final)
+    cart_phones = []
+    if prefix == "cart:":
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        for key, key_type in zip(keys, pipe.execute()):
+            if key_type == "list":
+                cart_phones.append(_target_key(key)[1])
+
+    if dry_run:
+        pipe = client.pipeline(transaction=False)
+        for _, new in renames:
+            pipe.exists(new)
+        taken = sum(1 for exists in pipe.execute() if exists) if renames else 0
+        stats["conflicts"] += taken
+        stats["renamed"] += len(renames) - taken
+        stats["carts_converted"] += len(cart_phones)
+        return
+
+    if renames:
+        pipe = client.pipeline(transaction=False)
+        for old, new in renames:
+            pipe.renamenx(old, new)
+        for (old, new), moved in zip(renames, pipe.execute(raise_on_error=False)):
+            if moved is True or moved == 1:
+                stats["renamed"] += 1
+            elif isinstance(moved, Exception):
+                # Chave expirou entre o SCAN e o RENAMENX
+                continue
+            else:
+                stats["conflicts"] += 1
+                logger.warning(f"⚠️ Conflito: {old} não migrada ({new} já existe)")
+
+    for phone in cart_phones:
+        try:
+            if migrate_cart_list(client, phone) >= 0:
+                stats["carts_converted"] += 1
+        except Exception as e:
+            logger.error(f"Erro ao converter carrinho de {phone}: {e}")
+
+
+def migrate_customer_state(batch_size: int = SCAN_BATCH_SIZE, dry_run: bool = False) -> Dict[str, int]:
+    """
+    Move as chaves address:, comprovante: e cooldown: para o hash cust:{phone}.
+    Retorna o resumo: scanned, moved, skipped, seconds.
+    """
+    client = get_redis_client()
+    if client is None:
+        logger.error("❌ Redis indisponível: migração não executada")
+        return {}
+
+    native = customer_state.field_ttl_supported(client)
+    stats = {"scanned": 0, "moved": 0, "skipped": 0}
+    start = time.monotonic()
+
+    for field in customer_state.CUSTOMER_FIELDS:
+        batch: List[str] = []
+        for key in client.scan_iter(match=f"{field}:*", count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                _fold_batch(client, field, batch, native, stats, dry_run)
+                batch = []
+        if batch:
+            _fold_batch(client, field, batch, native, stats, dry_run)
+        logger.info(f"⏳ {field}: scanned={stats['scanned']} moved={stats['moved']} skipped={stats['skipped']}")
+
+    stats["seconds"] = round(time.monotonic() - start, 2)
+    logger.info(f"📊 Migração para cust:{{phone}} {'(dry-run) ' if dry_run else ''}concluída: {stats}")
+    return stats
+
+
+def _fold_batch(client, field: str, keys: List[str], native: bool, stats: Dict[str, int], dry_run: bool) -> None:
+    stats["scanned"] += len(keys)
+    phones = [normalize_phone(key.partition(":")[2]) for key in keys]
+
+    pipe = client.pipeline(transaction=False)
+    for key, phone in zip(keys, phones):
+        pipe.get(key)
+        pipe.ttl(key)
+        pipe.hexists(customer_state.customer_key(phone), field)
+    results = pipe.execute(raise_on_error=False)
+
+    script = registered_script(client, "customer:set", customer_state.SET_FIELD_SCRIPT)
+    pipe = client.pipeline(transaction=False)
+    for i, (key, phone) in enumerate(zip(keys, phones)):
+        value, ttl, exists = results[3 * i:3 * i + 3]
+        if value is None or isinstance(value, Exception) or exists is True or ttl == -2:
+            # Expirou no meio do caminho, não é string ou o hash já tem valor mais novo
+            stats["skipped"] += 1
+            continue
+        stats["moved"] += 1
+        if dry_run:
+            continue
+        args = customer_state.set_field_args(field, value, ttl if ttl > 0 else 0, native)
+        script(keys=[customer_state.customer_key(phone)], args=args, client=pipe)
+        pipe.delete(key)
+    if not dry_run:
+        pipe.execute()
+
+
+if __name__ == "__main__":
+    batch = SCAN_BATCH_SIZE
+    if "--batch" in sys.argv:
+        batch = int(sys.argv[sys.argv.index("--batch") + 1])
+    if "--customer-hash" in sys.argv:
+        result = migrate_customer_state(batch_size=batch, dry_run="--dry-run" in sys.argv)
+        sys.exit(0 if result else 1)
+    result = migrate_phone_keys(batch_size=batch, dry_run="--dry-run" in sys.argv)
+    sys.exit(0 if result else 1)
@@ -8,7 +8,7 @@ root_dir = Path(__file__).resolve().parent.parent
 sys.path.append(str(root_dir))
 
 from tools.vector_search_subagent import run_vector_search_subagent
-from tools.http_tools import estoque_preco
+from tools.http_tools import estoque_preco_many
 
 def _extract_eans(vector_output: str) -> list[str]:
     if not vector_output:
@@ -41,24 +41,24 @@ def main():
         print("❌ Nenhum EAN extraído do banco_vetorial.")
         sys.exit(2)
 
-    ean = eans[0]
-    print(f"🧾 Testando estoque_preco com primeiro EAN: {ean}")
-    stock_raw = estoque_preco(ean)
-    print("=== estoque_preco (raw) ===")
-    print(stock_raw)
-    print("")
+    print(f"🧾 Testando estoque_preco_many com {len(eans)} EAN(s) extraídos")
+    results = estoque_preco_many(eans)
+    for ean, stock_raw in results.items():
+        print(f"=== estoque_preco {ean} (raw) ===")
+        print(stock_raw)
+        print("")
 
-    try:
-        data = json.loads(stock_raw)
-        if isinstance(data, list) and data:
-            item = data[0]
-            nome = item.get("produto") or item.get("nome") or ""
-            preco = item.get("preco")
-            print(f"✅ OK: {nome} | preco={preco}")
-        else:
-            print("⚠️ estoque_preco retornou lista vazia (sem disponibilidade).")
-    except Exception:
-        print("⚠️ estoque_preco não retornou JSON parseável (provável erro/instabilidade).")
+        try:
+            data = json.loads(stock_raw)
+            if isinstance(data, list) and data:
+                item = data[0]
+                nome = item.get("produto") or item.get("nome") or ""
+                preco = item.get("preco")
+                print(f"✅ OK: {nome} | preco={preco}")
+            else:
+                print("⚠️ estoque_preco retornou lista vazia (sem disponibilidade).")
+        except Exception:
+            print("⚠️ estoque_preco não retornou JSON parseável (provável erro/instabilidade).")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,98 @@
+"""
+Confere, no Redis configurado, o ciclo da sessão de um pedido já enviado:
+
+1. item adicionado depois do checkout fica no MESMO pedido (status continua
+   "sent" e a alteração é agendada no order_sync), em vez de abrir uma nova
+   sessão com o carrinho antigo (que viraria um pedido duplicado)
+2. mensagem sem saudação com o pedido enviado -> contexto "sent"
+3. saudação com o pedido enviado -> sessão nova ("restarted") e carrinho vazio
+4. item adicionado depois da saudação -> pedido novo em "building"
+
+Usa um telefone de teste; as chaves são removidas no fim. O flush do
+order_sync fica adiado (nenhuma chamada ao dashboard).
+
+Uso: python scripts/verify_sent_order_flow.py
+"""
+import json
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from config.settings import settings
+from tools import order_sync
+from tools.redis_tools import (
+    add_item_to_cart,
+    get_cart_items,
+    get_order_context,
+    get_order_session,
+    get_redis_client,
+    mark_order_sent,
+    start_order_session,
+)
+
+PHONE = "5500000000001"
+
+
+def _item(nome: str) -> str:
+    return json.dumps({"produto": nome, "quantidade": 1, "preco": 5.0}, ensure_ascii=False)
+
+
+def _check(label: str, ok: bool, failures: list) -> None:
+    print(f"  {'✅' if ok else '❌'} {label}")
+    if not ok:
+        failures.append(label)
+
+
+def _cleanup(client) -> None:
+    keys = [k for k in client.scan_iter(match=f"*{PHONE}*")]
+    if keys:
+        client.delete(*keys)
+    client.zrem(order_sync.DUE_KEY, PHONE)
+
+
+def main():
+    client = get_redis_client()
+    if client is None:
+        print("❌ Redis indisponível (REDIS_HOST/REDIS_PORT)")
+        sys.exit(1)
+    # Flush bem depois do fim do script: nada vai para o dashboard
+    settings.order_sync_quiet_ms = 10 * 60 * 1000
+    failures = []
+    _cleanup(client)
+    try:
+        start_order_session(PHONE)
+        add_item_to_cart(PHONE, _item("Arroz"))
+        mark_order_sent(PHONE, "verify")
+
+        print("1. Adição depois do checkout")
+        add_item_to_cart(PHONE, _item("Feijao"))
+        session = get_order_session(PHONE) or {}
+        _check("sessão continua 'sent'", session.get("status") == "sent", failures)
+        _check("carrinho tem os 2 itens", len(get_cart_items(PHONE)) == 2, failures)
+        if settings.order_outbox_enabled:
+            _check("sync agendado em order_sync:due", client.zscore(order_sync.DUE_KEY, PHONE) is not None, failures)
+
+        print("2. Mensagem sem saudação")
+        get_order_context(PHONE, "quero mais um refrigerante")
+        _check("contexto mantém 'sent'", (get_order_session(PHONE) or {}).get("status") == "sent", failures)
+
+        print("3. Saudação reinicia o pedido")
+        get_order_context(PHONE, "oi, bom dia")
+        _check("sessão nova em 'building'", (get_order_session(PHONE) or {}).get("status") == "building", failures)
+        _check("carrinho vazio", get_cart_items(PHONE) == [], failures)
+
+        print("4. Adição depois da saudação")
+        add_item_to_cart(PHONE, _item("Cafe"))
+        _check("pedido novo em 'building' com 1 item",
+               (get_order_session(PHONE) or {}).get("status") == "building" and len(get_cart_items(PHONE)) == 1,
+               failures)
+    finally:
+        _cleanup(client)
+
+    print(f"\n{'✅ Tudo certo' if not failures else f'❌ {len(failures)} falha(s)'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
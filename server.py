@@ -4,7 +4,7 @@ Suporta: Texto, Áudio (Transcrição), Imagem (Visão) e PDF (Extração de Tex
 Versão: 1.6.0 (Correção de LID e Buffer Personalizado)
 """
 from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, FileResponse
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any
 import requests
@@ -14,12 +14,15 @@ import random
 import threading
 import re
 import io
+import os
 import asyncio
+import hmac
 from arq import create_pool
 from arq.connections import RedisSettings
 from urllib.parse import urlparse
 from apscheduler.schedulers.background import BackgroundScheduler
 from scripts.populate_products_db import sync_products_db
+from scripts.memoria_partitions import maintain_memoria_partitions
 
 # Tenta importar pypdf para leitura de comprovantes
 try:
@@ -32,20 +35,27 @@ from config.logger import setup_logger
 from agent_multiagent import run_agent_langgraph as run_agent, get_session_history
 from tools.whatsapp_api import whatsapp
 from tools.redis_tools import (
-    push_message_to_buffer,
     get_buffer_length,
     pop_all_messages,
-    set_agent_cooldown,
-    is_agent_in_cooldown,
     get_order_session,
     start_order_session,
     refresh_session_ttl,
     get_order_context,
-    clear_cart,
+    get_redis_client,
+    lock_contention_top,
 )
+from tools import redis_async
+from tools import metrics
+from tools import blob_store
+from tools import phone_jobs
+from tools import outbound
+from tools import image_cache
+from tools.circuit_breaker import get_breaker
 
 logger = setup_logger(__name__)
 
+GEMINI_SERVICE = "gemini"  # Circuit breaker da transcrição/visão (tools/circuit_breaker.py)
+
 app = FastAPI(title="Agente de Supermercado", version="1.7.0")  # Queue-based version
 
 # ARQ Queue Pool (inicializado no startup)
@@ -161,11 +171,16 @@ def transcribe_audio(message_id: str = None, base64_data: str = None, mimetype:
         logger.error("❌ Não foi possível obter o áudio nem do webhook nem da API")
         return None
     
+    gemini = get_breaker(GEMINI_SERVICE)
     try:
         if not settings.google_api_key:
             logger.error("❌ GOOGLE_API_KEY não configurada no .env! Necessária para transcrição de áudio.")
             return None
 
+        if not gemini.allow():
+            logger.warning("⚡ Circuit Breaker ABERTO para Gemini. Transcrição pulada.")
+            return None
+
         logger.info(f"🎧 Transcrevendo áudio com Gemini ({mime_type_clean})")
         
         from google import genai
@@ -201,6 +216,7 @@ def transcribe_audio(message_id: str = None, base64_data: str = None, mimetype:
                     audio_file
                 ]
             )
+            gemini.record_success()
             
             transcription = response.text.strip() if response.text else None
             
@@ -219,6 +235,7 @@ def transcribe_audio(message_id: str = None, base64_data: str = None, mimetype:
                 pass
             
     except Exception as e:
+        gemini.record_failure()
         logger.error(f"Erro transcrição Gemini: {e}")
         return None
 
@@ -263,8 +280,16 @@ def analyze_image(message_id: Optional[str], url: Optional[str] = None) -> Optio
             tmp.write(image_bytes)
             file_path = tmp.name
 
-        client = genai.Client(api_key=settings.google_api_key)
-        image_file = client.files.upload(file=file_path, config={"mime_type": mime_type_clean or "image/jpeg"})
+        gemini = get_breaker(GEMINI_SERVICE)
+        if not gemini.allow():
+            logger.warning("⚡ Circuit Breaker ABERTO para Gemini. Análise de imagem pulada.")
+            return None
+        try:
+            client = genai.Client(api_key=settings.google_api_key)
+            image_file = client.files.upload(file=file_path, config={"mime_type": mime_type_clean or "image/jpeg"})
+        except Exception:
+            gemini.record_failure()
+            raise
 
         prompt = (
             "Analise cuidadosamente esta imagem. Identifique o que ela contém:\\n\\n"
@@ -280,6 +305,7 @@ def analyze_image(message_id: Optional[str], url: Optional[str] = None) -> Optio
         for model in model_candidates:
             try:
                 response = client.models.generate_content(model=model, contents=[prompt, image_file])
+                gemini.record_success()
                 txt = (response.text or "").strip()
                 if txt:
                     return txt[:800]
@@ -287,6 +313,7 @@ def analyze_image(message_id: Optional[str], url: Optional[str] = None) -> Optio
                 last_err = e
 
         if last_err:
+            gemini.record_failure()
             logger.error(f"Erro visão Gemini: {last_err}")
         return None
 
@@ -329,8 +356,16 @@ def _analyze_image_from_base64(base64_data: str, mimetype: str = None) -> Option
             tmp.write(image_bytes)
             file_path = tmp.name
         
-        client = genai.Client(api_key=settings.google_api_key)
-        image_file = client.files.upload(file=file_path, config={"mime_type": mime_type_clean})
+        gemini = get_breaker(GEMINI_SERVICE)
+        if not gemini.allow():
+            logger.warning("⚡ Circuit Breaker ABERTO para Gemini. Análise de imagem pulada.")
+            return None
+        try:
+            client = genai.Client(api_key=settings.google_api_key)
+            image_file = client.files.upload(file=file_path, config={"mime_type": mime_type_clean})
+        except Exception:
+            gemini.record_failure()
+            raise
         
         prompt = (
             "Analise cuidadosamente esta imagem. Identifique o que ela contém:\\n\\n"
@@ -342,7 +377,12 @@ def _analyze_image_from_base64(base64_data: str, mimetype: str = None) -> Option
         )
         
         model = settings.llm_model or "gemini-2.0-flash-lite"
-        response = client.models.generate_content(model=model, contents=[prompt, image_file])
+        try:
+            response = client.models.generate_content(model=model, contents=[prompt, image_file])
+        except Exception:
+            gemini.record_failure()
+            raise
+        gemini.record_success()
         txt = (response.text or "").strip()
         
         if txt:
@@ -686,14 +726,13 @@ def _extract_incoming(payload: Dict[str, Any]) -> Dict[str, Any]:
             base = caption.strip()
             mensagem_texto = f"{base}\\n[Análise da imagem]: {analysis}".strip() if base else f"[Análise da imagem]: {analysis}"
             
-            # AUTO-SAVE: Se for comprovante de pagamento, salvar Base64 no Redis automaticamente
+            # AUTO-SAVE: Se for comprovante de pagamento, salvar no blob store (Redis guarda só a referência)
             if "COMPROVANTE" in analysis.upper() and media_base64:
                 from tools.redis_tools import set_comprovante
-                # Salvar o Base64 com prefixo data:image para o painel converter
                 mime = media_mimetype or "image/jpeg"
-                data_uri = f"data:{mime};base64,{media_base64}"
-                set_comprovante(telefone, data_uri)
-                logger.info(f"🧾 Comprovante Base64 salvo automaticamente para {telefone}")
+                ref = blob_store.put_base64(media_base64, mime) or f"data:{mime};base64,{media_base64}"
+                set_comprovante(telefone, ref)
+                logger.info(f"🧾 Comprovante salvo automaticamente para {telefone}")
         else:
             mensagem_texto = caption.strip() if caption else "[Imagem recebida]"
 
@@ -739,9 +778,9 @@ def _extract_incoming(payload: Dict[str, Any]) -> Dict[str, Any]:
         if pdf_b64:
             from tools.redis_tools import set_comprovante
             mime = media_mimetype or "application/pdf"
-            # O painel/backend precisa saber lidar com data URI de PDF
-            data_uri = f"data:{mime};base64,{pdf_b64}"
-            set_comprovante(telefone, data_uri)
+            # Blob em disco; data URI só se o disco falhar (o painel recebe URL ou data URI no envio)
+            ref = blob_store.put_base64(pdf_b64, mime) or f"data:{mime};base64,{pdf_b64}"
+            set_comprovante(telefone, ref)
             logger.info(f"🧾 PDF Comprovante salvo automaticamente para {telefone} (Size: {len(pdf_b64)})")
             
             # Avisar no texto que foi salvo
@@ -846,14 +885,13 @@ def process_async(tel, msg, mid=None):
         num = re.sub(r"\\D", "", tel)
         
         # 1. Simular "Lendo" (Delay Humano)
-        tempo_leitura = random.uniform(2.0, 4.0) 
-        time.sleep(tempo_leitura)
+        time.sleep(outbound.human_delay(2.0, 4.0))
 
         # 2. Marcar como LIDO (Azul) AGORA
         # Usa o telefone (chat_id) E o message_id para marcar como lido
         logger.info(f"👀 Marcando chat {tel} como lido... (mid={mid})")
         whatsapp.mark_as_read(tel, message_id=mid)
-        time.sleep(0.8) # Delay tático: Garante que o usuário veja o AZUL antes de ver o "Digitando..."
+        time.sleep(outbound.human_delay(0.8)) # Delay tático: Garante que o usuário veja o AZUL antes de ver o "Digitando..."
 
         # 3. Começar a "Digitar"
         send_presence(num, "composing")
@@ -864,57 +902,12 @@ def process_async(tel, msg, mid=None):
         
         # 5. Parar "Digitar"
         send_presence(num, "paused")
-        time.sleep(0.5) # Pausa dramática antes de chegar
+        time.sleep(outbound.human_delay(0.5)) # Pausa dramática antes de chegar
 
         # 6. Enviar Mensagem (Inteligente: Texto ou Imagem)
-        # Regex para encontrar todas as URLs de imagem (jpg, png, jpeg, webp)
-        # OTIMIZADO: Evita pontuação final (.,;!) e captura múltiplos
-        regex = r'(https?://[^\s]+\.(?:jpg|jpeg|png|webp))'
-        urls_encontradas = re.findall(regex, txt, re.IGNORECASE)
-        
-        if urls_encontradas:
-            # Texto limpo: remove todos os links para não ficar redundante no WhatsApp
-            texto_limpo = txt
-            for url in urls_encontradas:
-                # Substitui links seguidos opcionalmente por quebras de linha/espaços
-                texto_limpo = re.sub(re.escape(url) + r'[\\s\\n]*', '', texto_limpo).strip()
-            
-            logger.info(f"📸 Detectadas {len(urls_encontradas)} URLs de imagem. Texto limpo: {texto_limpo[:50]}...")
-            
-            # 1. Enviar primeiro o TEXTO como mensagem separada (se houver texto)
-            if texto_limpo:
-                whatsapp.send_text(tel, texto_limpo)
-                # Pequeno delay térmico antes das fotos
-                time.sleep(1.0)
-            
-            # 2. Enviar cada imagem
-            for i, image_url in enumerate(urls_encontradas):
-                logger.info(f"📸 Processando imagem [{i+1}/{len(urls_encontradas)}]: {image_url}")
-                logger.info(f"⬇️ Baixando imagem para enviar como arquivo...")
-                
-                try:
-                    # Baixar imagem para memória
-                    import base64
-                    img_resp = requests.get(image_url, timeout=15)
-                    img_resp.raise_for_status()
-                    
-                    # Converter para Base64
-                    img_b64 = base64.b64encode(img_resp.content).decode('utf-8')
-                    mime = img_resp.headers.get("Content-Type", "image/jpeg")
-                    
-                    # Enviar como mídia (sem caption agora)
-                    whatsapp.send_media(tel, caption="", base64_data=img_b64, mimetype=mime)
-                    
-                    # Pequeno delay entre imagens
-                    if i < len(urls_encontradas) - 1:
-                        time.sleep(1.2)
-                        
-                except Exception as e:
-                    logger.error(f"❌ Erro ao baixar/enviar imagem {image_url}: {e}")
-                    # Fallback: Tentar enviar via URL
-                    whatsapp.send_media(tel, media_url=image_url, caption="")
-        else:
-            send_whatsapp_message(tel, txt)
+        # Fallback sem worker: envia daqui mesmo (o despachante roda no worker), com as
+        # imagens baixadas em paralelo pela Session compartilhada
+        outbound.deliver_reply_sync(whatsapp, tel, outbound.build_reply_parts(txt, max_len=2000))
 
     except Exception as e:
         logger.error(f"Erro async: {e}")
@@ -977,6 +970,28 @@ def buffer_loop(tel):
     finally: 
         buffer_sessions.pop(re.sub(r"\\D","",tel), None)
 
+# --- Scheduler ---
+def _sync_products_and_prewarm():
+    """Sincroniza o catálogo e pré-aquece o cache com as imagens mais pedidas."""
+    sync_products_db()
+    image_cache.prewarm()
+
+def _start_scheduler():
+    """Agenda os jobs periódicos (sincronização de produtos e partições da memória)."""
+    if scheduler.running:
+        return
+    # Sincronização de Produtos (1x por hora)
+    scheduler.add_job(_sync_products_and_prewarm, 'interval', hours=1, id='sync_products_job')
+    # Partições mensais da memória: criar futuras, arquivar antigas, aplicar retenção (1x por dia, madrugada)
+    scheduler.add_job(maintain_memoria_partitions, 'cron', hour=3, minute=30, id='memoria_partitions_job')
+    # GC dos comprovantes em disco cujo metadado expirou no Redis (1x por hora)
+    scheduler.add_job(blob_store.gc_blobs, 'interval', hours=1, id='blob_gc_job')
+    scheduler.start()
+    # Rodar uma vez logo no início (em thread separada para não bloquear startup)
+    threading.Thread(target=_sync_products_and_prewarm, daemon=True).start()
+    threading.Thread(target=maintain_memoria_partitions, daemon=True).start()
+    logger.info("⏰ Scheduler iniciado: produtos e GC de comprovantes a cada 1 hora, partições da memória diariamente às 03:30.")
+
 # --- ARQ Pool Lifecycle ---
 @app.on_event("startup")
 async def startup_event():
@@ -995,14 +1010,7 @@ async def startup_event():
         )
         logger.info("✅ ARQ Pool inicializado com sucesso")
         
-        # Iniciar Scheduler de Sincronização de Produtos (1x por hora)
-        if not scheduler.running:
-            scheduler.add_job(sync_products_db, 'interval', hours=1, id='sync_products_job')
-            scheduler.start()
-            # Rodar uma vez logo no início (em thread separada para não bloquear startup)
-            threading.Thread(target=sync_products_db, daemon=True).start()
-            logger.info("⏰ Scheduler iniciado: Sincronização de produtos agendada para cada 1 hora.")
-        
+        _start_scheduler()
         return
     arq_pool = await create_pool(
         RedisSettings(
@@ -1014,13 +1022,7 @@ async def startup_event():
     )
     logger.info("✅ ARQ Pool inicializado com sucesso")
 
-    # Iniciar Scheduler de Sincronização de Produtos (1x por hora)
-    if not scheduler.running:
-        scheduler.add_job(sync_products_db, 'interval', hours=1, id='sync_products_job')
-        scheduler.start()
-        # Rodar uma vez logo no início (em thread separada para não bloquear startup)
-        threading.Thread(target=sync_products_db, daemon=True).start()
-        logger.info("⏰ Scheduler iniciado: Sincronização de produtos agendada para cada 1 hora.")
+    _start_scheduler()
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -1030,6 +1032,8 @@ async def shutdown_event():
         logger.info("🔄 Fechando ARQ Pool...")
         await arq_pool.close()
         logger.info("✅ ARQ Pool fechado")
+
+    await redis_async.close_async_redis()
     
     if scheduler.running:
         logger.info("🔄 Fechando Scheduler...")
@@ -1037,34 +1041,47 @@ async def shutdown_event():
         logger.info("✅ Scheduler fechado")
 
 # --- ARQ Enqueue Helpers ---
-async def _enqueue_process_job(telefone: str, mensagem: str, message_id: str = None):
+async def _enqueue_process_job(telefone: str, mensagem: str, message_id: str = None, context: str = ""):
     """
     Enfileira job de processamento de mensagem no ARQ.
+
+    Com worker_phone_serialization, só há um job por telefone na fila/executando:
+    se já houver, a mensagem é estacionada (phone_jobs) e entra nesse job ou no
+    próximo, encadeado pelo worker — sem ocupar outro slot.
     
     Args:
         telefone: Número do cliente
         mensagem: Texto da mensagem
         message_id: ID da mensagem (opcional)
+        context: Contexto de sessão ([SESSÃO]) prefixado só se o job for criado agora
     """
     global arq_pool
+    texto_job = f"{context}\n\n{mensagem}" if context else mensagem
     if not arq_pool:
         logger.error("❌ ARQ Pool não inicializado! Usando fallback síncrono.")
         # Fallback: processar síncrono (não ideal mas evita crash)
-        process_async(telefone, mensagem, message_id)
+        process_async(telefone, texto_job, message_id)
+        return
+
+    if settings.worker_phone_serialization and not await phone_jobs.claim_or_park(telefone, mensagem, message_id):
         return
     
     try:
         job = await arq_pool.enqueue_job(
             "process_message",  # Nome da função no worker.py
             telefone,
-            mensagem,
+            texto_job,
             message_id,
         )
         logger.info(f"🎉 Job enfileirado: {job.job_id} | Cliente: {telefone}")
     except Exception as e:
         logger.error(f"❌ Erro ao enfileirar job: {e}")
-        # Fallback para não perder mensagem
-        process_async(telefone, mensagem, message_id)
+        # Fallback para não perder mensagem (incluindo as que estacionaram nesse meio tempo)
+        extra = await phone_jobs.finish_job(telefone) if settings.worker_phone_serialization else None
+        if extra:
+            texto_job = " | ".join(t for t in (texto_job, extra[0]) if t)
+            message_id = phone_jobs.as_mid_list(message_id) + extra[1]
+        process_async(telefone, texto_job, message_id)
 
 async def _enqueue_buffer_job(telefone: str):
     """
@@ -1078,7 +1095,7 @@ async def _enqueue_buffer_job(telefone: str):
         n = re.sub(r"\\D","",telefone)
         
         while True:
-            prev = get_buffer_length(n)
+            prev = await redis_async.get_buffer_length(n)
             if prev == 0:
                 break
             
@@ -1086,26 +1103,24 @@ async def _enqueue_buffer_job(telefone: str):
             # Esperar por mais mensagens (3 ciclos de 5s)
             while stall < 3:
                 await asyncio.sleep(5)
-                curr = get_buffer_length(n)
+                curr = await redis_async.get_buffer_length(n)
                 if curr > prev: 
                     prev, stall = curr, 0
                 else: 
                     stall += 1
             
             # Consumir mensagens do buffer
-            msgs, mids = pop_all_messages(n)
+            msgs, mids = await redis_async.pop_all_messages(n)
             final = " | ".join([m for m in msgs if m.strip()])
             
             if not final:
                 break
             
             # Obter contexto de sessão
-            order_ctx = get_order_context(n, final)
-            if order_ctx:
-                final = f"{order_ctx}\n\n{final}"
+            order_ctx = await redis_async.get_order_context(n, final)
             
             # MUDANÇA: Enfileirar job com LISTA de IDs
-            await _enqueue_process_job(n, final, mids)
+            await _enqueue_process_job(n, final, mids, context=order_ctx)
             
     except Exception as e:
         logger.error(f"Erro no buffer_loop async: {e}")
@@ -1119,6 +1134,43 @@ async def root(): return {"status":"online", "ver":"1.7.0", "queue":"enabled"}
 @app.get("/health")
 async def health(): return {"status":"healthy", "ts":datetime.now().isoformat()}
 
+def _bare_token(value: Optional[str]) -> str:
+    value = (value or "").strip()
+    return value[7:].strip() if value.lower().startswith("bearer ") else value
+
+def _require_dashboard_token(request: Request) -> None:
+    """401 se o header Authorization não trouxer o token do dashboard (com ou sem "Bearer")."""
+    expected = _bare_token(settings.supermercado_auth_token)
+    given = _bare_token(request.headers.get("authorization"))
+    if not expected or not hmac.compare_digest(given.encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail="Token inválido")
+
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    """Métricas do server (pool Redis, tempos) + snapshots publicados pelos workers. Exige o token do dashboard."""
+    _require_dashboard_token(request)
+    published = await asyncio.to_thread(metrics.collect_published, get_redis_client())
+    contention = await asyncio.to_thread(lock_contention_top, "agent")
+    return {"server": metrics.snapshot(), "workers": published, "lock_contention_24h": dict(contention)}
+
+@app.get("/blobs/{sha}")
+async def get_blob(sha: str, request: Request, exp: int = 0, sig: str = ""):
+    """
+    Comprovante salvo no blob store (o nome é o SHA-256 do conteúdo).
+    Exige a assinatura da URL gerada por blob_store.blob_url() ou o token do dashboard.
+    """
+    sha = blob_store.ref_sha(sha.lower())
+    if not sha:
+        raise HTTPException(status_code=404)
+    if not blob_store.verify_blob_signature(sha, exp, sig):
+        _require_dashboard_token(request)
+    path = blob_store.blob_path(sha)
+    meta = await asyncio.to_thread(blob_store.get_meta, sha)
+    if not meta or not await asyncio.to_thread(os.path.exists, path):
+        raise HTTPException(status_code=404)
+    return FileResponse(path, media_type=meta.get("mime") or "application/octet-stream",
+                        headers={"Cache-Control": "private, max-age=86400, immutable"})
+
 @app.get("/graph")
 async def graph():
     """
@@ -1329,11 +1381,11 @@ async def webhook(req: Request, tasks: BackgroundTasks):
                 if tel_clean and tel_clean != agent_clean:
                     # Ativar cooldown - IA pausa por X minutos
                     ttl = settings.human_takeover_ttl  # Default: 900s (15min)
-                    set_agent_cooldown(tel_clean, ttl)
-                    clear_cart(tel_clean)  # Limpa o carrinho/sessão ao assumir
+                    await redis_async.set_agent_cooldown(tel_clean, ttl)
+                    await redis_async.clear_cart(tel_clean)  # Limpa o carrinho/sessão ao assumir
                     logger.info(f"🙋 Human Takeover ativado para {tel_clean} - IA pausa por {ttl//60}min - Carrinho limpo")
             
-            try: get_session_history(tel).add_ai_message(txt)
+            try: await asyncio.to_thread(lambda: get_session_history(tel).add_ai_message(txt))
             except: pass
             return JSONResponse(content={"status":"ignored_self"})
 
@@ -1342,13 +1394,13 @@ async def webhook(req: Request, tasks: BackgroundTasks):
         # NOTA: 'send_presence' imediato removido para evitar comportamento robótico.
         # O cliente verá 'digitando' apenas após o buffer, no process_async.
 
-        active, _ = is_agent_in_cooldown(num)
+        active, _ = await redis_async.is_agent_in_cooldown(num)
         if active:
             # push_message_to_buffer(num, txt, message_id=msg_id) -> REMOVED to ignore messages during pause
             # SALVAR MENSAGEM DO CLIENTE NO HISTÓRICO mesmo durante cooldown
             try:
                 from langchain_core.messages import HumanMessage
-                get_session_history(tel).add_message(HumanMessage(content=txt))
+                await asyncio.to_thread(lambda: get_session_history(tel).add_message(HumanMessage(content=txt)))
                 logger.info(f"📝 Mensagem do cliente salva no histórico (cooldown ativo)")
             except Exception as e:
                 logger.warning(f"Erro ao salvar mensagem durante cooldown: {e}")
@@ -1359,7 +1411,7 @@ async def webhook(req: Request, tasks: BackgroundTasks):
                 presence_sessions[num] = True
         except: pass
 
-        if push_message_to_buffer(num, txt, message_id=msg_id):
+        if await redis_async.push_message_to_buffer(num, txt, message_id=msg_id):
             if not buffer_sessions.get(num):
                 buffer_sessions[num] = True
                 # MUDANÇA: Em vez de Thread, enfileira job ARQ
@@ -1,7 +1,7 @@
 """
 Módulo de ferramentas do Agente de Supermercado
 """
-from .http_tools import estoque, pedidos, alterar, estoque_preco
+from .http_tools import estoque, pedidos, alterar, estoque_preco, estoque_preco_many
 from .redis_tools import push_message_to_buffer, get_buffer_length, pop_all_messages, set_agent_cooldown, is_agent_in_cooldown
 from .time_tool import get_current_time
 
@@ -15,5 +15,6 @@ __all__ = [
     'set_agent_cooldown',
     'is_agent_in_cooldown',
     'get_current_time',
-    'estoque_preco'
+    'estoque_preco',
+    'estoque_preco_many'
 ]
@@ -0,0 +1,230 @@
+"""
+Armazenamento de comprovantes (imagens/PDFs) em disco, endereçado por SHA-256
+
+- O arquivo é gravado uma única vez em {blob_store_dir}/{sha[:2]}/{sha}
+  (escrita atômica: arquivo temporário + os.replace); o mesmo conteúdo
+  enviado de novo não é regravado (deduplicação)
+- No Redis ficam só a referência "blob:sha256:<hex>" (no lugar do data URI
+  em base64) e os metadados em blobmeta:<hex> (mime, tamanho), com TTL de
+  settings.blob_store_retention_hours renovado a cada envio
+- gc_blobs() (scheduler do server) apaga os arquivos cujo metadado expirou
+- Para o painel: URL GET /blobs/<hex>?exp=..&sig=.. quando
+  settings.blob_public_base_url está definido (assinada com HMAC e válida
+  pelo período de retenção; sem assinatura, só com o token do dashboard);
+  senão, data URI codificado direto do arquivo mapeado (mmap)
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import mmap
+import os
+import re
+import tempfile
+import time
+from typing import Dict, Optional
+
+from config.settings import settings
+from config.logger import setup_logger
+from tools import metrics
+
+logger = setup_logger(__name__)
+
+BLOB_REF_PREFIX = "blob:sha256:"
+_SHA_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def blob_meta_key(sha: str) -> str:
+    return f"blobmeta:{sha}"
+
+
+def blob_path(sha: str) -> str:
+    return os.path.join(settings.blob_store_dir, sha[:2], sha)
+
+
+def is_blob_ref(value: Optional[str]) -> bool:
+    return bool(value) and value.startswith(BLOB_REF_PREFIX)
+
+
+def ref_sha(value: str) -> Optional[str]:
+    sha = value[len(BLOB_REF_PREFIX):] if is_blob_ref(value) else value
+    return sha if _SHA_RE.match(sha or "") else None
+
+
+def _retention_seconds() -> int:
+    return max(1, int(settings.blob_store_retention_hours)) * 3600
+
+
+def put_blob(data: bytes, mime: str) -> Optional[str]:
+    """Grava o conteúdo (se ainda não existir) e retorna a referência blob:sha256:<hex>."""
+    from tools.redis_tools import get_redis_client
+
+    sha = hashlib.sha256(data).hexdigest()
+    path = blob_path(sha)
+    try:
+        if os.path.exists(path):
+            os.utime(path, None)
+            metrics.incr("blob.dedup_hits")
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+            metrics.incr("blob.bytes_written", len(data))
+    except OSError as e:
+        logger.error(f"Erro ao gravar blob {sha[:12]}: {e}")
+        return None
+
+    client = get_redis_client()
+    if client is not None:
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.hset(blob_meta_key(sha), mapping={"mime": mime, "size": len(data), "created": int(time.time())})
+            pipe.expire(blob_meta_key(sha), _retention_seconds())
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Erro ao gravar metadados do blob {sha[:12]}: {e}")
+    logger.info(f"🗄️ Blob {sha[:12]} salvo ({len(data)} B, {mime})")
+    return BLOB_REF_PREFIX + sha
+
+
+def put_base64(b64_data: str, mime: str) -> Optional[str]:
+    """Decodifica o base64 do webhook e grava como blob. None se o base64 for inválido."""
+    if "," in b64_data[:100] and b64_data.startswith("data:"):
+        b64_data = b64_data.split(",", 1)[1]
+    try:
+        data = base64.b64decode(b64_data)
+    except (binascii.Error, ValueError) as e:
+        logger.error(f"Base64 inválido para blob: {e}")
+        return None
+    return put_blob(data, mime)
+
+
+def get_meta(sha: str) -> Dict[str, str]:
+    from tools.redis_tools import get_redis_client
+
+    client = get_redis_client()
+    if client is None:
+        return {}
+    try:
+        return client.hgetall(blob_meta_key(sha)) or {}
+    except Exception as e:
+        logger.error(f"Erro ao ler metadados do blob {sha[:12]}: {e}")
+        return {}
+
+
+def _url_secret() -> bytes:
+    return (settings.blob_url_secret or settings.supermercado_auth_token or "").encode("utf-8")
+
+
+def sign_blob(sha: str, expires: int) -> str:
+    return hmac.new(_url_secret(), f"{sha}:{expires}".encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+
+def verify_blob_signature(sha: str, expires: int, sig: str) -> bool:
+    """Assinatura da URL confere e ainda não expirou."""
+    if not sig or not _url_secret() or expires < time.time():
+        return False
+    return hmac.compare_digest(sign_blob(sha, expires), sig)
+
+
+def blob_url(sha: str) -> Optional[str]:
+    """URL assinada, válida enquanto o blob existir (blob_store_retention_hours)."""
+    base = (settings.blob_public_base_url or "").rstrip("/")
+    if not base:
+        return None
+    expires = int(time.time()) + settings.blob_store_retention_hours * 3600
+    return f"{base}/blobs/{sha}?exp={expires}&sig={sign_blob(sha, expires)}"
+
+
+def to_data_uri(sha: str, mime: Optional[str] = None) -> Optional[str]:
+    """Codifica o arquivo em data URI lendo via mmap (sem cópia intermediária em bytes)."""
+    path = blob_path(sha)
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                encoded = ""
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    encoded = base64.b64encode(mm).decode("ascii")
+    except OSError as e:
+        logger.error(f"Blob {sha[:12]} indisponível: {e}")
+        return None
+    mime = mime or get_meta(sha).get("mime") or "application/octet-stream"
+    return f"data:{mime};base64,{encoded}"
+
+
+def resolve_comprovante(value: Optional[str]) -> Optional[str]:
+    """
+    Converte a referência salva no Redis no formato do painel:
+    URL pública (se configurada) ou data URI. Valores antigos (URL/data URI) passam direto.
+    """
+    if not is_blob_ref(value):
+        return value
+    sha = ref_sha(value)
+    if sha is None:
+        return None
+    return blob_url(sha) or to_data_uri(sha)
+
+
+def gc_blobs() -> Dict[str, int]:
+    """Apaga os blobs cujo metadado expirou no Redis (e os temporários esquecidos)."""
+    from tools.redis_tools import get_redis_client
+
+    stats = {"scanned": 0, "deleted": 0, "bytes_freed": 0}
+    root = settings.blob_store_dir
+    client = get_redis_client()
+    if client is None or not os.path.isdir(root):
+        return stats
+
+    # Arquivos recém-gravados ganham uma folga (metadado pode estar a caminho)
+    cutoff = time.time() - 600
+    for shard in os.listdir(root):
+        shard_dir = os.path.join(root, shard)
+        if not os.path.isdir(shard_dir):
+            continue
+        entries = []
+        for name in os.listdir(shard_dir):
+            path = os.path.join(shard_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_mtime > cutoff:
+                continue
+            if name.startswith(".tmp-"):
+                entries.append((name, path, st.st_size, False))
+            elif _SHA_RE.match(name):
+                entries.append((name, path, st.st_size, True))
+        if not entries:
+            continue
+        stats["scanned"] += len(entries)
+        try:
+            pipe = client.pipeline(transaction=False)
+            for name, _, _, is_blob in entries:
+                if is_blob:
+                    pipe.exists(blob_meta_key(name))
+            alive = iter(pipe.execute())
+        except Exception as e:
+            logger.error(f"Erro no GC de blobs: {e}")
+            return stats
+        for name, path, size, is_blob in entries:
+            if is_blob and next(alive):
+                continue
+            try:
+                os.unlink(path)
+                stats["deleted"] += 1
+                stats["bytes_freed"] += size
+            except OSError:
+                pass
+
+    metrics.incr("blob.gc_deleted", stats["deleted"])
+    metrics.incr("blob.gc_bytes_freed", stats["bytes_freed"])
+    logger.info(f"🧹 GC de blobs: {stats}")
+    return stats
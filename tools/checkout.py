@@ -0,0 +1,158 @@
+"""
+Montagem do payload do pedido no servidor (finalizar_pedido_tool)
+
+O LLM não precisa mais ecoar o carrinho inteiro em itens_json (tokens de
+saída são a parte mais lenta da geração e JSON grande quebra). As linhas do
+pedido vêm, nesta ordem:
+
+1. itens_json (override explícito, formato antigo)
+2. itens compactos "id:quantidade[:unidades][#observação]" separados por
+   vírgula ou ";" (decimal com ponto: "8812:1,5" é recusado quando "5" não é
+   um id das buscas), com o id da busca_produto_tool; nome e preço saem das
+   sugestões em cache (o mesmo resultado da busca), não do LLM. A
+   observação do item (ex: "bem passado") vai depois do #, sem vírgula
+3. o carrinho (cart:{phone}), quando o atendimento usa add_item_tool
+"""
+import json
+import re
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from config.logger import setup_logger
+from tools.redis_tools import get_cart_items, get_suggestions
+
+logger = setup_logger(__name__)
+
+_COMPACT_SEP = re.compile(r"[;\n]+")
+
+
+def parse_compact_items(spec: str, known_ids: Optional[Set[str]] = None) -> List[Tuple[str, float, int, str]]:
+    """
+    '8812:2, 9931:0.45:3#sem gordura' -> [("8812", 2.0, 0, ""), ("9931", 0.45, 3, "sem gordura")].
+    ValueError se mal formado. Com known_ids (ids que o modelo viu), um pedaço
+    sem ":" logo depois de uma quantidade ("8812:1,5") que não é um id conhecido
+    é tratado como decimal com vírgula e recusado, em vez de virar o item "5".
+    """
+    parsed = []
+    for segment in _COMPACT_SEP.split(spec or ""):
+        previous = None
+        for chunk in segment.split(","):
+            chunk, _, observacao = chunk.partition("#")
+            chunk = chunk.strip()
+            if not chunk:
+                previous = None
+                continue
+            parts = [p.strip() for p in chunk.split(":")]
+            if not parts[0] or len(parts) > 3:
+                raise ValueError(f"item '{chunk}' fora do formato id:quantidade[:unidades]")
+            if (len(parts) == 1 and previous is not None and len(previous) > 1 and parts[0].isdigit()
+                    and known_ids is not None and parts[0] not in known_ids):
+                raise ValueError(
+                    f"'{':'.join(previous)},{parts[0]}' tem decimal com vírgula; use ponto "
+                    f"(ex: {previous[0]}:{previous[1]}.{parts[0]})"
+                )
+            quantidade = float(parts[1]) if len(parts) > 1 and parts[1] else 1.0
+            unidades = int(float(parts[2])) if len(parts) > 2 and parts[2] else 0
+            # "0,45" partido na vírgula vira quantidade 0: decimal tem que ser com ponto
+            if quantidade <= 0:
+                raise ValueError(f"quantidade inválida em '{chunk}' (use ponto no decimal: 0.45)")
+            parsed.append((parts[0], quantidade, unidades, observacao.strip()))
+            previous = parts
+    return parsed
+
+
+def items_from_ids(telefone: str, spec: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Resolve os ids compactos contra as sugestões da busca (e, para os que já
+    saíram do cache, contra a tabela de produtos): (itens, ids não encontrados).
+    """
+    by_id = {str(s.get("id")): s for s in get_suggestions(telefone) if s.get("id") is not None}
+    parsed = parse_compact_items(spec, set(by_id))
+    unknown = [product_id for product_id, *_ in parsed if product_id not in by_id]
+    if unknown:
+        from tools.db_search import get_products_by_ids
+
+        by_id.update(get_products_by_ids(unknown))
+    items, missing = [], []
+    for product_id, quantidade, unidades, observacao in parsed:
+        sugestao = by_id.get(product_id)
+        if sugestao is None:
+            missing.append(product_id)
+            continue
+        items.append({
+            "produto": sugestao.get("nome", "Produto"),
+            "quantidade": quantidade,
+            "preco": float(sugestao.get("preco", 0.0) or 0.0),
+            "unidades": unidades,
+            "observacao": observacao,
+        })
+    return items, missing
+
+
+def resolve_order_items(telefone: str, itens: str = "", itens_json: str = "") -> Tuple[Optional[List[Dict]], str]:
+    """
+    Itens do pedido pela ordem de precedência do módulo.
+    Retorna (itens, origem) ou (None, mensagem de erro para o LLM).
+    """
+    if itens_json and itens_json.strip():
+        try:
+            items = json.loads(itens_json)
+        except Exception as e:
+            return None, f"❌ Erro ao ler os itens do pedido: erro de formato JSON - {e}. Corrija o JSON e tente novamente."
+        return (items if isinstance(items, list) else [items]), "itens_json"
+
+    if itens and itens.strip():
+        try:
+            items, missing = items_from_ids(telefone, itens)
+        except ValueError as e:
+            return None, f"❌ Erro ao ler os itens do pedido: {e}."
+        if missing:
+            return None, (
+                f"❌ Não encontrei os ids {', '.join(missing)} nas buscas recentes. "
+                f"Refaça a busca_produto_tool desses produtos e use o 'id' retornado."
+            )
+        return items, "ids"
+
+    return get_cart_items(telefone), "carrinho"
+
+
+def format_order_lines(items: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], float]:
+    """
+    Linhas no formato da API do dashboard + subtotal. Itens por peso (unidades > 0)
+    vão como N unidades com o preço rateado e o peso estimado na observação.
+    """
+    total = 0.0
+    itens_formatados = []
+
+    for item in items:
+        preco = float(item.get("preco", 0.0))
+        quantidade = float(item.get("quantidade", 1.0))
+        unidades = int(item.get("unidades", 0))
+        obs_item = item.get("observacao", "")
+        total += preco * quantidade
+
+        nome_produto = item.get("produto", item.get("nome_produto", "Produto"))
+
+        if unidades > 0:
+            qtd_api = unidades
+            valor_estimado = round(preco * quantidade, 2)
+            preco_unitario_api = round(valor_estimado / unidades, 2)
+            obs_peso = f"Peso estimado: {quantidade:.3f}kg (~R${valor_estimado:.2f}). PESAR para confirmar valor."
+            if obs_item:
+                obs_item = f"{obs_item}. {obs_peso}"
+            else:
+                obs_item = obs_peso
+        else:
+            if quantidade < 1 or quantidade != int(quantidade):
+                qtd_api = 1
+            else:
+                qtd_api = int(quantidade)
+            preco_unitario_api = round(preco, 2)
+
+        itens_formatados.append({
+            "nome_produto": nome_produto,
+            "quantidade": qtd_api,
+            "preco_unitario": preco_unitario_api,
+            "observacao": obs_item
+        })
+
+    return itens_formatados, total
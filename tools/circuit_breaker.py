@@ -0,0 +1,262 @@
+"""
+Circuit breaker (disjuntor) em memória do processo, sincronizado via Redis
+
+Antes, check_circuit_open/report_failure/report_success faziam 1-2 idas ao
+Redis (GET, INCR/EXPIRE, EXISTS/DEL) em TODA chamada, mesmo com o serviço
+saudável. Agora o estado vive no processo e o Redis só é usado nas
+transições:
+
+- closed:    chamadas liberadas; falhas contadas numa janela (window)
+- open:      bloqueia até o cooldown acabar
+- half_open: libera UMA chamada de teste; sucesso fecha, falha reabre
+
+Ao abrir/fechar, o processo grava circuit:open:{service} (TTL = cooldown,
+para quem subir depois) e publica no canal circuit:events; os outros
+processos (server/worker) assinam o canal e aplicam o disparo remoto.
+
+Uso (UAZAPI, dashboard, estoque, Gemini):
+    breaker = get_breaker("uazapi")
+    if not breaker.allow(): ...
+    breaker.record_success() / breaker.record_failure()
+
+Métricas: gauge circuit.{service}.state (0 fechado, 1 meio-aberto, 2 aberto)
+e contadores circuit.{service}.opened / .rejected.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from config.logger import setup_logger
+from tools import metrics
+
+logger = setup_logger(__name__)
+
+CHANNEL = "circuit:events"
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_ORIGIN = f"{socket.gethostname()}:{os.getpid()}"
+
+_breakers: Dict[str, "CircuitBreaker"] = {}
+_breakers_lock = threading.Lock()
+_publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="circuit-pub")
+_listener: Optional[threading.Thread] = None
+
+
+def circuit_open_key(service: str) -> str:
+    return f"circuit:open:{service}"
+
+
+class CircuitBreaker:
+    """Disjuntor de um serviço (thread-safe; sem I/O fora das transições)."""
+
+    def __init__(self, service: str, threshold: int = 15, window: float = 60, cooldown: float = 30):
+        self.service = service
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._failures = 0
+        self._window_start = 0.0
+        self._open_until = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """True = pode chamar o serviço. No meio-aberto, só uma chamada de teste por vez."""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and now >= self._open_until:
+                self.state = HALF_OPEN
+                self._probing = False
+                logger.info(f"⚡ Circuit Breaker {self.service}: meio-aberto (chamada de teste)")
+            # Teste sem resultado reportado por mais de um cooldown: libera outro
+            if self.state == HALF_OPEN and (not self._probing or now - self._probe_started > self.cooldown):
+                self._probing = True
+                self._probe_started = now
+                return True
+        metrics.incr(f"circuit.{self.service}.rejected")
+        return False
+
+    def is_open(self) -> bool:
+        """Consulta sem consumir a chamada de teste do meio-aberto."""
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() < self._open_until
+            return self.state == HALF_OPEN and self._probing
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            if self.state == CLOSED:
+                return
+            self.state = CLOSED
+            self._probing = False
+        logger.info(f"✅ Circuit Breaker {self.service}: fechado")
+        _publish(self.service, CLOSED, 0)
+
+    def record_failure(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN:
+                return
+            if self.state == CLOSED:
+                if now - self._window_start > self.window:
+                    self._window_start, self._failures = now, 0
+                self._failures += 1
+                if self._failures < self.threshold:
+                    return
+            failures = self._failures
+            probe_failed = self.state == HALF_OPEN
+            self._trip(now, self.cooldown)
+        if probe_failed:
+            logger.critical(
+                f"⚡⚡ CIRCUIT BREAKER REABERTO: {self.service} falhou na chamada de teste (meio-aberto). "
+                f"Pausando por {self.cooldown}s."
+            )
+        else:
+            logger.critical(
+                f"⚡⚡ CIRCUIT BREAKER DISPARADO: {self.service} falhou {failures}x. Pausando por {self.cooldown}s."
+            )
+        _publish(self.service, OPEN, self.cooldown)
+
+    def _trip(self, now: float, seconds: float) -> None:
+        self.state = OPEN
+        self._open_until = now + seconds
+        self._failures = 0
+        self._probing = False
+        metrics.incr(f"circuit.{self.service}.opened")
+
+    def apply_remote(self, state: str, seconds: float) -> None:
+        """Disparo/fechamento publicado por outro processo."""
+        with self._lock:
+            if state == OPEN:
+                self._trip(time.monotonic(), seconds)
+            elif state == CLOSED and self.state != CLOSED:
+                self.state, self._failures, self._probing = CLOSED, 0, False
+            else:
+                return
+        logger.info(f"📡 Circuit Breaker {self.service}: {state} (remoto)")
+
+
+def get_breaker(service: str, **kwargs) -> CircuitBreaker:
+    """
+    Disjuntor do serviço (singleton por processo). kwargs (threshold, window,
+    cooldown) valem só na criação. Na criação, herda um disparo ainda ativo
+    no Redis e garante a assinatura do canal de eventos.
+    """
+    breaker = _breakers.get(service)
+    if breaker is not None:
+        return breaker
+    with _breakers_lock:
+        breaker = _breakers.get(service)
+        if breaker is None:
+            breaker = _breakers[service] = CircuitBreaker(service, **kwargs)
+            _restore(breaker)
+            _ensure_listener()
+    return breaker
+
+
+def _restore(breaker: CircuitBreaker) -> None:
+    from tools.redis_tools import get_redis_client
+
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        ttl_ms = client.pttl(circuit_open_key(breaker.service))
+    except Exception as e:
+        logger.debug(f"Erro ao ler estado do circuit breaker {breaker.service}: {e}")
+        return
+    if ttl_ms and ttl_ms > 0:
+        breaker.apply_remote(OPEN, ttl_ms / 1000)
+
+
+def _publish(service: str, state: str, seconds: float) -> None:
+    """Grava/limpa circuit:open:{service} e avisa os outros processos (em background)."""
+    _publisher.submit(_publish_sync, service, state, seconds)
+
+
+def _publish_sync(service: str, state: str, seconds: float) -> None:
+    from tools.redis_tools import get_redis_client
+
+    client = get_redis_client()
+    if client is None:
+        return
+    event = json.dumps({"service": service, "state": state, "seconds": seconds, "origin": _ORIGIN})
+    try:
+        pipe = client.pipeline(transaction=False)
+        if state == OPEN:
+            pipe.set(circuit_open_key(service), "1", ex=max(1, int(seconds)))
+        else:
+            pipe.delete(circuit_open_key(service))
+        pipe.publish(CHANNEL, event)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Erro ao publicar circuit breaker {service}: {e}")
+
+
+def _handle_event(raw: str) -> None:
+    try:
+        event = json.loads(raw)
+    except (TypeError, ValueError):
+        return
+    if event.get("origin") == _ORIGIN:
+        return
+    breaker = _breakers.get(event.get("service"))
+    if breaker is not None:
+        breaker.apply_remote(event.get("state"), float(event.get("seconds") or 0))
+
+
+def _listen() -> None:
+    from tools.redis_tools import get_redis_client
+
+    while True:
+        client = get_redis_client()
+        if client is None:
+            # Processo subiu antes do Redis: continua tentando (o listener só é criado uma vez)
+            time.sleep(5)
+            continue
+        pubsub = None
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            # Disparos publicados enquanto estava sem assinatura
+            for breaker in list(_breakers.values()):
+                _restore(breaker)
+            while True:
+                # Timeout curto (< socket_timeout do pool) para a conexão não expirar
+                msg = pubsub.get_message(timeout=1.0)
+                if msg and msg.get("type") == "message":
+                    _handle_event(msg.get("data"))
+        except Exception as e:
+            logger.warning(f"⚠️ Assinatura de circuit:events caiu ({e}); reconectando em 5s")
+            time.sleep(5)
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+
+def _ensure_listener() -> None:
+    global _listener
+    if _listener is not None and _listener.is_alive():
+        return
+    _listener = threading.Thread(target=_listen, name="circuit-events", daemon=True)
+    _listener.start()
+
+
+def _breaker_metrics() -> Dict[str, float]:
+    return {f"circuit.{name}.state": STATE_CODES[b.state] for name, b in list(_breakers.items())}
+
+
+metrics.register_collector(_breaker_metrics)
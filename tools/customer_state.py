@@ -0,0 +1,223 @@
+"""
+Estado consolidado por cliente: um HASH cust:{tel} com os campos pequenos
+(endereço, comprovante e cooldown), cada um com TTL próprio. As sugestões
+têm hash próprio (suggestions:{tel}, um campo por produto).
+
+- Redis >= 7.4: TTL nativo por campo (HEXPIRE / HTTL)
+- Redis mais antigo: emulação — o campo "<campo>@exp" guarda o vencimento
+  (epoch ms), as leituras ignoram campos vencidos e o TTL da chave acompanha
+  o maior vencimento (a chave some sozinha quando tudo venceu)
+
+Ativado por settings.redis_customer_hash; as funções de tools/redis_tools.py
+e tools/redis_async.py mantêm as mesmas assinaturas (camada de compatibilidade).
+"""
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+CUSTOMER_FIELDS = ("address", "comprovante", "cooldown")
+EXP_SUFFIX = "@exp"
+
+_native_field_ttl: Optional[bool] = None
+
+# KEYS: cust:{tel}; ARGV: campo, valor, ttl (s, 0 = sem TTL), agora (ms), nativo (0/1)
+SET_FIELD_SCRIPT = """
+local key, field, ttl, native = KEYS[1], ARGV[1], tonumber(ARGV[3]), ARGV[5]
+local existed = redis.call('EXISTS', key)
+local pttl = redis.call('PTTL', key)
+redis.call('HSET', key, field, ARGV[2])
+if native == '1' then
+    if ttl > 0 then
+        redis.call('HEXPIRE', key, ttl, 'FIELDS', 1, field)
+    else
+        redis.call('HPERSIST', key, 'FIELDS', 1, field)
+    end
+    return 1
+end
+if ttl > 0 then
+    redis.call('HSET', key, field .. '@exp', tonumber(ARGV[4]) + ttl * 1000)
+    if existed == 0 or (pttl >= 0 and pttl < ttl * 1000) then
+        redis.call('PEXPIRE', key, ttl * 1000)
+    end
+else
+    redis.call('HDEL', key, field .. '@exp')
+    redis.call('PERSIST', key)
+end
+return 1
+"""
+
+
+def customer_key(telefone: str) -> str:
+    """Chave do hash de estado do cliente (telefone já normalizado)."""
+    return f"cust:{telefone}"
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _version_tuple(version: str) -> Tuple[int, ...]:
+    try:
+        return tuple(int(p) for p in str(version).split(".")[:2])
+    except ValueError:
+        return (0, 0)
+
+
+def _detected(info: Dict) -> bool:
+    global _native_field_ttl
+    version = (info or {}).get("redis_version", "0.0")
+    _native_field_ttl = _version_tuple(version) >= (7, 4)
+    logger.info(f"🧩 Estado por cliente: Redis {version} | TTL por campo {'nativo' if _native_field_ttl else 'emulado'}")
+    return _native_field_ttl
+
+
+def field_ttl_supported(client) -> bool:
+    """True se o servidor suporta TTL por campo de hash (Redis >= 7.4). Consultado uma vez por processo."""
+    if _native_field_ttl is None:
+        try:
+            return _detected(client.info("server"))
+        except Exception:
+            return False
+    return _native_field_ttl
+
+
+async def afield_ttl_supported(client) -> bool:
+    """Versão assíncrona de field_ttl_supported (compartilha o resultado)."""
+    if _native_field_ttl is None:
+        try:
+            return _detected(await client.info("server"))
+        except Exception:
+            return False
+    return _native_field_ttl
+
+
+def native_field_ttl() -> bool:
+    """Resultado já detectado por field_ttl_supported (False enquanto não detectado)."""
+    return bool(_native_field_ttl)
+
+
+def set_field_args(field: str, value: str, ttl_seconds: int, native: bool) -> List:
+    return [field, value, max(0, int(ttl_seconds or 0)), _now_ms(), "1" if native else "0"]
+
+
+def live_fields(raw: Dict[str, str], now_ms: Optional[int] = None) -> Dict[str, str]:
+    """Filtra o HGETALL: remove os campos de vencimento e os campos vencidos (emulação)."""
+    now_ms = now_ms or _now_ms()
+    out = {}
+    for field, value in (raw or {}).items():
+        if field.endswith(EXP_SUFFIX):
+            continue
+        exp = raw.get(field + EXP_SUFFIX)
+        if exp is not None and int(exp) <= now_ms:
+            continue
+        out[field] = value
+    return out
+
+
+def emulated_ttl(raw: Dict[str, str], field: str, now_ms: Optional[int] = None) -> int:
+    """TTL restante (s) de um campo na emulação; -1 sem TTL, -2 inexistente/vencido."""
+    if field not in (raw or {}):
+        return -2
+    exp = raw.get(field + EXP_SUFFIX)
+    if exp is None:
+        return -1
+    remaining = int(exp) - (now_ms or _now_ms())
+    return -2 if remaining <= 0 else (remaining + 999) // 1000
+
+
+def _native_ttl_reply(reply) -> int:
+    # HTTL retorna uma lista (um valor por campo): -2 inexistente, -1 sem TTL
+    if isinstance(reply, (list, tuple)):
+        reply = reply[0] if reply else -2
+    try:
+        return int(reply)
+    except (TypeError, ValueError):
+        return -2
+
+
+# ============================================
+# API síncrona
+# ============================================
+
+def set_field(client, telefone: str, field: str, value: str, ttl_seconds: int) -> None:
+    from tools.redis_tools import registered_script
+    native = field_ttl_supported(client)
+    script = registered_script(client, "customer:set", SET_FIELD_SCRIPT)
+    script(keys=[customer_key(telefone)], args=set_field_args(field, value, ttl_seconds, native))
+
+
+def get_field(client, telefone: str, field: str) -> Optional[str]:
+    value, exp = client.hmget(customer_key(telefone), field, field + EXP_SUFFIX)
+    if value is None or (exp is not None and int(exp) <= _now_ms()):
+        return None
+    return value
+
+
+def get_field_ttl(client, telefone: str, field: str) -> int:
+    """TTL restante do campo (mesma convenção do comando TTL: -2 inexistente, -1 sem TTL)."""
+    key = customer_key(telefone)
+    if field_ttl_supported(client):
+        return _native_ttl_reply(client.execute_command("HTTL", key, "FIELDS", 1, field))
+    value, exp = client.hmget(key, field, field + EXP_SUFFIX)
+    if value is None:
+        return -2
+    return emulated_ttl({field: value, **({field + EXP_SUFFIX: exp} if exp is not None else {})}, field)
+
+
+def expire_field(client, telefone: str, field: str, ttl_seconds: int) -> None:
+    """Troca o TTL de um campo existente (ex: comprovante na janela de alteração do pedido)."""
+    value = get_field(client, telefone, field)
+    if value is not None:
+        set_field(client, telefone, field, value, ttl_seconds)
+
+
+def delete_fields(client, telefone: str, *fields: str) -> None:
+    names = []
+    for field in fields:
+        names.extend([field, field + EXP_SUFFIX])
+    client.hdel(customer_key(telefone), *names)
+
+
+def queue_snapshot_reads(pipe, telefone: str, native: bool) -> int:
+    """Enfileira as leituras do snapshot do turno (HGETALL + HTTL do cooldown). Retorna quantos comandos."""
+    key = customer_key(telefone)
+    pipe.hgetall(key)
+    if native:
+        pipe.execute_command("HTTL", key, "FIELDS", 1, "cooldown")
+        return 2
+    return 1
+
+
+def parse_snapshot(results: List, native: bool) -> Tuple[Dict[str, str], int]:
+    """Converte o resultado de queue_snapshot_reads em (campos vivos, ttl do cooldown)."""
+    raw = results[0] or {}
+    if native:
+        fields = live_fields(raw)
+        ttl = _native_ttl_reply(results[1]) if "cooldown" in fields else -2
+        return fields, ttl
+    now_ms = _now_ms()
+    return live_fields(raw, now_ms), emulated_ttl(raw, "cooldown", now_ms)
+
+
+# ============================================
+# API assíncrona (webhook)
+# ============================================
+
+async def aset_field(client, telefone: str, field: str, value: str, ttl_seconds: int) -> None:
+    from tools.redis_tools import registered_script
+    native = await afield_ttl_supported(client)
+    script = registered_script(client, "customer:set", SET_FIELD_SCRIPT)
+    await script(keys=[customer_key(telefone)], args=set_field_args(field, value, ttl_seconds, native))
+
+
+async def aget_field_ttl(client, telefone: str, field: str) -> int:
+    key = customer_key(telefone)
+    if await afield_ttl_supported(client):
+        return _native_ttl_reply(await client.execute_command("HTTL", key, "FIELDS", 1, field))
+    value, exp = await client.hmget(key, field, field + EXP_SUFFIX)
+    if value is None:
+        return -2
+    return emulated_ttl({field: value, **({field + EXP_SUFFIX: exp} if exp is not None else {})}, field)
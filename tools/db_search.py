@@ -656,6 +656,7 @@ def search_products_db(query: str, limit: int = 8, telefone: Optional[str] = Non
                 for r in results:
                     products_for_cache.append(
                         {
+                            "id": r.get("id"),  # finalizar_pedido_tool resolve os itens compactos (id:quantidade) por aqui
                             "nome": r.get("nome") or "",
                             "preco": _safe_float(r.get("preco"), 0.0),
                             "termo_busca": q,
@@ -681,3 +682,55 @@ def search_products_db(query: str, limit: int = 8, telefone: Optional[str] = Non
                 _return_connection(conn)
         except Exception:
             pass
+
+
+def get_products_by_ids(ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Produtos por id (uma query): {id: {"id", "nome", "preco", "unidade"}}.
+    Usado pelo fechamento de pedido quando o id já saiu das sugestões em cache.
+    """
+    ids = [str(i) for i in ids if i]
+    if not ids:
+        return {}
+    base = settings.postgres_products_table_name or "produtos-sp-queiroz"
+    tables = [base]
+    if "produtos-" in base:
+        tables.append(base.replace("produtos-", "produto-", 1))
+    elif "produto-" in base:
+        tables.append(base.replace("produto-", "produtos-", 1))
+
+    conn = None
+    try:
+        conn = _get_connection()
+        for table_name in tables:
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute(
+                        sql.SQL("SELECT id, nome, preco, unidade FROM {table} WHERE id = ANY(%s)").format(
+                            table=sql.Identifier(table_name)
+                        ),
+                        (ids,),
+                    )
+                    rows = cursor.fetchall() or []
+                return {
+                    str(r["id"]): {
+                        "id": str(r["id"]),
+                        "nome": r.get("nome") or "Produto sem nome",
+                        "preco": _safe_float(r.get("preco"), 0.0),
+                        "unidade": r.get("unidade") or "UN",
+                    }
+                    for r in rows
+                }
+            except Exception as e:
+                conn.rollback()
+                logger.debug(f"Busca por id em {table_name} falhou: {e}")
+        return {}
+    except Exception as e:
+        logger.error(f"Erro ao buscar produtos por id: {e}")
+        return {}
+    finally:
+        if conn is not None:
+            try:
+                _return_connection(conn)
+            except Exception:
+                pass
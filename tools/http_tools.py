@@ -3,17 +3,138 @@ Ferramentas HTTP para interação com a API do Supermercado
 """
 import requests
 import json
-from typing import Dict, Any, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 from config.settings import settings
 from config.logger import setup_logger
+from tools import metrics
+from tools.circuit_breaker import get_breaker
+from tools.result_format import render_estoque
 
 
 logger = setup_logger(__name__)
 
+ESTOQUE_SERVICE = "estoque_api"
+ESTOQUE_CACHE_TTL = 21600  # 6h
+
+DASHBOARD_SERVICE = "dashboard"
+AUTH_ENV_RECHECK = 300
+
+_http_client: Optional["SupermercadoHTTP"] = None
+_auth_cache: Dict[str, Any] = {}
+_auth_lock = threading.Lock()
+_http_lock = threading.Lock()
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+_revalidate_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="estoque-swr")
+# Faltas do estoque_preco_many: o limite vale para o processo, não por chamada
+_bulk_pool = ThreadPoolExecutor(max_workers=max(1, settings.estoque_bulk_concurrency), thread_name_prefix="estoque-bulk")
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Serviço com circuit breaker aberto: a requisição nem foi feita."""
+
+
+class SupermercadoHTTP:
+    """
+    Session compartilhada das ferramentas HTTP: pool keep-alive por host, retry
+    com backoff em falha de conexão e 502/503/504 (só GET/PUT; o POST do pedido
+    nunca é repetido), latência por endpoint em metrics (http.<endpoint>) e
+    circuit breaker por serviço (padrão "dashboard"; breaker=None desliga).
+    """
+
+    def __init__(self):
+        retry = Retry(
+            total=settings.supermercado_http_retries,
+            connect=settings.supermercado_http_retries,
+            read=0,  # Timeout de leitura não é repetido aqui (API lenta: quem chama decide)
+            status=settings.supermercado_http_retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET", "PUT"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max(settings.supermercado_http_pool_size, settings.estoque_bulk_concurrency),
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method: str, endpoint: str, url: str, auth: bool = True,
+                breaker: Optional[str] = DASHBOARD_SERVICE, **kwargs) -> requests.Response:
+        headers = kwargs.pop("headers", None)
+        if headers is None and auth:
+            headers = get_auth_headers()
+        circuit = get_breaker(breaker) if breaker else None
+        if circuit is not None and not circuit.allow():
+            raise CircuitOpenError(f"Circuit breaker aberto para {breaker}")
+        try:
+            with metrics.timer(f"http.{endpoint}"):
+                resp = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.exceptions.RequestException:
+            if circuit is not None:
+                circuit.record_failure()
+            raise
+        if circuit is not None:
+            if resp.status_code >= 500:
+                circuit.record_failure()
+            else:
+                circuit.record_success()
+        return resp
+
+    def get(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", endpoint, url, **kwargs)
+
+    def post(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", endpoint, url, **kwargs)
+
+    def put(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", endpoint, url, **kwargs)
+
+
+def get_http_client() -> SupermercadoHTTP:
+    """Cliente HTTP compartilhado (singleton, thread-safe)."""
+    global _http_client
+    if _http_client is None:
+        with _http_lock:
+            if _http_client is None:
+                _http_client = SupermercadoHTTP()
+    return _http_client
+
 
 def get_auth_headers() -> Dict[str, str]:
-    """Retorna os headers de autenticação para as requisições"""
-    token = settings.supermercado_auth_token or ""
+    """
+    Retorna os headers de autenticação para as requisições.
+    Ficam em cache: são reconstruídos quando settings.supermercado_auth_token muda
+    (ou por reload_auth_headers()); com token ausente/curto, o .env é relido no
+    máximo a cada AUTH_ENV_RECHECK segundos.
+    """
+    configured = settings.supermercado_auth_token or ""
+    cached = _auth_cache.get("headers")
+    if cached is not None and _auth_cache.get("key") == configured and (
+        len(configured) >= 10 or time.monotonic() - _auth_cache["built_at"] < AUTH_ENV_RECHECK
+    ):
+        return dict(cached)
+    with _auth_lock:
+        headers = _build_auth_headers(configured)
+        _auth_cache.update(key=configured, headers=headers, built_at=time.monotonic())
+    return dict(headers)
+
+
+def reload_auth_headers() -> None:
+    """Descarta os headers em cache (ex: token trocado no .env)."""
+    _auth_cache.clear()
+
+
+def _build_auth_headers(configured: str) -> Dict[str, str]:
+    token = configured
     
     # Fallback: Tentar ler TOKEN_SUPERMERCADO direto do environment caso o settings esteja vazio
     # (Caso o usuário tenha nomeado diferente no .env)
@@ -21,7 +142,8 @@ def get_auth_headers() -> Dict[str, str]:
         import os
         from dotenv import load_dotenv
         
-        # FORÇAR recarregamento do .env para pegar mudanças sem reiniciar servidor
+        # Recarrega o .env para pegar mudanças sem reiniciar servidor
+        # (no máximo a cada AUTH_ENV_RECHECK: o resultado fica em cache)
         load_dotenv(override=True)
         
         token_env = os.getenv("TOKEN_SUPERMERCADO", "")
@@ -36,7 +158,7 @@ def get_auth_headers() -> Dict[str, str]:
     if token and not token.strip().lower().startswith("bearer"):
         token = f"Bearer {token.strip()}"
     
-    # DEBUG: Verificar formato do token (mascarado)
+    # DEBUG: Verificar formato do token (mascarado) - só quando o cache é reconstruído
     safe_token = f"{token[:15]}...{token[-5:]}" if len(token) > 20 else "CURTO/VAZIO"
     logger.info(f"🔑 Auth Header gerado: {safe_token}")
         
@@ -60,11 +182,7 @@ def estoque(url: str) -> str:
     logger.info(f"Consultando estoque: {url}")
     
     try:
-        response = requests.get(
-            url,
-            headers=get_auth_headers(),
-            timeout=10
-        )
+        response = get_http_client().get("estoque", url, timeout=10)
         response.raise_for_status()
         
         data = response.json()
@@ -96,7 +214,7 @@ def estoque(url: str) -> str:
             
         logger.info(f"Estoque consultado com sucesso: {len(data) if isinstance(data, list) else 1} produto(s)")
         
-        return json.dumps(filtered_data, indent=2, ensure_ascii=False)
+        return render_estoque(json.dumps(filtered_data, ensure_ascii=False))
     
     except requests.exceptions.Timeout:
         error_msg = "Erro: Timeout ao consultar estoque. Tente novamente."
@@ -132,7 +250,7 @@ def consultar_cliente(telefone: str) -> Optional[Dict[str, Any]]:
     url = f"{base}/pedidos/cliente/{digits}"
     
     try:
-        response = requests.get(url, headers=get_auth_headers(), timeout=5)
+        response = get_http_client().get("consultar_cliente", url, timeout=5)
         if response.status_code == 404:
             return None
         response.raise_for_status()
@@ -155,6 +273,24 @@ def pedidos(json_body: str) -> str:
     Returns:
         Mensagem de sucesso com resposta do servidor ou mensagem de erro
     """
+    try:
+        # Validar JSON
+        data = json.loads(json_body)
+    except json.JSONDecodeError:
+        error_msg = "Erro: O corpo da requisição não é um JSON válido."
+        logger.error(error_msg)
+        return error_msg
+    return enviar_pedido(data)[2]
+
+
+def enviar_pedido(data: Dict[str, Any], idem: Optional[str] = None) -> Tuple[bool, bool, str]:
+    """
+    POST do pedido no dashboard. Retorna (ok, pode_repetir, mensagem):
+    pode_repetir = timeout, erro de conexão, circuito aberto, 5xx, 408 ou 429
+    (usado pelo outbox de pedidos para decidir entre retry e falha definitiva).
+    idem vai no header Idempotency-Key: o retry depois de um timeout (pedido
+    gravado, resposta perdida) não duplica o pedido no dashboard.
+    """
     # Remove trailing slashed from base and from endpoint to ensure correct path
     base = settings.supermercado_base_url.rstrip("/")
     url = f"{base}/pedidos/"  # Barra final necessária para FastAPI
@@ -166,43 +302,38 @@ def pedidos(json_body: str) -> str:
     logger.info(f"🔑 Token usado: {token_preview}")
     
     try:
-        # Validar JSON
-        data = json.loads(json_body)
         logger.debug(f"Dados do pedido: {data}")
         
-        response = requests.post(
-            url,
-            headers=get_auth_headers(),
-            json=data,
-            timeout=10
-        )
+        headers = get_auth_headers()
+        if idem:
+            headers = {**headers, "Idempotency-Key": idem}
+        response = get_http_client().post("pedidos", url, json=data, headers=headers, timeout=10)
         response.raise_for_status()
         
-        result = response.json()
+        try:
+            result = response.json()
+        except ValueError:
+            result = response.text
         success_msg = f"✅ Pedido enviado com sucesso!\n\nResposta do servidor:\n{json.dumps(result, indent=2, ensure_ascii=False)}"
         logger.info("Pedido enviado com sucesso")
         
-        return success_msg
-    
-    except json.JSONDecodeError:
-        error_msg = "Erro: O corpo da requisição não é um JSON válido."
-        logger.error(error_msg)
-        return error_msg
+        return True, False, success_msg
     
     except requests.exceptions.Timeout:
         error_msg = "Erro: Timeout ao enviar pedido. Tente novamente."
         logger.error(error_msg)
-        return error_msg
+        return False, True, error_msg
     
     except requests.exceptions.HTTPError as e:
-        error_msg = f"Erro HTTP ao enviar pedido: {e.response.status_code} - {e.response.text}"
+        status = e.response.status_code
+        error_msg = f"Erro HTTP ao enviar pedido: {status} - {e.response.text}"
         logger.error(error_msg)
-        return error_msg
+        return False, status >= 500 or status in (408, 429), error_msg
     
     except requests.exceptions.RequestException as e:
         error_msg = f"Erro ao enviar pedido: {str(e)}"
         logger.error(error_msg)
-        return error_msg
+        return False, True, error_msg
 
 
 def alterar(telefone: str, json_body: str) -> str:
@@ -229,7 +360,7 @@ def alterar(telefone: str, json_body: str) -> str:
         # 1. BUSCAR PEDIDO ATUAL (GET)
         # Precisamos da lista atual para não apagar o que já existe
         try:
-            get_response = requests.get(base_url, headers=get_auth_headers(), timeout=10)
+            get_response = get_http_client().get("alterar.get", base_url, timeout=10)
             get_response.raise_for_status()
             pedido_atual = get_response.json()
             
@@ -255,12 +386,7 @@ def alterar(telefone: str, json_body: str) -> str:
         data_update["itens"] = itens_finais
         
         # 3. ENVIAR ATUALIZAÇÃO (PUT)
-        response = requests.put(
-            base_url,
-            headers=get_auth_headers(),
-            json=data_update,
-            timeout=10
-        )
+        response = get_http_client().put("alterar.put", base_url, json=data_update, timeout=10)
         response.raise_for_status()
         
         result = response.json()
@@ -304,12 +430,7 @@ def overwrite_order(telefone: str, json_body: str) -> str:
         data = json.loads(json_body)
         
         # ENVIAR ATUALIZAÇÃO (PUT)
-        response = requests.put(
-            base_url,
-            headers=get_auth_headers(),
-            json=data,
-            timeout=10
-        )
+        response = get_http_client().put("overwrite_order", base_url, json=data, timeout=10)
         response.raise_for_status()
         
         result = response.json()
@@ -329,6 +450,31 @@ def overwrite_order(telefone: str, json_body: str) -> str:
         return error_msg
 
 
+def buscar_pedido(telefone: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    GET do pedido atual no dashboard: (pedido, etag). Pedido None = não existe (404).
+    Exceções de rede/HTTP sobem para o chamador (sync de pedidos decide o retry).
+    """
+    telefone_limpo = "".join(filter(str.isdigit, telefone))
+    url = f"{settings.supermercado_base_url}/pedidos/telefone/{telefone_limpo}"
+    response = get_http_client().get("pedido.get", url, timeout=10)
+    if response.status_code == 404:
+        return None, None
+    response.raise_for_status()
+    pedido = response.json()
+    return (pedido if isinstance(pedido, dict) else {"itens": pedido}), response.headers.get("ETag")
+
+
+def gravar_pedido(telefone: str, data: Dict[str, Any], etag: Optional[str] = None) -> requests.Response:
+    """PUT do pedido completo; com etag, vai com If-Match (412 = pedido mudou no servidor)."""
+    telefone_limpo = "".join(filter(str.isdigit, telefone))
+    url = f"{settings.supermercado_base_url}/pedidos/telefone/{telefone_limpo}"
+    headers = get_auth_headers()
+    if etag:
+        headers["If-Match"] = etag
+    return get_http_client().put("pedido.put", url, json=data, headers=headers, timeout=10)
+
+
 
 
 
@@ -341,6 +487,10 @@ def estoque_preco(ean: str) -> str:
     Exemplo: {base}/7891149103300
     
     MELHORIAS:
+    - Cache primeiro (estoque_preco_cache:{ean}, 6h): resposta com menos de
+      settings.estoque_cache_fresh_seconds volta direto; mais velha volta na hora
+      e é revalidada em segundo plano (stale-while-revalidate)
+    - Single-flight: consultas simultâneas do mesmo EAN dividem uma requisição
     - Retry automático com backoff exponencial (3 tentativas)
     - Timeouts progressivos para lidar com API lenta
 
@@ -350,20 +500,15 @@ def estoque_preco(ean: str) -> str:
     Returns:
         JSON string com informações do produto ou mensagem de erro amigável.
     """
-    import time
-    
+    from tools.redis_tools import get_redis_client
+
+    start = time.perf_counter()
     base = (settings.estoque_ean_base_url or "").strip().rstrip("/")
     if not base:
         msg = "Erro: ESTOQUE_EAN_BASE_URL não configurado no .env"
         logger.error(msg)
         return msg
 
-    # CIRCUIT BREAKER CHECK
-    from tools.redis_tools import check_circuit_open, report_failure, report_success
-    from tools.redis_tools import get_redis_client
-    SERVICE_NAME = "estoque_api"
-    CACHE_TTL = 21600
-    
     # manter apenas dígitos no EAN
     ean_digits = "".join(ch for ch in ean if ch.isdigit())
     if not ean_digits:
@@ -371,22 +516,124 @@ def estoque_preco(ean: str) -> str:
         logger.error(msg)
         return msg
 
-    cache_key = f"estoque_preco_cache:{ean_digits}"
+    cached = _read_estoque_cache(get_redis_client(), [ean_digits]).get(ean_digits)
+    if cached is not None:
+        return _serve_cached(ean_digits, cached, start)
 
-    if check_circuit_open(SERVICE_NAME):
-        client = get_redis_client()
-        if client is not None:
-            try:
-                cached = client.get(cache_key)
-                if cached:
-                    logger.warning(f"Circuit Breaker ativo; retornando cache para EAN {ean_digits}")
-                    return cached if isinstance(cached, str) else str(cached)
-            except Exception:
-                pass
+    out = _estoque_single_flight(ean_digits)
+    metrics.observe("estoque_preco.miss", time.perf_counter() - start)
+    return out
+
+
+def estoque_preco_many(eans: List[str]) -> Dict[str, str]:
+    """
+    estoque_preco para vários EANs: uma ida ao Redis para o cache de todos e as
+    faltas consultadas em paralelo (single-flight, no pool do módulo: até
+    settings.estoque_bulk_concurrency simultâneas, na Session compartilhada).
+    Retorna {ean_digits: resultado}.
+    """
+    from tools.redis_tools import get_redis_client
+
+    start = time.perf_counter()
+    digits = list(dict.fromkeys("".join(ch for ch in e if ch.isdigit()) for e in eans or []))
+    digits = [d for d in digits if d]
+    if not digits:
+        return {}
+    if not (settings.estoque_ean_base_url or "").strip():
+        msg = "Erro: ESTOQUE_EAN_BASE_URL não configurado no .env"
+        logger.error(msg)
+        return {ean: msg for ean in digits}
+    cached = _read_estoque_cache(get_redis_client(), digits)
+    results = {ean: _serve_cached(ean, cached[ean], start) for ean in digits if ean in cached}
+    missing = [ean for ean in digits if ean not in cached]
+    futures = {ean: _bulk_pool.submit(_estoque_single_flight, ean) for ean in missing}
+    for ean, fut in futures.items():
+        try:
+            results[ean] = fut.result()
+        except Exception as e:
+            logger.error(f"Erro ao consultar estoque do EAN {ean}: {e}")
+            results[ean] = "⚠️ Não foi possível consultar o estoque agora. Tente novamente em instantes."
+        metrics.observe("estoque_preco.miss", time.perf_counter() - start)
+    logger.info(f"📦 estoque_preco_many: {len(digits)} EAN(s), {len(cached)} do cache, {len(missing)} consultado(s)")
+    return {ean: results[ean] for ean in digits}
+
+
+def _read_estoque_cache(client, eans: List[str]) -> Dict[str, Tuple[str, int]]:
+    """{ean: (json, idade_em_segundos)} numa ida ao Redis (GET + TTL de cada chave)."""
+    if client is None or not eans:
+        return {}
+    try:
+        pipe = client.pipeline(transaction=False)
+        for ean in eans:
+            pipe.get(f"estoque_preco_cache:{ean}")
+            pipe.ttl(f"estoque_preco_cache:{ean}")
+        raw = pipe.execute()
+    except Exception as e:
+        logger.debug(f"Cache de estoque indisponível: {e}")
+        return {}
+    found = {}
+    for ean, value, ttl in zip(eans, raw[0::2], raw[1::2]):
+        if value:
+            age = ESTOQUE_CACHE_TTL - ttl if ttl and ttl > 0 else ESTOQUE_CACHE_TTL
+            found[ean] = (value if isinstance(value, str) else str(value), age)
+    return found
+
+
+def _serve_cached(ean_digits: str, cached: Tuple[str, int], start: float) -> str:
+    """Resposta do cache; se passou da janela de frescor, agenda a revalidação."""
+    value, age = cached
+    if age >= settings.estoque_cache_fresh_seconds:
+        _schedule_revalidation(ean_digits)
+        metrics.observe("estoque_preco.stale", time.perf_counter() - start)
+    else:
+        metrics.observe("estoque_preco.hit", time.perf_counter() - start)
+    return value
+
+
+def _schedule_revalidation(ean_digits: str) -> None:
+    with _inflight_lock:
+        if ean_digits in _inflight:
+            return
+    if get_breaker(ESTOQUE_SERVICE).is_open():
+        return
+    metrics.incr("estoque_preco.revalidations")
+    _revalidate_pool.submit(_estoque_single_flight, ean_digits)
+
+
+def _estoque_single_flight(ean_digits: str) -> str:
+    """Uma requisição por EAN em voo: as consultas simultâneas esperam o mesmo resultado."""
+    with _inflight_lock:
+        fut = _inflight.get(ean_digits)
+        owner = fut is None
+        if owner:
+            fut = _inflight[ean_digits] = Future()
+    if not owner:
+        metrics.incr("estoque_preco.single_flight_shared")
+        return fut.result()
+    try:
+        out = _fetch_estoque_preco(ean_digits)
+        fut.set_result(out)
+        return out
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(ean_digits, None)
+
+
+def _fetch_estoque_preco(ean_digits: str) -> str:
+    """Consulta a API de EAN (com retry), filtra os itens disponíveis e grava o cache."""
+    from tools.redis_tools import get_redis_client
+
+    cache_key = f"estoque_preco_cache:{ean_digits}"
+    breaker = get_breaker(ESTOQUE_SERVICE)
+    if not breaker.allow():
         msg = "⚠️ O sistema de estoque está instável no momento. Tente novamente em alguns minutos."
         logger.warning(f"Circuit Breaker impediu chamada para {ean_digits}")
         return msg
 
+    base = (settings.estoque_ean_base_url or "").strip().rstrip("/")
     url = f"{base}/{ean_digits}"
     
     headers = {
@@ -408,11 +655,11 @@ def estoque_preco(ean: str) -> str:
             else:
                 logger.info(f"Consultando estoque_preco por EAN: {url}")
             
-            resp = requests.get(url, headers=headers, timeout=timeout)
+            resp = get_http_client().get("estoque_ean", url, headers=headers, timeout=timeout, breaker=None)
             resp.raise_for_status()
 
             # SUCESSO DO CIRCUIT BREAKER
-            report_success(SERVICE_NAME)
+            breaker.record_success()
 
             # resposta esperada: lista de objetos
             try:
@@ -600,11 +847,11 @@ def estoque_preco(ean: str) -> str:
 
             logger.info(f"EAN {ean_digits}: {len(sanitized)} item(s) disponíveis após filtragem")
 
-            out = json.dumps(sanitized, indent=2, ensure_ascii=False)
+            out = json.dumps(sanitized, ensure_ascii=False)
             client = get_redis_client()
             if client is not None:
                 try:
-                    client.set(cache_key, out, ex=CACHE_TTL)
+                    client.set(cache_key, out, ex=ESTOQUE_CACHE_TTL)
                 except Exception:
                     pass
             return out
@@ -614,7 +861,7 @@ def estoque_preco(ean: str) -> str:
             logger.warning(f"⏱️ {last_error}")
             
             # FALHA DO CIRCUIT BREAKER (TIMEOUT)
-            report_failure(SERVICE_NAME)
+            breaker.record_failure()
             
             if attempt < MAX_RETRIES - 1:
                 time.sleep(0.5)  # Pequena pausa antes de retry
@@ -627,13 +874,15 @@ def estoque_preco(ean: str) -> str:
             
             # FALHA DO CIRCUIT BREAKER (Erro Servidor 500+)
             if str(status).startswith("5"):
-                report_failure(SERVICE_NAME)
+                breaker.record_failure()
+            else:
+                breaker.record_success()  # 4xx: o serviço respondeu
             
             return msg
         except requests.exceptions.RequestException as e:
             msg = f"Erro ao consultar EAN: {str(e)}"
             logger.error(msg)
-            report_failure(SERVICE_NAME)
+            breaker.record_failure()
             return msg
     
     client = get_redis_client()
@@ -675,11 +924,7 @@ def consultar_encarte() -> str:
     logger.info(f"Consultando encarte: {url}")
     
     try:
-        response = requests.get(
-            url,
-            headers=get_auth_headers(),
-            timeout=10
-        )
+        response = get_http_client().get("encarte", url, timeout=10)
         response.raise_for_status()
         
         data = response.json()
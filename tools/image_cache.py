@@ -0,0 +1,320 @@
+"""
+Cache em disco das imagens de produto enviadas pelo WhatsApp (LRU por tamanho)
+
+As respostas do agente citam as mesmas imagens do catálogo para vários
+clientes; sem cache, cada menção baixava e recodificava a imagem em base64.
+
+- Chave: SHA-256 da URL -> {image_cache_dir}/{h[:2]}/{h}.b64 (base64 pronto
+  para o /send/media) + {h}.json (url, mime, etag, last_modified, fetched_at)
+- Entrada com mais de IMAGE_CACHE_FRESH_SECONDS é revalidada com GET
+  condicional (If-None-Match / If-Modified-Since): 304 só renova o carimbo;
+  se a origem estiver fora do ar, a cópia antiga é servida
+- LRU: o mtime do .b64 é o último uso; passando de image_cache_max_mb, os
+  menos usados são apagados
+- imgcache:popular (ZSET no Redis) conta os pedidos por URL; prewarm() baixa
+  as top-N depois de cada sincronização do catálogo
+- Métricas: image_cache.hits/misses/revalidated/stale/evictions e o gauge
+  image_cache.hit_rate
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from config.settings import settings
+from config.logger import setup_logger
+from tools import metrics
+
+logger = setup_logger(__name__)
+
+POPULAR_KEY = "imgcache:popular"
+IMAGE_CACHE_FRESH_SECONDS = 3600
+FETCH_TIMEOUT = 15
+
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+_disk_bytes: Optional[int] = None  # Total aproximado em disco (recalculado na evicção)
+
+
+def _paths(url: str) -> Tuple[str, str]:
+    h = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    base = os.path.join(settings.image_cache_dir, h[:2], h)
+    return base + ".b64", base + ".json"
+
+
+def _cache_metrics() -> Dict[str, float]:
+    total = _stats["hits"] + _stats["misses"]
+    gauges = {"image_cache.hit_rate": round(_stats["hits"] / total, 4) if total else 0.0}
+    if _disk_bytes is not None:
+        gauges["image_cache.disk_bytes"] = _disk_bytes
+    return gauges
+
+
+metrics.register_collector(_cache_metrics)
+
+
+def _count(hit: bool) -> None:
+    with _lock:
+        _stats["hits" if hit else "misses"] += 1
+    metrics.incr("image_cache.hits" if hit else "image_cache.misses")
+
+
+def _load_meta(url: str) -> Optional[Dict]:
+    data_path, meta_path = _paths(url)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("url") != url or not os.path.exists(data_path):
+        return None
+    return meta
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _read_hit(url: str, meta: Dict) -> Optional[Tuple[str, str]]:
+    """Lê o base64 em cache e marca o uso (mtime) para o LRU."""
+    data_path, _ = _paths(url)
+    try:
+        with open(data_path, "r", encoding="ascii") as f:
+            b64 = f.read()
+        os.utime(data_path, None)
+    except OSError:
+        return None
+    return b64, meta.get("mime") or "image/jpeg"
+
+
+def _store(url: str, content: bytes, headers) -> Tuple[str, str]:
+    """Grava o base64 + metadados (e evicta se passar do limite). Retorna (base64, mime)."""
+    global _disk_bytes
+    data_path, meta_path = _paths(url)
+    b64 = base64.b64encode(content).decode("ascii")
+    meta = {
+        "url": url,
+        "mime": headers.get("Content-Type", "image/jpeg"),
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "fetched_at": time.time(),
+        "size": len(b64),
+    }
+    try:
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        previous = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        _write_atomic(data_path, b64.encode("ascii"))
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+        with _lock:
+            if _disk_bytes is not None:
+                _disk_bytes += len(b64) - previous
+        _evict_if_needed()
+    except OSError as e:
+        logger.error(f"Erro ao gravar imagem em cache ({url}): {e}")
+    return b64, meta["mime"]
+
+
+def _touch_meta(url: str, meta: Dict) -> None:
+    """304: a cópia continua válida, só renova o carimbo de revalidação."""
+    meta["fetched_at"] = time.time()
+    try:
+        _write_atomic(_paths(url)[1], json.dumps(meta).encode("utf-8"))
+    except OSError as e:
+        logger.debug(f"Erro ao renovar metadados da imagem {url}: {e}")
+
+
+def _evict_if_needed() -> None:
+    """Apaga os .b64 menos usados (mtime) até ficar abaixo de 90% do limite."""
+    global _disk_bytes
+    limit = max(1, settings.image_cache_max_mb) * 1024 * 1024
+    if _disk_bytes is not None and _disk_bytes <= limit:
+        return
+    entries, total = [], 0
+    root = settings.image_cache_dir
+    for shard in os.listdir(root) if os.path.isdir(root) else []:
+        shard_dir = os.path.join(root, shard)
+        if not os.path.isdir(shard_dir):
+            continue
+        for name in os.listdir(shard_dir):
+            if not name.endswith(".b64"):
+                continue
+            path = os.path.join(shard_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    evicted = 0
+    if total > limit:
+        for _, size, path in sorted(entries):
+            if total <= limit * 0.9:
+                break
+            for victim in (path, path[:-len(".b64")] + ".json"):
+                try:
+                    os.unlink(victim)
+                except OSError:
+                    pass
+            total -= size
+            evicted += 1
+    with _lock:
+        _disk_bytes = total
+    if evicted:
+        metrics.incr("image_cache.evictions", evicted)
+        logger.info(f"🧹 Cache de imagens: {evicted} evictadas ({total / 1024 / 1024:.1f} MB em disco)")
+
+
+def _conditional_headers(meta: Optional[Dict]) -> Dict[str, str]:
+    headers = {}
+    if meta and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+def _is_fresh(meta: Dict) -> bool:
+    return time.time() - meta.get("fetched_at", 0) < IMAGE_CACHE_FRESH_SECONDS
+
+
+async def _record_request(url: str) -> None:
+    from tools.redis_async import get_async_redis_client
+
+    client = await get_async_redis_client()
+    if client is None:
+        return
+    try:
+        await client.zincrby(POPULAR_KEY, 1, url)
+    except Exception as e:
+        logger.debug(f"Erro ao contar pedido da imagem {url}: {e}")
+
+
+async def aget_image(url: str) -> Optional[Tuple[str, str]]:
+    """(base64, mime) da imagem: do disco se válida, senão baixa (pool httpx compartilhado)."""
+    from tools.whatsapp_api import get_async_http_client
+
+    await _record_request(url)
+    meta = await asyncio.to_thread(_load_meta, url) if settings.image_cache_enabled else None
+    if meta and _is_fresh(meta):
+        hit = await asyncio.to_thread(_read_hit, url, meta)
+        if hit:
+            _count(True)
+            return hit
+
+    try:
+        resp = await get_async_http_client().get(
+            url, headers=_conditional_headers(meta), timeout=FETCH_TIMEOUT, follow_redirects=True
+        )
+        if resp.status_code == 304 and meta:
+            await asyncio.to_thread(_touch_meta, url, meta)
+            hit = await asyncio.to_thread(_read_hit, url, meta)
+            if hit:
+                metrics.incr("image_cache.revalidated")
+                _count(True)
+                return hit
+            resp = await get_async_http_client().get(url, timeout=FETCH_TIMEOUT, follow_redirects=True)
+        resp.raise_for_status()
+    except Exception as e:
+        if meta:
+            hit = await asyncio.to_thread(_read_hit, url, meta)
+            if hit:
+                metrics.incr("image_cache.stale")
+                _count(True)
+                return hit
+        logger.error(f"❌ Erro ao baixar {url}: {e}")
+        _count(False)
+        return None
+
+    _count(False)
+    if not settings.image_cache_enabled:
+        return base64.b64encode(resp.content).decode("ascii"), resp.headers.get("Content-Type", "image/jpeg")
+    return await asyncio.to_thread(_store, url, resp.content, resp.headers)
+
+
+def get_image(url: str, record: bool = True) -> Optional[Tuple[str, str]]:
+    """Versão síncrona de aget_image (fallback do server e prewarm)."""
+    from tools.redis_tools import get_redis_client
+    from tools.whatsapp_api import get_sync_session
+
+    # Prewarm não conta como pedido (nem no ranking nem na taxa de acerto)
+    count = _count if record else (lambda hit: None)
+    if record:
+        client = get_redis_client()
+        if client is not None:
+            try:
+                client.zincrby(POPULAR_KEY, 1, url)
+            except Exception as e:
+                logger.debug(f"Erro ao contar pedido da imagem {url}: {e}")
+
+    meta = _load_meta(url) if settings.image_cache_enabled else None
+    if meta and _is_fresh(meta):
+        hit = _read_hit(url, meta)
+        if hit:
+            count(True)
+            return hit
+
+    session = get_sync_session()
+    try:
+        resp = session.get(url, headers=_conditional_headers(meta), timeout=FETCH_TIMEOUT)
+        if resp.status_code == 304 and meta:
+            _touch_meta(url, meta)
+            hit = _read_hit(url, meta)
+            if hit:
+                metrics.incr("image_cache.revalidated")
+                count(True)
+                return hit
+            resp = session.get(url, timeout=FETCH_TIMEOUT)
+        resp.raise_for_status()
+    except Exception as e:
+        if meta:
+            hit = _read_hit(url, meta)
+            if hit:
+                metrics.incr("image_cache.stale")
+                count(True)
+                return hit
+        logger.error(f"❌ Erro ao baixar {url}: {e}")
+        count(False)
+        return None
+
+    count(False)
+    if not settings.image_cache_enabled:
+        return base64.b64encode(resp.content).decode("ascii"), resp.headers.get("Content-Type", "image/jpeg")
+    return _store(url, resp.content, resp.headers)
+
+
+def prewarm(top_n: Optional[int] = None) -> Dict[str, int]:
+    """Baixa/revalida as top-N imagens mais pedidas (roda depois da sincronização do catálogo)."""
+    from tools.redis_tools import get_redis_client
+
+    stats = {"warmed": 0, "failed": 0}
+    top_n = settings.image_cache_prewarm_top if top_n is None else top_n
+    client = get_redis_client()
+    if not settings.image_cache_enabled or client is None or top_n <= 0:
+        return stats
+    try:
+        urls = client.zrevrange(POPULAR_KEY, 0, top_n - 1)
+        # Mantém o ranking enxuto: só as 10x top-N mais pedidas continuam sendo contadas
+        client.zremrangebyrank(POPULAR_KEY, 0, -(top_n * 10) - 1)
+    except Exception as e:
+        logger.error(f"Erro ao ler imagens mais pedidas: {e}")
+        return stats
+    for url in urls:
+        if get_image(url, record=False):
+            stats["warmed"] += 1
+        else:
+            stats["failed"] += 1
+    logger.info(f"🔥 Cache de imagens pré-aquecido: {stats}")
+    return stats
@@ -0,0 +1,138 @@
+"""
+Métricas em memória do processo (contadores, gauges e tempos com percentis)
+
+- server.py expõe o snapshot em GET /metrics (JSON)
+- o worker publica o próprio snapshot no Redis (metrics:<processo>:<pid>),
+  que o /metrics do server agrega
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, List
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, float] = {}
+_timings: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=2000))
+_samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=2000))
+_collectors: List[Callable[[], Dict[str, float]]] = []
+
+METRICS_KEY_PREFIX = "metrics:"
+METRICS_TTL = 120
+
+
+def incr(name: str, value: float = 1.0) -> None:
+    """Incrementa um contador."""
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value: float) -> None:
+    """Define o valor atual de um gauge."""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, seconds: float) -> None:
+    """Registra uma duração (em segundos; exportada em ms com percentis)."""
+    with _lock:
+        _timings[name].append(seconds * 1000.0)
+
+
+def record(name: str, value: float) -> None:
+    """Registra uma amostra sem unidade de tempo (ex: round trips por turno)."""
+    with _lock:
+        _samples[name].append(float(value))
+
+
+@contextmanager
+def timer(name: str):
+    """Mede o bloco e registra em `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def register_collector(fn: Callable[[], Dict[str, float]]) -> None:
+    """Registra uma função chamada a cada snapshot para atualizar gauges (ex: estado do pool)."""
+    with _lock:
+        if fn not in _collectors:
+            _collectors.append(fn)
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return round(values[k], 2)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Resumo (count/p50/p95/p99/max) de uma lista de valores."""
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "p50": _percentile(ordered, 50),
+        "p95": _percentile(ordered, 95),
+        "p99": _percentile(ordered, 99),
+        "max": round(ordered[-1], 2) if ordered else 0.0,
+    }
+
+
+def snapshot() -> Dict[str, Any]:
+    """Retorna contadores, gauges e percentis dos tempos (ms) do processo atual."""
+    for fn in list(_collectors):
+        try:
+            for name, value in (fn() or {}).items():
+                set_gauge(name, value)
+        except Exception:
+            continue
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        timings = {name: list(values) for name, values in _timings.items()}
+        samples = {name: list(values) for name, values in _samples.items()}
+    return {
+        "pid": os.getpid(),
+        "ts": time.time(),
+        "counters": counters,
+        "gauges": gauges,
+        "timings_ms": {name: summarize(values) for name, values in timings.items()},
+        "samples": {name: summarize(values) for name, values in samples.items()},
+    }
+
+
+def metrics_key(process_name: str) -> str:
+    """Chave Redis onde o snapshot deste processo é publicado."""
+    return f"{METRICS_KEY_PREFIX}{process_name}:{os.getpid()}"
+
+
+def publish_snapshot(client, process_name: str) -> bool:
+    """Publica o snapshot no Redis para ser agregado pelo /metrics do server."""
+    if client is None:
+        return False
+    try:
+        client.set(metrics_key(process_name), json.dumps(snapshot()), ex=METRICS_TTL)
+        return True
+    except Exception:
+        return False
+
+
+def collect_published(client) -> Dict[str, Any]:
+    """Lê os snapshots publicados por outros processos (worker)."""
+    out: Dict[str, Any] = {}
+    if client is None:
+        return out
+    try:
+        for key in client.scan_iter(match=f"{METRICS_KEY_PREFIX}*", count=100):
+            raw = client.get(key)
+            if raw:
+                out[key[len(METRICS_KEY_PREFIX):]] = json.loads(raw)
+    except Exception:
+        pass
+    return out
@@ -0,0 +1,328 @@
+"""
+Outbox durável de pedidos (Redis Stream)
+
+Antes, o finalizar_pedido_tool gravava o audit log e chamava pedidos()
+(timeout de 10 s) dentro do loop de ferramentas do LLM: um dashboard lento
+segurava o turno e o slot do worker, e um timeout perdia o pedido.
+
+Agora o pedido é gravado atomicamente no stream e a ferramenta responde na
+hora; um consumidor em segundo plano entrega ao dashboard:
+
+- orders:outbox           STREAM (campo "order" = JSON) com consumer group
+- orders:outbox:delayed   ZSET de retries (score = quando tentar de novo)
+- order:idem:{key}        queued | sent | failed (chave de idempotência =
+                          telefone + sessão do pedido + hash do payload
+                          inteiro: itens, endereço, pagamento, observação;
+                          o mesmo pedido enfileirado 2x vira 1 envio, um
+                          pedido repetido em outra sessão ou com outro
+                          endereço/pagamento é outro pedido; "failed" não
+                          bloqueia um novo envio). Também vai ao dashboard
+                          no header Idempotency-Key
+
+Entrega: pelo menos uma vez; retry com backoff exponencial (5 s -> 5 min)
+em timeout / erro de conexão / 5xx, até order_outbox_max_attempts. Mensagens
+de um consumidor que morreu são reassumidas (XAUTOCLAIM) depois de
+CLAIM_IDLE_MS. Os resultados vão para logs/pedidos_audit.jsonl em lotes.
+Falha definitiva avisa o cliente e o atendente (order_failure_alert_phone).
+
+O mesmo consumidor faz o flush das alterações de pedidos já enviados
+(tools/order_sync), então as duas coisas chegam ao dashboard em ordem.
+"""
+import atexit
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from config.settings import settings
+from config.logger import setup_logger
+from tools import metrics, order_sync
+from tools.redis_tools import get_redis_client, normalize_phone, registered_script
+
+logger = setup_logger(__name__)
+
+STREAM_KEY = "orders:outbox"
+DELAYED_KEY = "orders:outbox:delayed"
+GROUP = "order-senders"
+AUDIT_PATH = "logs/pedidos_audit.jsonl"
+AUDIT_BATCH = 20
+AUDIT_FLUSH_SECONDS = 2.0
+READ_BLOCK_MS = 1000  # Abaixo do socket_timeout (5 s) do pool; também é a folga do flush do order_sync
+CLAIM_IDLE_MS = 60_000
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 300
+# Fora do hash: a URL assinada do comprovante muda a cada montagem do mesmo pedido
+IDEM_EXCLUDED_FIELDS = ("comprovante_pix",)
+
+# KEYS: idem, stream; ARGV: pedido (JSON), ttl -> id da mensagem (nil = já enfileirado/enviado)
+_ENQUEUE_LUA = """
+local state = redis.call('GET', KEYS[1])
+if state == 'queued' or state == 'sent' then
+    return false
+end
+redis.call('SET', KEYS[1], 'queued', 'EX', ARGV[2])
+return redis.call('XADD', KEYS[2], '*', 'order', ARGV[1])
+"""
+
+# KEYS: delayed, stream; ARGV: agora -> quantos retries voltaram para o stream
+_PROMOTE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 50)
+for _, raw in ipairs(due) do
+    redis.call('ZREM', KEYS[1], raw)
+    redis.call('XADD', KEYS[2], '*', 'order', raw)
+end
+return #due
+"""
+
+_consumer: Optional[threading.Thread] = None
+_consumer_lock = threading.Lock()
+_stop = threading.Event()
+_audit_buffer: List[Dict[str, Any]] = []
+_audit_lock = threading.Lock()
+_audit_flushed_at = time.monotonic()
+
+
+def order_idem_key(idem: str) -> str:
+    return f"order:idem:{idem}"
+
+
+def order_idempotency_key(telefone: str, payload: Dict[str, Any], session_id: str = "") -> str:
+    """Telefone + sessão do pedido + hash do payload em forma canônica (ordem dos itens indiferente)."""
+    canonical = {k: v for k, v in payload.items() if k not in IDEM_EXCLUDED_FIELDS}
+    canonical["itens"] = sorted(json.dumps(i, sort_keys=True, ensure_ascii=False) for i in payload.get("itens") or [])
+    payload_hash = hashlib.sha1(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return hashlib.sha1(f"{normalize_phone(telefone)}:{session_id}:{payload_hash}".encode("utf-8")).hexdigest()[:20]
+
+
+def enqueue_order(telefone: str, payload: Dict[str, Any], total: float, session_id: str = "") -> Optional[Tuple[str, bool]]:
+    """
+    Grava o pedido no outbox: (chave de idempotência, duplicado). duplicado =
+    o mesmo pedido já estava na fila ou já foi enviado (nada novo gravado).
+    None = sem Redis / outbox desligado: o chamador envia direto
+    (comportamento antigo).
+    """
+    client = get_redis_client()
+    if not settings.order_outbox_enabled or client is None:
+        return None
+    idem = order_idempotency_key(telefone, payload, session_id)
+    order = json.dumps({
+        "idem": idem,
+        "telefone": normalize_phone(telefone),
+        "total": round(total, 2),
+        "payload": payload,
+        "attempts": 0,
+        "enqueued_at": time.time(),
+    }, ensure_ascii=False)
+    try:
+        _ensure_group(client)
+        script = registered_script(client, "order_outbox:enqueue", _ENQUEUE_LUA)
+        msg_id = script(keys=[order_idem_key(idem), STREAM_KEY], args=[order, settings.order_outbox_dedup_ttl])
+    except Exception as e:
+        logger.error(f"Erro ao gravar pedido de {telefone} no outbox: {e}")
+        return None
+    if msg_id:
+        metrics.incr("orders.outbox.enqueued")
+        logger.info(f"📮 Pedido de {telefone} no outbox ({idem})")
+    else:
+        metrics.incr("orders.outbox.dedup")
+        logger.info(f"📮 Pedido de {telefone} já estava no outbox ({idem}); ignorado")
+    start_consumer()
+    return idem, not msg_id
+
+
+def audit(entry: Dict[str, Any]) -> None:
+    """Acrescenta uma linha ao audit log (gravada em lote por flush_audit)."""
+    entry.setdefault("timestamp", datetime.now().isoformat())
+    with _audit_lock:
+        _audit_buffer.append(entry)
+
+
+def flush_audit(force: bool = True) -> int:
+    """Grava o lote pendente do audit log (um open/write). Retorna as linhas gravadas."""
+    global _audit_flushed_at
+    with _audit_lock:
+        if not _audit_buffer:
+            return 0
+        if not force and len(_audit_buffer) < AUDIT_BATCH and time.monotonic() - _audit_flushed_at < AUDIT_FLUSH_SECONDS:
+            return 0
+        batch = list(_audit_buffer)
+        _audit_buffer.clear()
+        _audit_flushed_at = time.monotonic()
+    try:
+        os.makedirs(os.path.dirname(AUDIT_PATH), exist_ok=True)
+        with open(AUDIT_PATH, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in batch))
+    except Exception as e:
+        logger.warning(f"⚠️ Falha no audit log ({len(batch)} linhas): {e}")
+        return 0
+    return len(batch)
+
+
+def _ensure_group(client) -> None:
+    try:
+        client.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _finish(client, msg_id: str, idem: str, state: Optional[str], retry: Optional[str] = None, delay: float = 0) -> None:
+    """ACK + remoção da mensagem, junto com o novo estado da idempotência ou o retry agendado."""
+    pipe = client.pipeline(transaction=True)
+    if state:
+        pipe.set(order_idem_key(idem), state, ex=settings.order_outbox_dedup_ttl)
+    if retry:
+        pipe.zadd(DELAYED_KEY, {retry: time.time() + delay})
+    pipe.xack(STREAM_KEY, GROUP, msg_id)
+    pipe.xdel(STREAM_KEY, msg_id)
+    pipe.execute()
+
+
+def _deliver(client, msg_id: str, fields: Dict[str, str]) -> None:
+    from tools.http_tools import enviar_pedido
+
+    try:
+        order = json.loads(fields.get("order") or "")
+    except ValueError:
+        logger.error(f"Mensagem inválida no outbox de pedidos ({msg_id}); descartada")
+        client.xack(STREAM_KEY, GROUP, msg_id)
+        client.xdel(STREAM_KEY, msg_id)
+        return
+
+    idem, telefone = order["idem"], order.get("telefone", "")
+    if client.get(order_idem_key(idem)) == "sent":
+        metrics.incr("orders.outbox.dedup")
+        _finish(client, msg_id, idem, None)
+        return
+
+    attempts = int(order.get("attempts", 0)) + 1
+    with metrics.timer("orders.outbox.deliver"):
+        ok, retryable, msg = enviar_pedido(order["payload"], idem)
+    entry = {"telefone": telefone, "idem": idem, "total": order.get("total"), "attempts": attempts}
+
+    if ok:
+        _finish(client, msg_id, idem, "sent")
+        metrics.incr("orders.outbox.sent")
+        metrics.observe("orders.outbox.latency", time.time() - order.get("enqueued_at", time.time()))
+        audit({**entry, "status": "sent", "resposta": msg})
+        logger.info(f"📦 Pedido de {telefone} entregue ao dashboard ({idem}, tentativa {attempts})")
+    elif retryable and attempts < settings.order_outbox_max_attempts:
+        delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+        retry = json.dumps({**order, "attempts": attempts}, ensure_ascii=False)
+        _finish(client, msg_id, idem, None, retry=retry, delay=delay)
+        metrics.incr("orders.outbox.retries")
+        audit({**entry, "status": "retry", "erro": msg, "retry_in": delay})
+        logger.warning(f"🔁 Pedido de {telefone} ({idem}): {msg} — nova tentativa em {delay}s")
+    else:
+        _finish(client, msg_id, idem, "failed")
+        metrics.incr("orders.outbox.failed")
+        audit({**entry, "status": "failed", "erro": msg, "payload": order["payload"]})
+        logger.critical(f"🚨 Pedido de {telefone} NÃO entregue ao dashboard após {attempts} tentativa(s): {msg}")
+        _alert_failed(order, msg)
+
+
+def _alert_failed(order: Dict[str, Any], erro: str) -> None:
+    """Pedido perdido: o cliente fica sabendo e o atendente recebe o resumo para lançar à mão."""
+    from tools.whatsapp_api import whatsapp
+
+    telefone = order.get("telefone", "")
+    payload = order.get("payload") or {}
+    try:
+        whatsapp.send_text(
+            telefone,
+            "⚠️ Tivemos um problema ao registrar seu pedido no sistema da loja. "
+            "Um atendente vai conferir e confirmar com você em instantes.",
+        )
+    except Exception as e:
+        logger.error(f"Erro ao avisar {telefone} da falha do pedido: {e}")
+    if not settings.order_failure_alert_phone:
+        return
+    itens = "\n".join(
+        f"- {i.get('quantidade')}x {i.get('nome_produto')} (R$ {float(i.get('preco_unitario') or 0):.2f})"
+        for i in payload.get("itens") or []
+    )
+    try:
+        whatsapp.send_text(
+            settings.order_failure_alert_phone,
+            f"🚨 Pedido NÃO chegou ao dashboard ({order.get('idem')}): {erro}\n"
+            f"Cliente: {payload.get('nome_cliente', '')} {telefone}\n"
+            f"Endereço: {payload.get('endereco', '')}\nPagamento: {payload.get('forma', '')}\n"
+            f"Total: R$ {float(order.get('total') or 0):.2f}\n{itens}",
+        )
+    except Exception as e:
+        logger.error(f"Erro ao alertar o atendente do pedido de {telefone}: {e}")
+
+
+def _run() -> None:
+    consumer = f"{socket.gethostname()}:{os.getpid()}"
+    last_claim = 0.0
+    logger.info(f"📮 Consumidor do outbox de pedidos iniciado ({consumer})")
+    while not _stop.is_set():
+        client = get_redis_client()
+        if client is None:
+            _stop.wait(5)
+            continue
+        try:
+            registered_script(client, "order_outbox:promote", _PROMOTE_LUA)(
+                keys=[DELAYED_KEY, STREAM_KEY], args=[time.time()]
+            )
+            # Alterações em pedidos já enviados (debounce do tools/order_sync)
+            order_sync.flush_due(client)
+            entries = []
+            if time.monotonic() - last_claim > CLAIM_IDLE_MS / 1000:
+                last_claim = time.monotonic()
+                claimed = client.xautoclaim(STREAM_KEY, GROUP, consumer, CLAIM_IDLE_MS, "0-0", count=10)
+                entries = claimed[1] if claimed and len(claimed) > 1 else []
+            if not entries:
+                resp = client.xreadgroup(GROUP, consumer, {STREAM_KEY: ">"}, count=10, block=READ_BLOCK_MS)
+                entries = resp[0][1] if resp else []
+            for msg_id, fields in entries:
+                if fields:  # XAUTOCLAIM devolve None para mensagens já apagadas
+                    _deliver(client, msg_id, fields)
+        except Exception as e:
+            if "NOGROUP" in str(e):
+                _ensure_group(client)
+                continue
+            logger.error(f"Erro no consumidor do outbox de pedidos: {e}")
+            _stop.wait(2)
+        finally:
+            flush_audit(force=False)
+    flush_audit()
+
+
+def start_consumer() -> bool:
+    """Sobe o consumidor (thread daemon, um por processo). False = sem Redis / desligado."""
+    global _consumer
+    if not settings.order_outbox_enabled:
+        return False
+    client = get_redis_client()
+    if client is None:
+        return False
+    with _consumer_lock:
+        if _consumer is not None and _consumer.is_alive():
+            return True
+        try:
+            _ensure_group(client)
+        except Exception as e:
+            logger.error(f"Erro ao criar o consumer group do outbox de pedidos: {e}")
+            return False
+        _stop.clear()
+        _consumer = threading.Thread(target=_run, name="order-outbox", daemon=True)
+        _consumer.start()
+    return True
+
+
+def stop_consumer(timeout: float = 5.0) -> None:
+    """Para o consumidor (termina a entrega em curso) e grava o audit pendente."""
+    _stop.set()
+    if _consumer is not None:
+        _consumer.join(timeout)
+    flush_audit()
+
+
+# Linhas de audit ainda no buffer não se perdem se o processo sair sem stop_consumer()
+atexit.register(flush_audit)
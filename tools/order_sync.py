@@ -0,0 +1,251 @@
+"""
+Sincronização de pedidos já enviados (debounce + diff)
+
+Antes, cada add/remove/alteração no carrinho de um pedido com status "sent"
+disparava overwrite_order() com o carrinho inteiro: 5 itens adicionados
+depois do checkout = 5 PUTs completos no dashboard.
+
+Agora a alteração só marca o pedido como sujo (order_sync:due, ZSET com o
+horário do flush; cada nova alteração empurra o horário). Depois de
+order_sync_quiet_ms sem alterações, o consumidor do outbox de pedidos faz um
+único flush:
+
+1. diff entre o carrinho atual e a base (order_sync:{tel} "base" = linhas
+   do envio ou da última sincronização): adicionadas / alteradas /
+   removidas. Diff vazio = nada vai para a API (ex: adicionou e removeu o
+   mesmo item). Tudo é comparado no formato do dashboard (nome_produto /
+   preco_unitario, o mesmo do checkout): o carrinho passa por
+   format_order_lines antes do diff, e só os campos da linha (LINE_FIELDS)
+   contam; campos extras do servidor (ex: id da linha) são preservados
+2. GET da cópia do servidor (com ETag, se a API mandar) e detecção de
+   conflito contra a cópia gravada no último PUT (order_sync:{tel}
+   "server"): linha que mudou no servidor (ex: ajuste do atendente) E no
+   carrinho -> vale o carrinho, conta order_sync.conflicts; linhas que só
+   o servidor mudou são preservadas
+3. PUT do resultado (diff aplicado sobre a cópia do servidor) com If-Match;
+   412 = o pedido mudou entre o GET e o PUT -> refaz uma vez
+
+A API do dashboard só tem GET/PUT do pedido completo, então o diff é
+aplicado aqui e o PUT leva o pedido resultante.
+"""
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+from config.settings import settings
+from config.logger import setup_logger
+from tools import metrics
+from tools.checkout import format_order_lines
+from tools.redis_tools import (
+    MODIFICATION_TTL,
+    get_cart_items,
+    get_order_session,
+    get_redis_client,
+    normalize_phone,
+    order_sync_key,
+    registered_script,
+)
+
+logger = setup_logger(__name__)
+
+DUE_KEY = "order_sync:due"
+SYNC_RETRY_SECONDS = 10  # API fora / pedido ainda no outbox: tenta de novo depois disso
+
+# KEYS: due; ARGV: agora -> telefones com flush vencido (retirados do ZSET)
+_CLAIM_DUE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 20)
+for _, phone in ipairs(due) do
+    redis.call('ZREM', KEYS[1], phone)
+end
+return due
+"""
+
+
+# Campos da linha que o carrinho controla; o resto (ids, status do atendente) é do servidor
+LINE_FIELDS = ("nome_produto", "quantidade", "preco_unitario", "observacao")
+
+
+def line_key(item: Dict[str, Any]) -> str:
+    """Identidade da linha (mesmo critério do carrinho: nome strip/lower)."""
+    return "p:" + str(item.get("nome_produto") or item.get("produto") or "").strip().lower()
+
+
+def _lines(items: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Linhas no formato do dashboard por line_key; linhas do carrinho (produto/preco) são convertidas."""
+    lines = {}
+    for item in items or []:
+        if not isinstance(item, dict):
+            continue
+        if "preco_unitario" not in item:
+            item = format_order_lines([item])[0][0]
+        lines[line_key(item)] = item
+    return lines
+
+
+def same_line(a: Optional[Dict[str, Any]], b: Optional[Dict[str, Any]]) -> bool:
+    """Mesma linha para o pedido (compara só LINE_FIELDS; None = linha ausente)."""
+    if a is None or b is None:
+        return a is b
+    return all((a.get(f) or "") == (b.get(f) or "") for f in LINE_FIELDS)
+
+
+def diff_lines(base: Dict[str, Dict], local: Dict[str, Dict]) -> Dict[str, Any]:
+    """{"added": {k: linha}, "changed": {k: linha}, "removed": [k]} do carrinho em relação à base."""
+    return {
+        "added": {k: v for k, v in local.items() if k not in base},
+        "changed": {k: v for k, v in local.items() if k in base and not same_line(base[k], v)},
+        "removed": [k for k in base if k not in local],
+    }
+
+
+def _is_empty(diff: Dict[str, Any]) -> bool:
+    return not (diff["added"] or diff["changed"] or diff["removed"])
+
+
+def mark_dirty(telefone: str) -> bool:
+    """Agenda (ou adia) o flush do pedido. False = sync desligado ou sem Redis."""
+    client = get_redis_client()
+    if client is None or settings.order_sync_quiet_ms <= 0 or not settings.order_outbox_enabled:
+        return False
+    from tools import order_outbox
+
+    try:
+        client.zadd(DUE_KEY, {normalize_phone(telefone): time.time() + settings.order_sync_quiet_ms / 1000})
+    except Exception as e:
+        logger.error(f"Erro ao agendar sync do pedido de {telefone}: {e}")
+        return False
+    metrics.incr("order_sync.marked")
+    return order_outbox.start_consumer()
+
+
+def _reschedule(client, telefone: str) -> None:
+    try:
+        client.zadd(DUE_KEY, {telefone: time.time() + SYNC_RETRY_SECONDS}, nx=True)
+    except Exception as e:
+        logger.error(f"Erro ao reagendar sync do pedido de {telefone}: {e}")
+
+
+def _save_base(client, telefone: str, local: Dict[str, Dict], server: Optional[Dict[str, Dict]] = None) -> None:
+    key = order_sync_key(telefone)
+    mapping = {"base": json.dumps(local, ensure_ascii=False)}
+    if server is not None:
+        mapping["server"] = json.dumps(server, ensure_ascii=False)
+    pipe = client.pipeline(transaction=False)
+    if server is None:
+        pipe.hdel(key, "server")
+    pipe.hset(key, mapping=mapping)
+    pipe.expire(key, MODIFICATION_TTL)
+    pipe.execute()
+
+
+def reset_base(telefone: str) -> None:
+    """Pedido recém-enviado: o carrinho atual vira a base do diff (alterações do atendente ficam preservadas)."""
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        _save_base(client, normalize_phone(telefone), _lines(get_cart_items(telefone)))
+    except Exception as e:
+        logger.error(f"Erro ao gravar base do sync do pedido de {telefone}: {e}")
+
+
+def flush_order(telefone: str) -> str:
+    """
+    Sincroniza um pedido: "clean" (nada a enviar), "synced", "deferred"
+    (reagendado), "dropped" (pedido não está mais em alteração ou a entrega
+    pelo outbox falhou) ou "error".
+    """
+    from tools.http_tools import buscar_pedido, gravar_pedido
+    from tools.order_outbox import order_idem_key
+
+    client = get_redis_client()
+    if client is None:
+        return "error"
+    telefone = normalize_phone(telefone)
+    session = get_order_session(telefone)
+    if not session or session.get("status") != "sent":
+        client.delete(order_sync_key(telefone))
+        return "dropped"
+
+    # Pedido ainda no outbox: o dashboard nem tem a cópia; espera a entrega.
+    # Entrega que falhou de vez: não há cópia para sincronizar (o atendente já foi avisado)
+    order_id = str(session.get("order_id") or "")
+    if order_id.startswith("outbox:"):
+        state = client.get(order_idem_key(order_id[len("outbox:"):]))
+        if state == "queued":
+            _reschedule(client, telefone)
+            return "deferred"
+        if state == "failed":
+            client.delete(order_sync_key(telefone))
+            metrics.incr("order_sync.dropped_failed")
+            return "dropped"
+
+    local = _lines(get_cart_items(telefone))
+    raw_base, raw_server = client.hmget(order_sync_key(telefone), ["base", "server"])
+    # _lines de novo: bases gravadas antes no formato do carrinho são convertidas
+    base: Optional[Dict[str, Dict]] = _lines(json.loads(raw_base).values()) if raw_base else None
+    last_written: Optional[Dict[str, Dict]] = _lines(json.loads(raw_server).values()) if raw_server else None
+    if base is not None and _is_empty(diff_lines(base, local)):
+        metrics.incr("order_sync.clean")
+        return "clean"
+
+    try:
+        for attempt in range(2):
+            server, etag = buscar_pedido(telefone)
+            if server is None:
+                logger.warning(f"⚠️ Pedido de {telefone} não encontrado no dashboard; sync reagendado")
+                _reschedule(client, telefone)
+                return "deferred"
+            server_lines = _lines(server.get("itens", server.get("items", [])))
+            # Sem base (pedido enviado antes do order_sync): a cópia do servidor é a base
+            reference = server_lines if base is None else base
+            diff = diff_lines(reference, local)
+            if _is_empty(diff):
+                _save_base(client, telefone, local, server_lines)
+                metrics.incr("order_sync.clean")
+                return "clean"
+
+            touched = list(diff["added"]) + list(diff["changed"]) + diff["removed"]
+            # Sem cópia do último PUT (primeiro sync) não há como saber o que o atendente mudou
+            conflicts = [
+                k for k in touched
+                if last_written is not None and not same_line(server_lines.get(k), last_written.get(k))
+            ]
+            if conflicts:
+                metrics.incr("order_sync.conflicts", len(conflicts))
+                logger.warning(f"⚠️ Pedido de {telefone}: {len(conflicts)} linha(s) alteradas também no dashboard; vale o carrinho")
+
+            merged = dict(server_lines)
+            merged.update(diff["added"])
+            for k, line in diff["changed"].items():
+                merged[k] = {**server_lines.get(k, {}), **line}
+            for k in diff["removed"]:
+                merged.pop(k, None)
+
+            with metrics.timer("order_sync.flush"):
+                resp = gravar_pedido(telefone, {"itens": list(merged.values())}, etag)
+            if resp.status_code == 412 and attempt == 0:
+                metrics.incr("order_sync.precondition_failed")
+                continue
+            resp.raise_for_status()
+            _save_base(client, telefone, local, merged)
+            metrics.incr("order_sync.flushes")
+            metrics.incr("order_sync.lines_sent", len(touched))
+            logger.info(
+                f"🔄 Pedido de {telefone} sincronizado: +{len(diff['added'])} ~{len(diff['changed'])} "
+                f"-{len(diff['removed'])} (total {len(merged)} itens)"
+            )
+            return "synced"
+    except Exception as e:
+        logger.error(f"❌ Falha ao sincronizar pedido de {telefone}: {e}")
+    _reschedule(client, telefone)
+    metrics.incr("order_sync.errors")
+    return "error"
+
+
+def flush_due(client) -> int:
+    """Faz o flush dos pedidos cujo período de silêncio acabou (chamado pelo consumidor do outbox)."""
+    phones = registered_script(client, "order_sync:claim", _CLAIM_DUE_LUA)(keys=[DUE_KEY], args=[time.time()])
+    for telefone in phones or []:
+        flush_order(telefone)
+    return len(phones or [])
@@ -0,0 +1,538 @@
+"""
+Despacho de mensagens de saída (respostas do agente -> UAZAPI)
+
+O worker não envia mais a resposta dentro do slot do job: monta as partes
+(textos e imagens, com os intervalos entre elas) e entrega ao despachante,
+liberando o slot na hora. A coreografia "humana" do turno (lendo -> azul ->
+digitando -> resposta) também é agendada aqui: os atrasos viram timers no
+event loop do despachante em vez de sleeps dentro do job.
+
+- outbox:{tel}        LIST de respostas JSON {"parts": [...], "ts"} (ordem do chat);
+                      partes: text, image, read (confirmação de leitura) e presence,
+                      cada uma com "delay" (relativo) ou "at" (horário absoluto)
+- outbox:{tel}:lock   dono do escoamento do telefone (um por vez, entre processos)
+- outbox:ready        LIST de telefones com resposta nova (acorda o despachante via BLPOP)
+- outbox:pending      SET de telefones com fila não vazia (varredura após queda de processo)
+- outbox:bucket       token bucket global (settings.uazapi_rate_per_sec / uazapi_rate_burst)
+
+Cada telefone é escoado por uma única task, resposta a resposta, então a
+ordem das mensagens no chat é garantida. As imagens de uma resposta são
+buscadas em paralelo (tools/image_cache: disco ou download) enquanto o texto
+é enviado. Entrega "no máximo uma
+vez": uma resposta retirada da fila por um processo que morre no meio do
+envio não é reenviada (evita mensagens duplicadas para o cliente).
+"""
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Set
+
+from config.settings import settings
+from config.logger import setup_logger
+from tools import image_cache, metrics
+from tools.redis_async import get_async_redis_client
+from tools.redis_tools import LOCK_WAIT_SLICE, get_redis_client, normalize_phone, registered_script
+
+logger = setup_logger(__name__)
+
+READY_KEY = "outbox:ready"
+PENDING_KEY = "outbox:pending"
+BUCKET_KEY = "outbox:bucket"
+OUTBOX_TTL = 3600  # Resposta parada há 1h não faz mais sentido enviar
+DRAIN_LOCK_MS = 30000  # Renovado a cada parte enviada
+SWEEP_INTERVAL = 30  # Varredura de outbox:pending (telefones sem dono após queda)
+MAX_CHUNK_LEN = 500
+PRESENCE_HOLD = 4.5  # A UAZAPI mantém a presença por 5s (delay=5000): repetir antes disso é redundante
+SIGNALS_IDLE = 600  # Estado de leitura/presença por chat guardado por 10 min sem uso
+
+IMAGE_URL_RE = re.compile(r'(https?://[^\s]+\.(?:jpg|jpeg|png|webp))', re.IGNORECASE)
+
+# KEYS: outbox:{tel}, ready, pending; ARGV: resposta, telefone, ttl
+_ENQUEUE_LUA = """
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SADD', KEYS[3], ARGV[2])
+redis.call('RPUSH', KEYS[2], ARGV[2])
+return 1
+"""
+
+# KEYS: lock, outbox:{tel}, ready, pending; ARGV: token, telefone
+# Libera o escoamento; se algo chegou nesse meio tempo, reacorda o despachante
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+if redis.call('LLEN', KEYS[2]) > 0 then
+    redis.call('RPUSH', KEYS[3], ARGV[2])
+else
+    redis.call('SREM', KEYS[4], ARGV[2])
+end
+return 1
+"""
+
+# KEYS: lock; ARGV: token, px -> 1 se ainda é o dono
+_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: bucket; ARGV: agora_ms, taxa/s, capacidade -> ms a esperar (0 = token consumido)
+_TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cap = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or cap
+local ts = tonumber(state[2]) or now
+tokens = math.min(cap, tokens + math.max(0, now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(cap * 1000 / rate) + 1000)
+return wait
+"""
+
+
+def outbox_key(telefone: str) -> str:
+    return f"outbox:{normalize_phone(telefone)}"
+
+
+def _lock_key(telefone: str) -> str:
+    return f"{outbox_key(telefone)}:lock"
+
+
+def _split_text(mensagem: str, max_len: int = MAX_CHUNK_LEN) -> List[str]:
+    """Divide por parágrafos (e por linhas, se o parágrafo for grande demais)."""
+    if len(mensagem) <= max_len:
+        return [mensagem]
+    msgs = []
+    curr = ""
+    for p in mensagem.split('\n\n'):
+        if len(p) > max_len:
+            if curr:
+                msgs.append(curr.strip())
+                curr = ""
+            for linha in p.split('\n'):
+                if len(curr) + len(linha) + 1 <= max_len:
+                    curr += linha + "\n"
+                else:
+                    if curr: msgs.append(curr.strip())
+                    curr = linha + "\n"
+        elif len(curr) + len(p) + 2 <= max_len:
+            curr += p + "\n\n"
+        else:
+            if curr: msgs.append(curr.strip())
+            curr = p + "\n\n"
+    if curr: msgs.append(curr.strip())
+    return msgs
+
+
+def human_delay(low: float, high: Optional[float] = None) -> float:
+    """Pausa "humana" entre eventos do chat (0 no modo rápido: settings.outbound_fast_mode)."""
+    if settings.outbound_fast_mode:
+        return 0.0
+    return round(random.uniform(low, high) if high is not None else low, 2)
+
+
+def build_reply_parts(mensagem: str, max_len: int = MAX_CHUNK_LEN) -> List[Dict]:
+    """
+    Partes de uma resposta, em ordem: {"type": "text"|"image", "text"/"url", "delay"}.
+    delay = segundos de espera antes da parte (ritmo "humano" entre mensagens).
+    Com URLs de imagem: o texto sem os links vai primeiro, depois cada imagem.
+    """
+    urls = IMAGE_URL_RE.findall(mensagem)
+    if not urls:
+        chunks = _split_text(mensagem, max_len)
+        return [
+            {"type": "text", "text": chunk, "delay": 0.0 if i == 0 else human_delay(0.8, 1.5)}
+            for i, chunk in enumerate(chunks)
+        ]
+
+    # Texto limpo: remove todos os links para não ficar redundante no WhatsApp
+    texto_limpo = mensagem
+    for url in urls:
+        texto_limpo = re.sub(re.escape(url) + r'[\s\n]*', '', texto_limpo).strip()
+    logger.info(f"📸 Detectadas {len(urls)} URLs de imagem. Texto limpo: {texto_limpo[:50]}...")
+
+    parts = [{"type": "text", "text": texto_limpo, "delay": 0.0}] if texto_limpo else []
+    for i, url in enumerate(urls):
+        # 1s para o texto chegar primeiro; 1.2s entre imagens
+        delay = (human_delay(1.0) if parts else 0.0) if i == 0 else human_delay(1.2)
+        parts.append({"type": "image", "url": url, "delay": delay})
+    return parts
+
+
+def opening_timeline(mids: List[str], started_at: Optional[float] = None) -> List[Dict]:
+    """
+    Coreografia do início do turno, em horários absolutos ("at"): "lendo" por 2-4s,
+    confirmação de leitura (azul) e, 0.8s depois, "digitando". O agente roda em
+    paralelo; a resposta entra na mesma fila do telefone e só sai depois disto.
+    """
+    read_at = (started_at or time.time()) + human_delay(2.0, 4.0)
+    parts = [{"type": "read", "mids": mids, "at": read_at}] if mids else []
+    parts.append({"type": "presence", "presence": "composing", "at": read_at + (human_delay(0.8) if mids else 0.0)})
+    return parts
+
+
+def reply_timeline(mensagem: str, typing_from: Optional[float] = None) -> List[Dict]:
+    """
+    Fim do turno: para de "digitar", pausa curta e as partes da resposta.
+    typing_from = horário do "digitando" da abertura; se o agente respondeu antes
+    disso, o "digitando" ainda fica visível por 1.5-3s antes da resposta.
+    """
+    parts = build_reply_parts(mensagem)
+    if parts:
+        parts[0]["delay"] = human_delay(0.5)
+    paused = {"type": "presence", "presence": "paused"}
+    if typing_from is not None:
+        paused["at"] = typing_from + human_delay(1.5, 3.0)
+    return [paused] + parts
+
+
+async def enqueue_parts(telefone: str, parts: List[Dict]) -> bool:
+    """Agenda eventos no despachante. False = sem Redis/desligado (o chamador executa direto)."""
+    if not settings.outbound_dispatcher or not parts:
+        return False
+    client = await get_async_redis_client()
+    if client is None:
+        return False
+    payload = json.dumps({"parts": parts, "ts": time.time()}, ensure_ascii=False)
+    telefone = normalize_phone(telefone)
+    try:
+        script = registered_script(client, "outbound:enqueue", _ENQUEUE_LUA)
+        await script(keys=[outbox_key(telefone), READY_KEY, PENDING_KEY], args=[payload, telefone, OUTBOX_TTL])
+    except Exception as e:
+        logger.error(f"Erro ao enfileirar resposta de {telefone}: {e}")
+        return False
+    metrics.incr("outbound.enqueued")
+    return True
+
+
+async def enqueue_reply(telefone: str, mensagem: str, typing_from: Optional[float] = None) -> bool:
+    """Entrega a resposta (com o "paused" antes) ao despachante."""
+    if not mensagem:
+        return False
+    return await enqueue_parts(telefone, reply_timeline(mensagem, typing_from))
+
+
+async def _take_token(client) -> None:
+    """Espera um token do bucket global (limite de envios/s da UAZAPI)."""
+    if client is None or settings.uazapi_rate_per_sec <= 0:
+        return
+    script = registered_script(client, "outbound:bucket", _TOKEN_BUCKET_LUA)
+    waited = 0.0
+    while True:
+        try:
+            wait_ms = await script(
+                keys=[BUCKET_KEY],
+                args=[int(time.time() * 1000), settings.uazapi_rate_per_sec, max(1, settings.uazapi_rate_burst)],
+            )
+        except Exception as e:
+            logger.debug(f"Token bucket indisponível: {e}")
+            return
+        if not wait_ms:
+            break
+        waited += wait_ms / 1000
+        await asyncio.sleep(wait_ms / 1000)
+    if waited:
+        metrics.observe("outbound.rate_limited_wait", waited)
+
+
+class ChatSignals:
+    """
+    Confirmações de leitura e presença de um chat, coalescidas:
+    - leituras que chegam dentro de settings.uazapi_coalesce_window_ms viram UM
+      /message/markread com a lista de IDs (IDs já confirmados são ignorados)
+    - presença repetida (composing -> composing dentro de PRESENCE_HOLD, ou
+      paused -> paused) não é reenviada
+    As leituras pendentes são enviadas antes de qualquer outro evento do chat,
+    para o azul nunca chegar depois da resposta.
+    """
+
+    def __init__(self, api, telefone: str):
+        self.api = api
+        self.telefone = telefone
+        self.last_used = time.monotonic()
+        self._pending: List[str] = []
+        self._confirmed: Deque[str] = deque(maxlen=200)
+        self._flush_task: Optional[asyncio.Task] = None
+        self._presence: Optional[str] = None
+        self._presence_at = 0.0
+        self.calls = 0
+        self.saved = 0
+
+    async def read(self, mids: List[str]) -> None:
+        self.last_used = time.monotonic()
+        novos = [m for m in dict.fromkeys(mids) if m not in self._confirmed and m not in self._pending]
+        self.saved += len(mids) - len(novos)  # Antes: um POST por ID, mesmo repetido
+        self._pending.extend(novos)
+        if self._pending and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(settings.uazapi_coalesce_window_ms / 1000)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Envia as leituras pendentes (um único POST)."""
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+            self._flush_task = None
+        if not self._pending:
+            return
+        mids, self._pending = self._pending, []
+        self.calls += 1
+        self.saved += len(mids) - 1
+        if await self.api.mark_as_read(self.telefone, message_id=mids):
+            self._confirmed.extend(mids)
+
+    async def presence(self, presence: str) -> None:
+        self.last_used = time.monotonic()
+        await self.flush()
+        now = time.monotonic()
+        if presence == self._presence and (presence == "paused" or now - self._presence_at < PRESENCE_HOLD):
+            self.saved += 1
+            return
+        self.calls += 1
+        if await self.api.send_presence(self.telefone, presence):
+            self._presence, self._presence_at = presence, now
+
+    async def before_message(self) -> None:
+        """Antes de texto/mídia: leituras primeiro. O envio (presence=true) mostra "digitando" e termina parado."""
+        self.last_used = time.monotonic()
+        await self.flush()
+        self._presence, self._presence_at = "paused", time.monotonic()
+
+    def end_turn(self) -> None:
+        """Fim do turno (resposta enviada): registra as chamadas poupadas."""
+        metrics.incr("uazapi.calls_saved", self.saved)
+        metrics.record("uazapi.calls_saved_per_turn", self.saved)
+        metrics.record("uazapi.signal_calls_per_turn", self.calls)
+        self.calls = self.saved = 0
+
+
+async def deliver_reply(api, telefone: str, parts: List[Dict], client=None, on_progress=None,
+                        signals: Optional[ChatSignals] = None) -> bool:
+    """
+    Envia as partes em ordem. As imagens são buscadas todas em paralelo logo no
+    início (cache em disco ou download, enquanto o texto sai); cada envio
+    consome um token do bucket global.
+    """
+    downloads = {
+        i: asyncio.create_task(image_cache.aget_image(part["url"]))
+        for i, part in enumerate(parts) if part.get("type") == "image"
+    }
+    local_signals = signals is None
+    if local_signals:
+        signals = ChatSignals(api, telefone)
+    ok = True
+    delivered = False
+    try:
+        for i, part in enumerate(parts):
+            wait = max(part.get("delay") or 0.0, (part.get("at") or 0.0) - time.time())
+            if wait > 0:
+                await asyncio.sleep(wait)
+            kind = part.get("type")
+            if kind == "presence":
+                await signals.presence(part.get("presence", "paused"))
+                continue
+            if kind == "read":
+                await signals.read(part.get("mids") or [])
+                continue
+            await signals.before_message()
+            await _take_token(client)
+            if kind == "image":
+                baixada = await downloads[i]
+                if baixada is not None:
+                    img_b64, mime = baixada
+                    sent = await api.send_media(telefone, caption="", base64_data=img_b64, mimetype=mime)
+                else:
+                    sent = False
+                if not sent:
+                    # Fallback: Tentar enviar via URL
+                    sent = await api.send_media(telefone, media_url=part["url"], caption="")
+            else:
+                sent = await api.send_text(telefone, part.get("text", ""))
+            ok = ok and sent
+            delivered = True
+            metrics.incr("outbound.parts_sent" if sent else "outbound.parts_failed")
+            if on_progress is not None:
+                await on_progress()
+        if local_signals:
+            await signals.flush()
+        if delivered:
+            signals.end_turn()
+    except Exception as e:
+        logger.error(f"❌ Erro ao enviar resposta para {telefone}: {e}")
+        ok = False
+    finally:
+        for task in downloads.values():
+            task.cancel()
+    return ok
+
+
+def deliver_reply_sync(api, telefone: str, parts: List[Dict]) -> bool:
+    """
+    Versão síncrona de deliver_reply (fallback do server sem ARQ): mesmo ritmo,
+    imagens buscadas em paralelo em threads (cache em disco ou Session compartilhada).
+    """
+    client = get_redis_client()
+    bucket = registered_script(client, "outbound:bucket", _TOKEN_BUCKET_LUA) if client is not None else None
+    images = [(i, part["url"]) for i, part in enumerate(parts) if part.get("type") == "image"]
+    ok = True
+    with ThreadPoolExecutor(max_workers=max(1, min(4, len(images)))) as pool:
+        downloads = {i: pool.submit(image_cache.get_image, url) for i, url in images}
+        try:
+            for i, part in enumerate(parts):
+                if part.get("delay"):
+                    time.sleep(part["delay"])
+                while bucket is not None and settings.uazapi_rate_per_sec > 0:
+                    try:
+                        wait_ms = bucket(
+                            keys=[BUCKET_KEY],
+                            args=[int(time.time() * 1000), settings.uazapi_rate_per_sec, max(1, settings.uazapi_rate_burst)],
+                        )
+                    except Exception:
+                        break
+                    if not wait_ms:
+                        break
+                    time.sleep(wait_ms / 1000)
+                if part.get("type") == "image":
+                    baixada = downloads[i].result()
+                    sent = False
+                    if baixada is not None:
+                        img_b64, mime = baixada
+                        sent = api.send_media(telefone, caption="", base64_data=img_b64, mimetype=mime)
+                    if not sent:
+                        # Fallback: Tentar enviar via URL
+                        sent = api.send_media(telefone, media_url=part["url"], caption="")
+                else:
+                    sent = api.send_text(telefone, part.get("text", ""))
+                ok = ok and sent
+                metrics.incr("outbound.parts_sent" if sent else "outbound.parts_failed")
+        except Exception as e:
+            logger.error(f"❌ Erro ao enviar resposta para {telefone}: {e}")
+            ok = False
+        finally:
+            for fut in downloads.values():
+                fut.cancel()
+    return ok
+
+
+class OutboundDispatcher:
+    """Escoa outbox:{tel} de cada telefone (uma task por telefone) dentro do event loop do worker."""
+
+    def __init__(self, api):
+        self.api = api
+        self._draining: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._runner: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._signals: Dict[str, ChatSignals] = {}
+
+    def start(self) -> None:
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+            logger.info("📮 Despachante de mensagens iniciado")
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Para de aceitar telefones novos e espera os envios em curso (até timeout)."""
+        self._stopping = True
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+
+    async def _run(self) -> None:
+        last_sweep = 0.0
+        while not self._stopping:
+            client = await get_async_redis_client()
+            if client is None:
+                await asyncio.sleep(LOCK_WAIT_SLICE)
+                continue
+            try:
+                if time.monotonic() - last_sweep > SWEEP_INTERVAL:
+                    last_sweep = time.monotonic()
+                    self._prune_signals()
+                    for telefone in await client.smembers(PENDING_KEY):
+                        self._spawn(telefone)
+                item = await client.blpop(READY_KEY, timeout=LOCK_WAIT_SLICE)
+                if item:
+                    self._spawn(item[1])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Erro no despachante de mensagens: {e}")
+                await asyncio.sleep(1)
+
+    def _signals_for(self, telefone: str) -> ChatSignals:
+        signals = self._signals.get(telefone)
+        if signals is None:
+            signals = self._signals[telefone] = ChatSignals(self.api, telefone)
+        return signals
+
+    def _prune_signals(self) -> None:
+        """Esquece o estado de presença/leitura dos chats parados há mais de SIGNALS_IDLE."""
+        cutoff = time.monotonic() - SIGNALS_IDLE
+        for telefone in [t for t, sig in self._signals.items() if sig.last_used < cutoff and t not in self._draining]:
+            del self._signals[telefone]
+
+    def _spawn(self, telefone: str) -> None:
+        if telefone in self._draining:
+            return  # A task atual pega a resposta nova antes de terminar
+        self._draining.add(telefone)
+        task = asyncio.create_task(self._drain(telefone))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, telefone: str) -> None:
+        client = await get_async_redis_client()
+        token = uuid.uuid4().hex
+        lock = _lock_key(telefone)
+        acquired = False
+        try:
+            if client is None or not await client.set(lock, token, nx=True, px=DRAIN_LOCK_MS):
+                return  # Outro processo está escoando este telefone (e reacorda ao liberar)
+            acquired = True
+            renew = registered_script(client, "outbound:renew", _RENEW_LUA)
+
+            async def _renew():
+                await renew(keys=[lock], args=[token, DRAIN_LOCK_MS])
+
+            while True:
+                raw = await client.lpop(outbox_key(telefone))
+                if raw is None:
+                    break
+                try:
+                    reply = json.loads(raw)
+                except ValueError:
+                    continue
+                metrics.observe("outbound.queue_wait", max(0.0, time.time() - reply.get("ts", time.time())))
+                with metrics.timer("outbound.delivery"):
+                    await deliver_reply(
+                        self.api, telefone, reply.get("parts", []), client, _renew, self._signals_for(telefone)
+                    )
+                await _renew()
+        except Exception as e:
+            logger.error(f"❌ Erro ao escoar mensagens de {telefone}: {e}")
+        finally:
+            self._draining.discard(telefone)
+            if acquired:
+                try:
+                    release = registered_script(client, "outbound:release", _RELEASE_LUA)
+                    await release(keys=[lock, outbox_key(telefone), READY_KEY, PENDING_KEY], args=[token, telefone])
+                except Exception as e:
+                    logger.error(f"Erro ao liberar escoamento de {telefone}: {e}")
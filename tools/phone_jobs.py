@@ -0,0 +1,186 @@
+"""
+Serialização de jobs por telefone na fila ARQ
+
+No máximo um job por telefone fica na fila/executando. Mensagens que chegam
+enquanto isso são estacionadas numa lista por telefone (sem ocupar slot do
+worker) e:
+- se o job ainda está na fila: são incorporadas a ele quando começa (start_job)
+- se o job já está rodando: viram UM novo job encadeado no fim (finish_job)
+
+Chaves:
+- jobq:{tel}         HASH {state: queued|running}, TTL = job_timeout + folga
+- jobq:{tel}:parked  LIST de payloads JSON {"text", "mids"}
+
+Os outros telefones não são afetados: max_jobs do worker continua inteiro
+para clientes diferentes.
+
+Preempção: cada mensagem estacionada incrementa jobq:{tel}.gen. O job guarda a
+geração em que começou (start_job) e o agente consulta current_generation()
+entre os passos do ReAct e antes de enviar; se avançou, o turno é refeito uma
+vez com as mensagens novas.
+"""
+import json
+from typing import List, Optional, Tuple
+
+from config.logger import setup_logger
+from tools import metrics
+from tools.redis_async import get_async_redis_client
+from tools.redis_tools import get_redis_client, normalize_phone, registered_script
+
+logger = setup_logger(__name__)
+
+PHONE_JOB_TTL = 600 + 60  # job_timeout do worker + folga (chave some se o worker morrer)
+
+# KEYS: estado, parked; ARGV: payload, ttl -> "claimed" (pode enfileirar) ou estado atual
+_CLAIM_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    redis.call('HINCRBY', KEYS[1], 'gen', 1)
+    return redis.call('HGET', KEYS[1], 'state') or 'queued'
+end
+redis.call('HSET', KEYS[1], 'state', 'queued')
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 'claimed'
+"""
+
+# KEYS: estado, parked; ARGV: ttl -> {geração atual, payloads estacionados (incorporados ao job)}
+_START_LUA = """
+redis.call('HSET', KEYS[1], 'state', 'running')
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+return {redis.call('HGET', KEYS[1], 'gen') or '0', items}
+"""
+
+# KEYS: estado, parked; ARGV: ttl -> payloads para o job encadeado (vazio = telefone liberado)
+_FINISH_LUA = """
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+if #items > 0 then
+    redis.call('HSET', KEYS[1], 'state', 'queued')
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+else
+    redis.call('DEL', KEYS[1])
+end
+return items
+"""
+
+
+def phone_job_keys(telefone: str) -> List[str]:
+    telefone = normalize_phone(telefone)
+    return [f"jobq:{telefone}", f"jobq:{telefone}:parked"]
+
+
+def as_mid_list(message_id) -> List[str]:
+    if not message_id:
+        return []
+    return [m for m in (message_id if isinstance(message_id, list) else [message_id]) if m]
+
+
+def merge_payloads(mensagem: str, mids: List[str], items: List[str]) -> Tuple[str, List[str]]:
+    """Junta os textos estacionados ao texto do job (mesmo separador do buffer: " | ")."""
+    texts = [mensagem] if mensagem else []
+    mids = list(mids)
+    for raw in items:
+        try:
+            payload = json.loads(raw)
+        except Exception:
+            continue
+        if payload.get("text"):
+            texts.append(payload["text"])
+        mids.extend(as_mid_list(payload.get("mids")))
+    return " | ".join(texts), mids
+
+
+async def claim_or_park(telefone: str, mensagem: str, message_id=None) -> bool:
+    """
+    True = nenhum job do telefone na fila/executando: o chamador deve enfileirar.
+    False = mensagem estacionada (será incorporada ao job pendente ou encadeada).
+    Sem Redis, sempre True (comportamento antigo).
+    """
+    client = await get_async_redis_client()
+    if client is None:
+        return True
+    payload = json.dumps({"text": mensagem, "mids": as_mid_list(message_id)}, ensure_ascii=False)
+    try:
+        script = registered_script(client, "phone_jobs:claim", _CLAIM_LUA)
+        state = await script(keys=phone_job_keys(telefone), args=[payload, PHONE_JOB_TTL])
+    except Exception as e:
+        logger.error(f"Erro ao reservar job de {telefone}: {e}")
+        return True
+    if state == "claimed":
+        return True
+    metrics.incr(f"jobs.parked.{state}")
+    logger.info(f"🅿️ Mensagem de {telefone} estacionada (job {state})")
+    return False
+
+
+async def start_job(telefone: str, mensagem: str, message_id=None) -> Tuple[str, List[str], List[str], Optional[int]]:
+    """
+    Marca o job como em execução e incorpora o que foi estacionado enquanto estava na fila.
+    Retorna (texto, mids, payloads_incorporados, geração); os payloads voltam para a fila
+    via unpark() se o job falhar e o ARQ for tentar de novo (o retry recebe os args originais).
+    Geração None = sem Redis (preempção desligada).
+    """
+    mids = as_mid_list(message_id)
+    client = await get_async_redis_client()
+    if client is None:
+        return mensagem, mids, [], None
+    try:
+        script = registered_script(client, "phone_jobs:start", _START_LUA)
+        gen, items = await script(keys=phone_job_keys(telefone), args=[PHONE_JOB_TTL])
+    except Exception as e:
+        logger.error(f"Erro ao iniciar job de {telefone}: {e}")
+        return mensagem, mids, [], None
+    if items:
+        metrics.incr("jobs.merged", len(items))
+        logger.info(f"🧩 {len(items)} mensagem(ns) incorporada(s) ao job de {telefone}")
+    texto, mids = merge_payloads(mensagem, mids, items)
+    return texto, mids, list(items or []), int(gen or 0)
+
+
+def current_generation(telefone: str) -> int:
+    """Geração atual do telefone (síncrono: chamado do agente, que roda em thread)."""
+    client = get_redis_client()
+    if client is None:
+        return 0
+    try:
+        return int(client.hget(phone_job_keys(telefone)[0], "gen") or 0)
+    except Exception:
+        return 0
+
+
+async def unpark(telefone: str, items: List[str]) -> None:
+    """Devolve payloads incorporados para o início da fila estacionada (mesma ordem)."""
+    client = await get_async_redis_client()
+    if client is None or not items:
+        return
+    try:
+        parked = phone_job_keys(telefone)[1]
+        pipe = client.pipeline(transaction=True)
+        pipe.lpush(parked, *reversed(items))
+        pipe.expire(parked, PHONE_JOB_TTL)
+        await pipe.execute()
+    except Exception as e:
+        logger.error(f"Erro ao devolver mensagens estacionadas de {telefone}: {e}")
+
+
+async def finish_job(telefone: str) -> Optional[Tuple[str, List[str]]]:
+    """
+    Fim do job: libera o telefone ou devolve (texto, mids) para UM job encadeado
+    com tudo que chegou durante a execução.
+    """
+    client = await get_async_redis_client()
+    if client is None:
+        return None
+    try:
+        script = registered_script(client, "phone_jobs:finish", _FINISH_LUA)
+        items = await script(keys=phone_job_keys(telefone), args=[PHONE_JOB_TTL])
+    except Exception as e:
+        logger.error(f"Erro ao finalizar job de {telefone}: {e}")
+        return None
+    if not items:
+        return None
+    metrics.incr("jobs.chained")
+    return merge_payloads("", [], items)
@@ -0,0 +1,232 @@
+"""
+Cliente Redis assíncrono (redis.asyncio) para o caminho do webhook no server.
+
+Mesmas chaves e semântica das funções síncronas de tools/redis_tools.py,
+mas sem bloquear o event loop do FastAPI. Usa um BlockingConnectionPool
+próprio (mesmos limites do pool síncrono: settings.redis_max_connections).
+"""
+import asyncio
+import json
+from datetime import datetime
+from typing import Optional, Dict, List, Tuple
+
+import redis
+import redis.asyncio as aioredis
+
+from config.settings import settings
+from config.logger import setup_logger
+from tools import customer_state, metrics
+from tools.redis_tools import (
+    SESSION_TTL,
+    _local_buffer,
+    normalize_phone,
+    buffer_key,
+    cooldown_key,
+    cart_key,
+    cart_index_key,
+    parse_buffer_payloads,
+    is_greeting_message,
+    order_context_keys,
+    order_context_message,
+    registered_script,
+    _SESSION_LUA_SCRIPTS,
+    pool_stats,
+    redis_pool_kwargs,
+)
+
+logger = setup_logger(__name__)
+
+_async_pool: Optional[aioredis.BlockingConnectionPool] = None
+_async_client: Optional[aioredis.Redis] = None
+_async_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+async def get_async_redis_client() -> Optional[aioredis.Redis]:
+    """
+    Retorna o cliente Redis assíncrono (singleton por event loop).
+    Retorna None se o Redis estiver indisponível.
+    """
+    global _async_pool, _async_client, _async_loop
+
+    loop = asyncio.get_running_loop()
+    if _async_client is not None and _async_loop is loop:
+        return _async_client
+
+    try:
+        pool = aioredis.BlockingConnectionPool.from_url(settings.redis_url, **redis_pool_kwargs())
+        client = aioredis.Redis(connection_pool=pool)
+        await client.ping()
+        _async_pool, _async_client, _async_loop = pool, client, loop
+        metrics.register_collector(_pool_metrics)
+        logger.info(f"🔌 Pool Redis async criado (max={settings.redis_max_connections})")
+        return _async_client
+    except Exception as e:
+        logger.error(f"Erro ao conectar ao Redis (async): {e}")
+        return None
+
+
+def _pool_metrics() -> Dict[str, float]:
+    return pool_stats(_async_pool, "redis.pool.async")
+
+
+async def close_async_redis() -> None:
+    """Fecha o pool assíncrono (shutdown do server)."""
+    global _async_pool, _async_client, _async_loop
+    if _async_pool is not None:
+        try:
+            await _async_pool.disconnect()
+        except Exception:
+            pass
+    _async_pool, _async_client, _async_loop = None, None, None
+
+
+# ============================================
+# Buffer de mensagens
+# ============================================
+
+async def push_message_to_buffer(telefone: str, mensagem: str, message_id: str = None, ttl_seconds: int = 300) -> bool:
+    """Empilha a mensagem recebida no buffer do telefone (JSON {"text", "mid"})."""
+    client = await get_async_redis_client()
+    payload = json.dumps({"text": mensagem, "mid": message_id})
+
+    telefone = normalize_phone(telefone)
+    if client is None:
+        # Fallback em memória (mesmo buffer local do módulo síncrono)
+        _local_buffer.setdefault(telefone, []).append(payload)
+        logger.info(f"[fallback] Mensagem empilhada em memória para {telefone}")
+        return True
+
+    key = buffer_key(telefone)
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.rpush(key, payload)
+        pipe.ttl(key)
+        _, ttl = await pipe.execute()
+        if ttl in (-1, -2):
+            await client.expire(key, ttl_seconds)
+        logger.info(f"Mensagem empilhada no buffer: {key}")
+        return True
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Erro ao empilhar mensagem no Redis: {e}")
+        return False
+
+
+async def get_buffer_length(telefone: str) -> int:
+    """Retorna o tamanho atual do buffer de mensagens para o telefone."""
+    client = await get_async_redis_client()
+    telefone = normalize_phone(telefone)
+    if client is None:
+        return len(_local_buffer.get(telefone) or [])
+    try:
+        return int(await client.llen(buffer_key(telefone)))
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Erro ao consultar tamanho do buffer: {e}")
+        return 0
+
+
+async def pop_all_messages(telefone: str) -> Tuple[List[str], Optional[List[str]]]:
+    """Obtém todas as mensagens do buffer e limpa a chave. Retorna (textos, mids)."""
+    client = await get_async_redis_client()
+    telefone = normalize_phone(telefone)
+
+    if client is None:
+        msgs_raw = _local_buffer.pop(telefone, None) or []
+    else:
+        key = buffer_key(telefone)
+        try:
+            pipe = client.pipeline()
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            result = await pipe.execute()
+            msgs_raw = result[0] if result else []
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Erro ao consumir buffer: {e}")
+            return [], None
+
+    texts, mids = parse_buffer_payloads(msgs_raw)
+    logger.info(f"Buffer consumido para {telefone}: {len(texts)} mensagens. MIDs: {len(mids)}")
+    return texts, mids
+
+
+# ============================================
+# Cooldown do agente
+# ============================================
+
+async def set_agent_cooldown(telefone: str, ttl_seconds: int = 60) -> bool:
+    """Define o cooldown do telefone (pausa da automação)."""
+    client = await get_async_redis_client()
+    telefone = normalize_phone(telefone)
+    if client is None:
+        logger.warning(f"[fallback] Cooldown não persistido (Redis indisponível) para {telefone}")
+        return False
+    try:
+        if settings.redis_customer_hash:
+            await customer_state.aset_field(client, telefone, "cooldown", "1", ttl_seconds)
+        else:
+            await client.set(cooldown_key(telefone), "1", ex=ttl_seconds)
+        logger.info(f"Cooldown definido para {telefone} por {ttl_seconds}s")
+        return True
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Erro ao definir cooldown: {e}")
+        return False
+
+
+async def is_agent_in_cooldown(telefone: str) -> Tuple[bool, int]:
+    """Verifica se há cooldown ativo e retorna (ativo, ttl_restante)."""
+    client = await get_async_redis_client()
+    telefone = normalize_phone(telefone)
+    if client is None:
+        return (False, -1)
+    try:
+        # TTL sozinho basta: -2 = chave (ou campo) inexistente
+        if settings.redis_customer_hash:
+            ttl = await customer_state.aget_field_ttl(client, telefone, "cooldown")
+        else:
+            ttl = await client.ttl(cooldown_key(telefone))
+        if ttl == -2:
+            return (False, -1)
+        return (True, ttl if isinstance(ttl, int) else -1)
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Erro ao consultar cooldown: {e}")
+        return (False, -1)
+
+
+# ============================================
+# Sessão de pedido
+# ============================================
+
+async def get_order_context(telefone: str, mensagem: str = "") -> str:
+    """Versão assíncrona de redis_tools.get_order_context (mesmo script Lua, mesma resposta [SESSÃO])."""
+    client = await get_async_redis_client()
+    telefone = normalize_phone(telefone)
+    if client is None:
+        return "[SESSÃO] Nova conversa. Monte o pedido normalmente."
+    try:
+        script = registered_script(client, "session:context", _SESSION_LUA_SCRIPTS["context"])
+        state, was_completed = await script(
+            keys=order_context_keys(telefone),
+            args=["1" if is_greeting_message(mensagem) else "0", datetime.now().isoformat(), SESSION_TTL],
+        )
+    except Exception as e:
+        logger.error(f"Erro ao obter contexto de pedido: {e}")
+        return ""
+    return order_context_message(telefone, state, was_completed)
+
+
+# ============================================
+# Carrinho
+# ============================================
+
+async def clear_cart(telefone: str) -> bool:
+    """Remove todo o carrinho (hash + índice)."""
+    client = await get_async_redis_client()
+    telefone = normalize_phone(telefone)
+    if client is None:
+        return False
+    try:
+        await client.delete(cart_key(telefone), cart_index_key(telefone))
+        logger.info(f"🛒 Carrinho limpo para {telefone}")
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao limpar carrinho: {e}")
+        return False
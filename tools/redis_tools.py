@@ -3,14 +3,21 @@ Ferramentas Redis para buffer de mensagens e cooldown
 Apenas funcionalidades essenciais mantidas
 """
 import redis
+import threading
 import time
 import uuid
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Tuple, Any
 from config.settings import settings
 from config.logger import setup_logger
+from tools import customer_state, metrics
+from tools.turn_context import TurnContext, begin_turn, end_turn, current_turn, count_round_trip
+from tools.suggestion_index import SuggestionIndex, normalize_name
 
 logger = setup_logger(__name__)
 
+# Pool de conexões compartilhado por todos os módulos do processo
+_redis_pool: Optional[redis.BlockingConnectionPool] = None
+_redis_pool_lock = threading.Lock()
 # Conexão global com Redis
 _redis_client: Optional[redis.Redis] = None
 # Buffer local em memória (fallback quando Redis não está disponível)
@@ -21,9 +28,38 @@ def normalize_phone(telefone: str) -> str:
     digits = "".join(ch for ch in telefone if ch.isdigit())
     return digits or telefone.strip()
 
+# Marcador gravado por scripts/migrate_redis_keys.py ao terminar a migração das chaves
+# com telefone não normalizado. Com ele presente, _maybe_migrate_key vira no-op.
+PHONE_KEYS_MIGRATION_MARKER = "migration:phone_keys:v1"
+PHONE_KEY_PREFIXES = ("cart:", "order_session:", "suggestions:", "comprovante:", "address:")
+_MARKER_RECHECK_SECONDS = 300
+_phone_keys_migrated = False
+_marker_checked_at = 0.0
+
+
+def phone_keys_migrated(client: redis.Redis) -> bool:
+    """True se a migração one-shot já rodou (consulta o marcador no máximo a cada 5 min)."""
+    global _phone_keys_migrated, _marker_checked_at
+    if _phone_keys_migrated:
+        return True
+    now = time.monotonic()
+    if _marker_checked_at and now - _marker_checked_at < _MARKER_RECHECK_SECONDS:
+        return False
+    _marker_checked_at = now
+    try:
+        _phone_keys_migrated = bool(client.exists(PHONE_KEYS_MIGRATION_MARKER))
+    except Exception:
+        return False
+    if _phone_keys_migrated:
+        logger.info("✅ Chaves por telefone já migradas: checagem por chamada desativada")
+    return _phone_keys_migrated
+
+
 def _maybe_migrate_key(client: redis.Redis, old_key: str, new_key: str) -> None:
     if not old_key or not new_key or old_key == new_key:
         return
+    if phone_keys_migrated(client):
+        return
     try:
         if client.type(old_key) == "none":
             return
@@ -38,33 +74,197 @@ def _maybe_migrate_key(client: redis.Redis, old_key: str, new_key: str) -> None:
 def _lock_key(namespace: str, telefone: str) -> str:
     return f"lock:{namespace}:{normalize_phone(telefone)}"
 
-def _release_lock(client: redis.Redis, key: str, token: str) -> bool:
-    script = """
-    if redis.call("get", KEYS[1]) == ARGV[1] then
-        return redis.call("del", KEYS[1])
-    else
-        return 0
+
+# Lock FIFO com entrega direta (sem polling):
+# - lock:{ns}:{tel}          dono atual (token, com TTL)
+# - lock:{ns}:{tel}:queue    fila de espera (LIST de tokens, ordem de chegada)
+# - lock:{ns}:{tel}:hb       heartbeat de cada waiter (HASH token -> expira_em_ms)
+# - lock:{ns}:{tel}:wake:{t} lista em que o waiter t fica bloqueado (BLPOP)
+# Quem libera entrega o lock ao próximo waiter vivo da fila (no script) e o acorda
+# logo depois com RPUSH na lista de wake dele (fora do script: todas as chaves que
+# um script toca precisam estar em KEYS). Se o RPUSH se perder, o waiter assume o
+# lock na próxima fatia do BLPOP.
+LOCK_WAIT_SLICE = 3  # BLPOP em fatias (< socket_timeout do pool); a cada fatia o waiter renova o heartbeat
+LOCK_HEARTBEAT_MS = (2 * LOCK_WAIT_SLICE + 1) * 1000
+LOCK_CLAIM_MS = 10_000  # TTL do lock entregue até o waiter acordar e assumir
+LOCK_CONTENTION_KEY = "lock_contention:{namespace}"
+LOCK_CONTENTION_TTL = 24 * 3600
+
+# KEYS: lock, queue, hb; ARGV: token, ttl_ms, agora_ms, heartbeat_ms -> 1 adquiriu, 0 na fila
+ACQUIRE_LOCK_SCRIPT = """
+local lock, queue, hb = KEYS[1], KEYS[2], KEYS[3]
+local token, ttl, now = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+while true do
+    local head = redis.call('LINDEX', queue, 0)
+    if not head or tonumber(redis.call('HGET', hb, head) or '0') >= now then break end
+    redis.call('LPOP', queue)
+    redis.call('HDEL', hb, head)
+end
+local holder = redis.call('GET', lock)
+if holder == token then
+    redis.call('PEXPIRE', lock, ttl)
+    return 1
+end
+local head = redis.call('LINDEX', queue, 0)
+if not holder and (not head or head == token) then
+    redis.call('SET', lock, token, 'PX', ttl)
+    if head == token then redis.call('LPOP', queue) end
+    redis.call('HDEL', hb, token)
+    return 1
+end
+if redis.call('HEXISTS', hb, token) == 0 then
+    redis.call('RPUSH', queue, token)
+end
+redis.call('HSET', hb, token, now + tonumber(ARGV[4]))
+redis.call('PEXPIRE', queue, ttl + tonumber(ARGV[4]))
+redis.call('PEXPIRE', hb, ttl + tonumber(ARGV[4]))
+return 0
+"""
+
+# KEYS: lock, queue, hb; ARGV: token, agora_ms, claim_ms -> 0 não era dono, 1 liberou, token do waiter que recebeu
+RELEASE_LOCK_SCRIPT = """
+local lock, queue, hb = KEYS[1], KEYS[2], KEYS[3]
+if redis.call('GET', lock) ~= ARGV[1] then
+    return 0
+end
+local now = tonumber(ARGV[2])
+while true do
+    local nxt = redis.call('LPOP', queue)
+    if not nxt then
+        redis.call('DEL', lock)
+        return 1
+    end
+    local alive = tonumber(redis.call('HGET', hb, nxt) or '0') >= now
+    redis.call('HDEL', hb, nxt)
+    if alive then
+        redis.call('SET', lock, nxt, 'PX', ARGV[3])
+        return nxt
     end
+end
+"""
+
+# KEYS: lock, queue, hb; ARGV: token -> 1 se o lock já tinha sido entregue a ele (desistência tardia)
+CANCEL_WAIT_SCRIPT = """
+redis.call('LREM', KEYS[2], 0, ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+if redis.call('GET', KEYS[1]) == ARGV[1] then return 1 end
+return 0
+"""
+
+_registered_scripts: Dict[Tuple[int, str], Any] = {}
+
+
+def registered_script(client, name: str, source: str):
+    """
+    Script Lua registrado no cliente (sync ou async), em cache por cliente.
+    A chamada usa EVALSHA e cai para SCRIPT LOAD só se o servidor não tiver o script.
     """
+    cache_key = (id(client), name)
+    script = _registered_scripts.get(cache_key)
+    if script is None:
+        script = client.register_script(source)
+        _registered_scripts[cache_key] = script
+    return script
+
+
+def lock_keys(key: str) -> List[str]:
+    """KEYS dos scripts de lock: dono, fila e heartbeats."""
+    return [key, f"{key}:queue", f"{key}:hb"]
+
+
+def _wake_key(key: str, token: str) -> str:
+    return f"{key}:wake:{token}"
+
+
+def release_lock_args(token: str) -> List[Any]:
+    """ARGV do RELEASE_LOCK_SCRIPT (token, agora, TTL de entrega)."""
+    return [token, int(time.time() * 1000), LOCK_CLAIM_MS]
+
+
+def wake_lock_waiter(client: redis.Redis, key: str, released: Any) -> None:
+    """Acorda o waiter que recebeu o lock (retorno do RELEASE_LOCK_SCRIPT = token dele)."""
+    if released in (None, 0, 1) or not isinstance(released, (str, bytes)):
+        return
+    waiter = released.decode() if isinstance(released, bytes) else released
     try:
-        res = client.eval(script, 1, key, token)
-        return bool(res)
+        pipe = client.pipeline(transaction=False)
+        pipe.rpush(_wake_key(key, waiter), "1")
+        pipe.pexpire(_wake_key(key, waiter), LOCK_CLAIM_MS)
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"Erro ao acordar waiter de {key}: {e}")
+
+
+def _release_lock(client: redis.Redis, key: str, token: str) -> bool:
+    try:
+        script = registered_script(client, "lock:release", RELEASE_LOCK_SCRIPT)
+        res = script(keys=lock_keys(key), args=release_lock_args(token))
     except Exception:
         return False
+    wake_lock_waiter(client, key, res)
+    return bool(res)
+
+
+def _record_lock_contention(client: redis.Redis, key: str, waited: float, acquired: bool) -> None:
+    namespace, _, telefone = key[len("lock:"):].partition(":")
+    metrics.observe(f"lock.{namespace}.wait", waited)
+    metrics.incr(f"lock.{namespace}.contended")
+    if not acquired:
+        metrics.incr(f"lock.{namespace}.timeouts")
+    try:
+        zkey = LOCK_CONTENTION_KEY.format(namespace=namespace)
+        pipe = client.pipeline(transaction=False)
+        pipe.zincrby(zkey, 1, telefone)
+        pipe.expire(zkey, LOCK_CONTENTION_TTL)
+        pipe.execute()
+    except Exception:
+        pass
+
 
-def _acquire_lock(client: redis.Redis, key: str, ttl_seconds: int, wait_seconds: int) -> Optional[str]:
-    token = uuid.uuid4().hex
-    deadline = time.monotonic() + max(0, int(wait_seconds))
+def lock_contention_top(namespace: str = "agent", limit: int = 10) -> List[Tuple[str, int]]:
+    """Telefones com mais esperas pelo lock nas últimas 24h (para o /metrics)."""
+    client = get_redis_client()
+    if client is None:
+        return []
+    try:
+        rows = client.zrevrange(LOCK_CONTENTION_KEY.format(namespace=namespace), 0, limit - 1, withscores=True)
+        return [(tel, int(score)) for tel, score in rows]
+    except Exception:
+        return []
+
+
+def _acquire_lock(client: redis.Redis, key: str, ttl_seconds: int, wait_seconds: int,
+                  token: Optional[str] = None) -> Optional[str]:
+    """
+    Adquire o lock em ordem de chegada. Sem polling: o waiter fica em BLPOP na
+    própria lista de wake e quem libera entrega o lock diretamente a ele.
+    token: de quem já entrou na fila (begin_agent_turn), para manter o lugar.
+    """
+    token = token or uuid.uuid4().hex
+    ttl_ms = max(1, int(ttl_seconds)) * 1000
+    keys = lock_keys(key)
+    acquire = registered_script(client, "lock:acquire", ACQUIRE_LOCK_SCRIPT)
+    start = time.monotonic()
+    deadline = start + max(0, int(wait_seconds))
+    contended = False
     while True:
         try:
-            ok = client.set(key, token, nx=True, ex=max(1, int(ttl_seconds)))
-        except Exception:
-            return None
-        if ok:
-            return token
-        if time.monotonic() >= deadline:
+            if acquire(keys=keys, args=[token, ttl_ms, int(time.time() * 1000), LOCK_HEARTBEAT_MS]):
+                if contended:
+                    _record_lock_contention(client, key, time.monotonic() - start, True)
+                return token
+            contended = True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                owned = registered_script(client, "lock:cancel", CANCEL_WAIT_SCRIPT)(keys=keys, args=[token])
+                _record_lock_contention(client, key, time.monotonic() - start, bool(owned))
+                return token if owned else None
+            # Acordado = lock já entregue; o próximo acquire() só renova o TTL para o valor cheio
+            client.blpop(_wake_key(key, token), timeout=max(1, min(LOCK_WAIT_SLICE, int(remaining + 0.999))))
+        except Exception as e:
+            logger.error(f"Erro aguardando lock {key}: {e}")
             return None
-        time.sleep(0.15)
+
 
 def acquire_agent_lock(telefone: str, ttl_seconds: int = 600, wait_seconds: int = 120) -> Optional[str]:
     client = get_redis_client()
@@ -83,20 +283,86 @@ def release_agent_lock(telefone: str, token: str) -> bool:
     return _release_lock(client, _lock_key("agent", telefone), token)
 
 
+class _CountingPipeline(redis.client.Pipeline):
+    """Pipeline que conta cada execute() como uma ida ao Redis no turno ativo."""
+
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            count_round_trip()
+        return super().execute(raise_on_error)
+
+
+class CountingRedis(redis.Redis):
+    """Cliente Redis que contabiliza idas ao servidor (métrica de round trips por turno)."""
+
+    def execute_command(self, *args, **options):
+        count_round_trip()
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return _CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def redis_pool_kwargs() -> Dict[str, Any]:
+    """Parâmetros comuns dos pools (sync e async)."""
+    return {
+        "decode_responses": True,
+        "max_connections": settings.redis_max_connections,
+        "timeout": settings.redis_pool_timeout,  # Espera por conexão livre quando o pool está cheio
+        "health_check_interval": settings.redis_health_check_interval,
+        "socket_keepalive": True,
+        "socket_connect_timeout": 5,
+        "socket_timeout": 5,
+    }
+
+
+def get_redis_pool() -> redis.BlockingConnectionPool:
+    """
+    Retorna o ConnectionPool compartilhado (singleton, thread-safe).
+    Usado pelo get_redis_client e pelo RedisChatMessageHistory.
+    """
+    global _redis_pool
+    if _redis_pool is None:
+        with _redis_pool_lock:
+            if _redis_pool is None:
+                _redis_pool = redis.BlockingConnectionPool.from_url(settings.redis_url, **redis_pool_kwargs())
+                metrics.register_collector(lambda: pool_stats(_redis_pool, "redis.pool.sync"))
+                logger.info(f"🔌 Pool Redis criado (max={settings.redis_max_connections})")
+    return _redis_pool
+
+
+def pool_stats(pool: Any, prefix: str) -> Dict[str, float]:
+    """
+    Saturação de um BlockingConnectionPool (sync ou async):
+    conexões criadas, em uso, ociosas e utilização (em uso / máximo).
+    """
+    if pool is None:
+        return {}
+    queue = getattr(pool.pool, "queue", None)
+    if queue is None:
+        queue = getattr(pool.pool, "_queue", [])
+    idle = sum(1 for c in list(queue) if c is not None)
+    created = len(getattr(pool, "_connections", []))
+    in_use = max(0, created - idle)
+    max_conn = pool.max_connections or 1
+    return {
+        f"{prefix}.max": max_conn,
+        f"{prefix}.created": created,
+        f"{prefix}.in_use": in_use,
+        f"{prefix}.idle": idle,
+        f"{prefix}.utilization": round(in_use / max_conn, 3),
+    }
+
+
 def get_redis_client() -> Optional[redis.Redis]:
     """
-    Retorna a conexão com o Redis (singleton)
+    Retorna a conexão com o Redis (singleton sobre o pool compartilhado)
     """
     global _redis_client
     
     if _redis_client is None:
         try:
-            _redis_client = redis.from_url(
-                settings.redis_url,
-                decode_responses=True,
-                socket_connect_timeout=5,
-                socket_timeout=5,
-            )
+            _redis_client = CountingRedis(connection_pool=get_redis_pool())
             # Testar conexão
             _redis_client.ping()
             logger.info("Conectado ao Redis")
@@ -176,12 +442,8 @@ def pop_all_messages(telefone: str) -> Tuple[List[str], Optional[str]]:
     Retorna (lista_de_textos, lista_de_mids).
     """
     client = get_redis_client()
-    import json
     telefone = normalize_phone(telefone)
     
-    texts = []
-    # mids (plural) para marcar todos como lidos
-    
     if client is None:
         # Fallback em memória
         msgs_raw = _local_buffer.get(telefone) or []
@@ -198,6 +460,16 @@ def pop_all_messages(telefone: str) -> Tuple[List[str], Optional[str]]:
             logger.error(f"Erro ao consumir buffer: {e}")
             return [], None
 
+    texts, mids = parse_buffer_payloads(msgs_raw)
+    logger.info(f"Buffer consumido para {telefone}: {len(texts)} mensagens. MIDs: {len(mids)}")
+    return texts, mids
+
+
+def parse_buffer_payloads(msgs_raw: List[str]) -> Tuple[List[str], List[str]]:
+    """Converte os payloads do buffer em (textos, mids). Aceita JSON novo e texto puro antigo."""
+    import json
+    texts = []
+    # mids (plural) para marcar todos como lidos
     mids = []
     
     # Processar payloads
@@ -216,8 +488,6 @@ def pop_all_messages(telefone: str) -> Tuple[List[str], Optional[str]]:
         except:
             # Não é JSON, assume texto puro (retrocompatibilidade)
             texts.append(str(raw))
-            
-    logger.info(f"Buffer consumido para {telefone}: {len(texts)} mensagens. MIDs: {len(mids)}")
     return texts, mids
 
 
@@ -243,8 +513,11 @@ def set_agent_cooldown(telefone: str, ttl_seconds: int = 60) -> bool:
         logger.warning(f"[fallback] Cooldown não persistido (Redis indisponível) para {telefone}")
         return False
     try:
-        key = cooldown_key(telefone)
-        client.set(key, "1", ex=ttl_seconds)
+        if settings.redis_customer_hash:
+            customer_state.set_field(client, telefone, "cooldown", "1", ttl_seconds)
+        else:
+            client.set(cooldown_key(telefone), "1", ex=ttl_seconds)
+        _turn_set(telefone, "cooldown_ttl", ttl_seconds)
         logger.info(f"Cooldown definido para {telefone} por {ttl_seconds}s")
         return True
     except redis.exceptions.RedisError as e:
@@ -256,11 +529,18 @@ def is_agent_in_cooldown(telefone: str) -> Tuple[bool, int]:
     """
     Verifica se há cooldown ativo e retorna (ativo, ttl_restante).
     """
-    client = get_redis_client()
     telefone = normalize_phone(telefone)
+    ctx = current_turn(telefone)
+    if ctx is not None and ctx.has("cooldown_ttl"):
+        ttl = ctx.get("cooldown_ttl")
+        return (False, -1) if ttl == -2 else (True, ttl)
+    client = get_redis_client()
     if client is None:
         return (False, -1)
     try:
+        if settings.redis_customer_hash:
+            ttl = customer_state.get_field_ttl(client, telefone, "cooldown")
+            return (False, -1) if ttl == -2 else (True, ttl)
         key = cooldown_key(telefone)
         val = client.get(key)
         if val is None:
@@ -290,6 +570,115 @@ def order_session_key(telefone: str) -> str:
     return f"order_session:{normalize_phone(telefone)}"
 
 
+def order_completed_key(telefone: str) -> str:
+    """Flag de pedido finalizado recentemente (evita o aviso de pedido não finalizado)."""
+    return f"order_completed:{normalize_phone(telefone)}"
+
+
+def order_sync_key(telefone: str) -> str:
+    """Última versão do carrinho sincronizada com o dashboard (base do diff do order_sync)."""
+    return f"order_sync:{normalize_phone(telefone)}"
+
+
+ORDER_COMPLETED_TTL = 2 * 60 * 60  # 2 horas
+
+# Máquina de estados da sessão de pedido (building → sent → expirada por TTL).
+# Cada transição é um script Lua: uma ida ao Redis e sem corrida entre workers.
+_SESSION_LUA_SCRIPTS = {
+    # KEYS: sessão, order_completed, carrinho, índice do carrinho
+    # ARGV: saudação (0/1), agora (iso), SESSION_TTL
+    # -> {estado, pedido_anterior_finalizado(0/1)}
+    "context": """
+local function new_session()
+    local s = {status = 'building', started_at = ARGV[2], sent_at = cjson.null, order_id = cjson.null}
+    redis.call('SET', KEYS[1], cjson.encode(s), 'EX', ARGV[3])
+end
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    local was_completed = redis.call('DEL', KEYS[2])
+    new_session()
+    return {'new', was_completed}
+end
+local ok, session = pcall(cjson.decode, raw)
+local status = 'building'
+if ok and type(session) == 'table' and type(session['status']) == 'string' then
+    status = session['status']
+end
+if status == 'building' then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return {'building', 0}
+end
+if status == 'sent' then
+    if ARGV[1] == '1' then
+        redis.call('DEL', KEYS[3], KEYS[4])
+        new_session()
+        return {'restarted', 0}
+    end
+    return {'sent', 0}
+end
+return {status, 0}
+""",
+    # KEYS: sessão, carrinho, índice do carrinho, comprovante, order_completed
+    # ARGV: agora (iso), order_id, MODIFICATION_TTL, ORDER_COMPLETED_TTL -> JSON da sessão
+    "mark_sent": """
+local session = nil
+local raw = redis.call('GET', KEYS[1])
+if raw then
+    local ok, decoded = pcall(cjson.decode, raw)
+    if ok and type(decoded) == 'table' then session = decoded end
+end
+if not session then session = {started_at = ARGV[1]} end
+session['status'] = 'sent'
+session['sent_at'] = ARGV[1]
+if ARGV[2] ~= '' then session['order_id'] = ARGV[2] else session['order_id'] = cjson.null end
+local out = cjson.encode(session)
+redis.call('SET', KEYS[1], out, 'EX', ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+redis.call('EXPIRE', KEYS[4], ARGV[3])
+redis.call('SET', KEYS[5], '1', 'EX', ARGV[4])
+return out
+""",
+    # KEYS: sessão; ARGV: SESSION_TTL -> 1 se renovou (só em building)
+    "refresh": """
+local raw = redis.call('GET', KEYS[1])
+if not raw then return 0 end
+local ok, session = pcall(cjson.decode, raw)
+if ok and type(session) == 'table' and session['status'] == 'building' then
+    return redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 0
+""",
+}
+
+
+def _session_script(client, name: str):
+    return registered_script(client, f"session:{name}", _SESSION_LUA_SCRIPTS[name])
+
+
+def order_context_keys(telefone: str) -> List[str]:
+    """KEYS do script de contexto da sessão (compartilhado com tools/redis_async.py)."""
+    return [order_session_key(telefone), order_completed_key(telefone), cart_key(telefone), cart_index_key(telefone)]
+
+
+def order_context_message(telefone: str, state: str, was_completed: int) -> str:
+    """Converte o resultado da transição no texto [SESSÃO] injetado no agente."""
+    if state == "new":
+        logger.info(f"📦 Nova sessão de pedido iniciada para {telefone} (TTL: {SESSION_TTL//60}min)")
+        if was_completed:
+            # Pedido anterior FOI finalizado - iniciar novo normalmente
+            return "[SESSÃO] Novo pedido iniciado. Cliente já fez pedido anteriormente."
+        # Conversa nova ou sessão expirou SEM finalizar
+        return "[SESSÃO] Nova conversa. Monte o pedido normalmente."
+    if state == "restarted":
+        logger.info(f"🔄 Saudação detectada para {telefone} - iniciando NOVO pedido (limpando sessão anterior)")
+        return "[SESSÃO] Novo pedido iniciado. Cliente iniciou nova conversa com saudação."
+    if state == "sent":
+        # Pedido já foi enviado - está na janela de modificação (15min)
+        return "[SESSÃO] Pedido já enviado. Se cliente quiser adicionar algo, use alterar_tool."
+    return ""
+
+
 def get_order_session(telefone: str) -> Optional[Dict]:
     """
     Retorna a sessão de pedido atual do cliente.
@@ -301,9 +690,13 @@ def get_order_session(telefone: str) -> Optional[Dict]:
         - sent_at: timestamp de envio (se enviado)
         - order_id: ID do pedido (se enviado)
     """
-    client = get_redis_client()
     raw_phone = "" if telefone is None else str(telefone).strip()
     telefone = normalize_phone(raw_phone)
+    ctx = current_turn(telefone)
+    if ctx is not None and ctx.has("session"):
+        session = ctx.get("session")
+        return dict(session) if session else None
+    client = get_redis_client()
     if client is None:
         return None
     
@@ -312,9 +705,10 @@ def get_order_session(telefone: str) -> Optional[Dict]:
             _maybe_migrate_key(client, f"order_session:{raw_phone}", f"order_session:{telefone}")
         key = order_session_key(telefone)
         data = client.get(key)
-        if data:
-            return json.loads(data)
-        return None
+        session = json.loads(data) if data else None
+        if ctx is not None:
+            ctx.set("session", session)
+        return dict(session) if session else None
     except Exception as e:
         logger.error(f"Erro ao obter sessão de pedido: {e}")
         return None
@@ -342,6 +736,7 @@ def start_order_session(telefone: str) -> bool:
             "order_id": None
         }
         client.set(key, json.dumps(session), ex=SESSION_TTL)
+        _turn_set(telefone, "session", session)
         logger.info(f"📦 Nova sessão de pedido iniciada para {telefone} (TTL: {SESSION_TTL//60}min)")
         return True
     except Exception as e:
@@ -351,8 +746,8 @@ def start_order_session(telefone: str) -> bool:
 
 def mark_order_sent(telefone: str, order_id: str = None) -> bool:
     """
-    Marca o pedido como enviado. 
-    Atualiza TTL para 15 minutos (janela de alteração).
+    Marca o pedido como enviado (transição building → sent, script Lua, 1 ida ao Redis).
+    Atualiza TTL para 15 minutos (janela de alteração) na sessão, carrinho e comprovante.
     Também marca flag de pedido completado (2h TTL) para evitar mensagem de "não finalizado".
     """
     client = get_redis_client()
@@ -361,27 +756,17 @@ def mark_order_sent(telefone: str, order_id: str = None) -> bool:
         return False
     
     try:
-        key = order_session_key(telefone)
-        session = get_order_session(telefone)
-        
-        if session is None:
-            session = {"started_at": datetime.now().isoformat()}
-        
-        session["status"] = "sent"
-        session["sent_at"] = datetime.now().isoformat()
-        session["order_id"] = order_id
-        
-        client.set(key, json.dumps(session), ex=MODIFICATION_TTL) # 15 min TTL na sessão
-        
-        # Manter Carrinho e Comprovante vivos pela mesma janela de 15min
-        client.expire(cart_key(telefone), MODIFICATION_TTL)
-        client.expire(comprovante_key(telefone), MODIFICATION_TTL)
-        
-        # Marcar que pedido foi completado (TTL 2 horas)
-        # Isso evita a mensagem "pedido não finalizado" quando cliente voltar
-        completed_key = f"order_completed:{telefone}"
-        client.set(completed_key, "1", ex=7200)  # 2 horas
-        
+        session_json = _session_script(client, "mark_sent")(
+            keys=[order_session_key(telefone), cart_key(telefone), cart_index_key(telefone),
+                  comprovante_key(telefone), order_completed_key(telefone)],
+            args=[datetime.now().isoformat(), order_id or "", MODIFICATION_TTL, ORDER_COMPLETED_TTL],
+        )
+        _turn_set(telefone, "session", json.loads(session_json))
+        if settings.redis_customer_hash:
+            customer_state.expire_field(client, telefone, "comprovante", MODIFICATION_TTL)
+        # Base do diff das alterações pós-envio (tools/order_sync): o carrinho enviado
+        from tools import order_sync
+        order_sync.reset_base(telefone)
         logger.info(f"✅ Pedido marcado como enviado para {telefone} (Janela de alteração: 15min)")
         return True
     except Exception as e:
@@ -398,6 +783,7 @@ def clear_order_session(telefone: str) -> bool:
     
     try:
         client.delete(order_session_key(telefone))
+        _turn_set(telefone, "session", None)
         logger.info(f"🗑️ Sessão de pedido removida para {telefone}")
         return True
     except Exception as e:
@@ -405,6 +791,19 @@ def clear_order_session(telefone: str) -> bool:
         return False
 
 
+SAUDACOES = [
+    "boa tarde", "boa noite", "bom dia", "boa", "olá", "ola", "oi", 
+    "eae", "eai", "e ai", "oii", "oiee", "hello", "hi", "hey",
+    "opa", "opaa", "fala", "salve", "blz", "beleza"
+]
+
+
+def is_greeting_message(mensagem: str) -> bool:
+    """Detecta se a mensagem começa com uma saudação (novo atendimento)."""
+    msg_lower = (mensagem or "").strip().lower()
+    return any(msg_lower.startswith(s) or msg_lower == s for s in SAUDACOES)
+
+
 def get_order_context(telefone: str, mensagem: str = "") -> str:
     """
     Retorna o contexto de pedido para injetar no agente.
@@ -415,70 +814,26 @@ def get_order_context(telefone: str, mensagem: str = "") -> str:
     
     Returns:
         String com instrução para o agente baseada no estado da sessão.
+        A transição (nova sessão / renovar TTL / novo pedido após saudação)
+        é feita atomicamente no script Lua "context".
     """
     client = get_redis_client()
     telefone = normalize_phone(telefone)
-    session = get_order_session(telefone)
-    
-    # Detectar se é uma saudação/novo atendimento
-    saudacoes = [
-        "boa tarde", "boa noite", "bom dia", "boa", "olá", "ola", "oi", 
-        "eae", "eai", "e ai", "oii", "oiee", "hello", "hi", "hey",
-        "opa", "opaa", "fala", "salve", "blz", "beleza"
-    ]
-    msg_lower = mensagem.strip().lower()
-    is_greeting = any(msg_lower.startswith(s) or msg_lower == s for s in saudacoes)
-    
-    # Chave para rastrear se o ÚLTIMO pedido foi finalizado
-    completed_key = f"order_completed:{telefone}"
-    
-    if session is None:
-        # Verificar se o último pedido foi finalizado
-        was_completed = False
-        if client:
-            try:
-                was_completed = client.get(completed_key) is not None
-            except:
-                pass
-        
-        # Iniciar nova sessão
-        start_order_session(telefone)
-        
-        # Limpar flag de pedido completado para próximo ciclo
-        if client and was_completed:
-            try:
-                client.delete(completed_key)
-            except:
-                pass
-        
-        if was_completed:
-            # Pedido anterior FOI finalizado - iniciar novo normalmente
-            return "[SESSÃO] Novo pedido iniciado. Cliente já fez pedido anteriormente."
-        else:
-            # Conversa nova ou sessão expirou SEM finalizar
-            return "[SESSÃO] Nova conversa. Monte o pedido normalmente."
-    
-    status = session.get("status", "building")
+    if client is None:
+        return "[SESSÃO] Nova conversa. Monte o pedido normalmente."
     
-    if status == "building":
-        # Ainda montando pedido - renovar TTL
-        refresh_session_ttl(telefone)
+    try:
+        state, was_completed = _session_script(client, "context")(
+            keys=order_context_keys(telefone),
+            args=["1" if is_greeting_message(mensagem) else "0", datetime.now().isoformat(), SESSION_TTL],
+        )
+    except Exception as e:
+        logger.error(f"Erro ao obter contexto de pedido: {e}")
         return ""
-    
-    elif status == "sent":
-        # Pedido já foi enviado - está na janela de modificação (15min)
-        # MAS se cliente mandou saudação, ele quer NOVO pedido!
-        if is_greeting:
-            logger.info(f"🔄 Saudação detectada para {telefone} - iniciando NOVO pedido (limpando sessão anterior)")
-            # Limpar sessão antiga e carrinho
-            clear_order_session(telefone)
-            clear_cart(telefone)
-            start_order_session(telefone)
-            return "[SESSÃO] Novo pedido iniciado. Cliente iniciou nova conversa com saudação."
-        
-        return "[SESSÃO] Pedido já enviado. Se cliente quiser adicionar algo, use alterar_tool."
-    
-    return ""
+    _turn_invalidate(telefone, "session")
+    if state == "restarted":
+        _turn_set(telefone, "cart", [])
+    return order_context_message(telefone, state, was_completed)
 
 
 def check_can_modify_order(telefone: str) -> Tuple[bool, str]:
@@ -509,6 +864,7 @@ def check_can_modify_order(telefone: str) -> Tuple[bool, str]:
 def refresh_session_ttl(telefone: str) -> bool:
     """
     Renova o TTL da sessão quando o cliente interage (se ainda em building).
+    Dentro de um turno do agente a renovação vai para o flush final.
     """
     client = get_redis_client()
     telefone = normalize_phone(telefone)
@@ -516,32 +872,264 @@ def refresh_session_ttl(telefone: str) -> bool:
         return False
     
     try:
-        session = get_order_session(telefone)
-        if session and session.get("status") == "building":
-            key = order_session_key(telefone)
-            client.expire(key, SESSION_TTL)
-            logger.debug(f"TTL da sessão renovado para {telefone}")
-            return True
-        return False
+        ctx = current_turn(telefone)
+        if ctx is not None and ctx.has("session"):
+            session = ctx.get("session")
+            if session and session.get("status") == "building":
+                _expire_or_defer(client, telefone, order_session_key(telefone), SESSION_TTL)
+                return True
+            return False
+        return bool(_session_script(client, "refresh")(keys=[order_session_key(telefone)], args=[SESSION_TTL]))
     except Exception as e:
         logger.error(f"Erro ao renovar TTL da sessão: {e}")
         return False
 
 
 # ============================================
-# Carrinho de Compras (Redis List)
+# Carrinho de Compras (Redis Hash + índice ordenado)
 # ============================================
+# cart:{tel}      HASH  "p:<nome normalizado>" -> JSON do item
+#                       "#seq" (contador de inserção), "#count" (itens), "#cents" (subtotal em centavos)
+# cart_idx:{tel}  ZSET  "p:<nome>" com score = ordem de inserção (índices do ver_pedido_tool)
+#
+# Todas as alterações rodam em scripts Lua (EVALSHA): merge atômico sem lock no cliente
+# e agregados mantidos a cada escrita (total em O(1)).
+# Carrinhos antigos (LIST em cart:{tel}) são migrados na primeira escrita/leitura.
 
 def cart_key(telefone: str) -> str:
-    """Chave da lista de itens do carrinho no Redis."""
+    """Chave do hash de itens do carrinho no Redis."""
     return f"cart:{normalize_phone(telefone)}"
 
 
+def cart_index_key(telefone: str) -> str:
+    """Chave do índice ordenado (ZSET) dos itens do carrinho."""
+    return f"cart_idx:{normalize_phone(telefone)}"
+
+
+def _cart_field(produto: str) -> str:
+    """Campo do item no hash (mesmo critério de deduplicação de antes: nome strip/lower)."""
+    return "p:" + str(produto or "").strip().lower()
+
+
+_CART_LUA_HEADER = """
+local cart, idx = KEYS[1], KEYS[2]
+
+local function str(v)
+    if type(v) == 'string' then return v end
+    return ''
+end
+
+local function cents(item)
+    local p = tonumber(item['preco']) or 0
+    local q = tonumber(item['quantidade']) or 0
+    return math.floor(p * q * 100 + 0.5)
+end
+
+local function add_item(field, new)
+    local raw = redis.call('HGET', cart, field)
+    if raw then
+        local old = cjson.decode(raw)
+        local old_cents = cents(old)
+        old['quantidade'] = (tonumber(old['quantidade']) or 0) + (tonumber(new['quantidade']) or 0)
+        local u_old = math.floor(tonumber(old['unidades']) or 0)
+        local u_new = math.floor(tonumber(new['unidades']) or 0)
+        if u_old ~= 0 or u_new ~= 0 then
+            old['unidades'] = u_old + u_new
+        end
+        if tonumber(new['preco']) then
+            old['preco'] = new['preco']
+        end
+        local obs_old, obs_new = str(old['observacao']), str(new['observacao'])
+        if obs_new ~= '' and not string.find(obs_old, obs_new, 1, true) then
+            old['observacao'] = string.match(obs_old .. ' ' .. obs_new, '^%s*(.-)%s*$')
+        end
+        local out = cjson.encode(old)
+        redis.call('HSET', cart, field, out)
+        redis.call('HINCRBY', cart, '#cents', cents(old) - old_cents)
+        return 0, out
+    end
+    local out = cjson.encode(new)
+    local seq = redis.call('HINCRBY', cart, '#seq', 1)
+    redis.call('HSET', cart, field, out)
+    redis.call('ZADD', idx, seq, field)
+    redis.call('HINCRBY', cart, '#count', 1)
+    redis.call('HINCRBY', cart, '#cents', cents(new))
+    return 1, out
+end
+
+local function remove_field(field)
+    local raw = redis.call('HGET', cart, field)
+    if not raw then return nil end
+    local item = cjson.decode(raw)
+    redis.call('HDEL', cart, field)
+    redis.call('ZREM', idx, field)
+    local left = redis.call('HINCRBY', cart, '#count', -1)
+    redis.call('HINCRBY', cart, '#cents', -cents(item))
+    if left <= 0 then
+        redis.call('DEL', cart, idx)
+    end
+    return item
+end
+
+local function touch(ttl)
+    ttl = tonumber(ttl) or 0
+    if ttl > 0 and redis.call('EXISTS', cart) == 1 then
+        redis.call('EXPIRE', cart, ttl)
+        redis.call('EXPIRE', idx, ttl)
+    end
+end
+"""
+
+# Carrinho ainda no formato LIST: o Python migra (mesma normalização de nomes) e repete
+_CART_LUA_GUARD = """
+if redis.call('TYPE', cart)['ok'] == 'list' then
+    return redis.error_reply('LEGACY_CART')
+end
+"""
+
+_CART_LUA_SCRIPTS = {
+    # ARGV: campo, item_json, ttl -> {criado(0/1), item_json_final}
+    "add": _CART_LUA_GUARD + """
+local created, out = add_item(ARGV[1], cjson.decode(ARGV[2]))
+touch(ARGV[3])
+return {created, out}
+""",
+    # -> lista de JSON na ordem de inserção
+    "get": _CART_LUA_GUARD + """
+local fields = redis.call('ZRANGE', idx, 0, -1)
+if #fields == 0 then return {} end
+return redis.call('HMGET', cart, unpack(fields))
+""",
+    # ARGV: índice (0-based) -> JSON do item removido ou false
+    "remove_at": _CART_LUA_GUARD + """
+local field = redis.call('ZRANGE', idx, ARGV[1], ARGV[1])[1]
+if not field then return false end
+local item = remove_field(field)
+if not item then return false end
+return cjson.encode(item)
+""",
+    # ARGV: índice (0-based), quantidade a remover -> {removido_total(0/1), nova_qtd, nome} ou false
+    "reduce_at": _CART_LUA_GUARD + """
+local field = redis.call('ZRANGE', idx, ARGV[1], ARGV[1])[1]
+if not field then return false end
+local raw = redis.call('HGET', cart, field)
+if not raw then return false end
+local item = cjson.decode(raw)
+local name = str(item['produto'])
+if name == '' then name = 'Item' end
+local current = tonumber(item['quantidade']) or 1
+local new_qty = current - (tonumber(ARGV[2]) or 0)
+if new_qty <= 0 then
+    remove_field(field)
+    return {1, '0', name}
+end
+local old_cents = cents(item)
+item['quantidade'] = new_qty
+local units = math.floor(tonumber(item['unidades']) or 0)
+if units > 0 then
+    item['unidades'] = math.max(0, math.floor(units * new_qty / current))
+end
+redis.call('HSET', cart, field, cjson.encode(item))
+redis.call('HINCRBY', cart, '#cents', cents(item) - old_cents)
+return {0, tostring(new_qty), name}
+""",
+    # Migração LIST -> HASH. ARGV: ttl, campo1, json1, campo2, json2, ...
+    "load": """
+if redis.call('TYPE', cart)['ok'] ~= 'list' then return -1 end
+redis.call('DEL', cart, idx)
+for i = 2, #ARGV, 2 do
+    add_item(ARGV[i], cjson.decode(ARGV[i + 1]))
+end
+touch(ARGV[1])
+return tonumber(redis.call('HGET', cart, '#count') or 0)
+""",
+}
+
+def _cart_script(client: redis.Redis, name: str):
+    """Script Lua do carrinho registrado no cliente (chamado via EVALSHA, com fallback para EVAL)."""
+    return registered_script(client, f"cart:{name}", _CART_LUA_HEADER + _CART_LUA_SCRIPTS[name])
+
+
+def migrate_cart_list(client: redis.Redis, telefone: str) -> int:
+    """
+    Converte um carrinho antigo (LIST de JSON em cart:{tel}) para o hash + índice.
+    Itens com o mesmo nome são fundidos como no add. Retorna quantos itens ficaram (-1 = nada a migrar).
+    """
+    telefone = normalize_phone(telefone)
+    key = cart_key(telefone)
+    raw_items = client.lrange(key, 0, -1)
+    ttl = client.ttl(key)
+    args: List[Any] = [ttl if isinstance(ttl, int) and ttl > 0 else SESSION_TTL]
+    for item in _parse_cart(raw_items):
+        args.extend([_cart_field(item.get("produto", "")), json.dumps(item, ensure_ascii=False)])
+    result = _cart_script(client, "load")(keys=[key, cart_index_key(telefone)], args=args)
+    if result is not None and int(result) >= 0:
+        logger.info(f"🔁 Carrinho de {telefone} migrado de LIST para HASH ({len(raw_items)} → {result} itens)")
+    return int(result or -1)
+
+
+def _run_cart(client: redis.Redis, telefone: str, fn):
+    """Executa uma operação no carrinho; se ainda for LIST, migra e repete uma vez."""
+    try:
+        return fn()
+    except redis.exceptions.ResponseError as e:
+        if "LEGACY_CART" not in str(e) and "WRONGTYPE" not in str(e):
+            raise
+    migrate_cart_list(client, telefone)
+    return fn()
+
+
+def _cart_script_call(client: redis.Redis, name: str, telefone: str, args: List[Any] = None):
+    keys = [cart_key(telefone), cart_index_key(telefone)]
+    script = _cart_script(client, name)
+    return _run_cart(client, telefone, lambda: script(keys=keys, args=list(args or [])))
+
+
+def _parse_cart(items_raw: List[str]) -> List[Dict]:
+    items = []
+    for raw in items_raw or []:
+        try:
+            if isinstance(raw, str):
+                items.append(json.loads(raw))
+        except:
+            continue
+    return items
+
+
+def _cart_items_from_hash(fields: Dict[str, str], order: List[str]) -> List[Dict]:
+    """Monta a lista ordenada de itens a partir de HGETALL + ZRANGE (snapshot do turno)."""
+    return _parse_cart([fields.get(f) for f in order or [] if f in (fields or {})])
+
+
+def _sync_sent_order(telefone: str, motivo: str) -> None:
+    """
+    Pedido já enviado: agenda a sincronização com a API (tools/order_sync: várias
+    alterações seguidas viram um único GET + PUT com o diff aplicado sobre a cópia
+    do servidor). Com o sync desligado, propaga o carrinho completo (overwrite_order).
+    """
+    try:
+        session = get_order_session(telefone)
+        if session and session.get("status") == "sent":
+            from tools import order_sync
+            if order_sync.mark_dirty(telefone):
+                logger.info(f"🕓 Pedido {session.get('order_id')} já enviado ({motivo}): sincronização agendada.")
+                return
+            from tools.http_tools import overwrite_order
+            full_cart = get_cart_items(telefone)
+            payload_api = json.dumps({"itens": full_cart}, ensure_ascii=False)
+            logger.info(f"🚀 Pedido {session.get('order_id')} já enviado ({motivo}): Disparando overwrite_order() para sync completo.")
+            alterar_result = overwrite_order(telefone, payload_api)
+            logger.info(f"✅ Auto-update resultado: {alterar_result}")
+    except Exception as ex_api:
+        logger.error(f"❌ Falha no auto-update do pedido enviado: {ex_api}")
+
+
 def add_item_to_cart(telefone: str, item_json: str) -> bool:
     """
     Adiciona um item (JSON string) ao carrinho.
     Inicia sessão se não existir e renova TTL (30min).
-    Implementa DEDUPLICAÇÃO: Se item já existe, soma quantidade.
+    Implementa DEDUPLICAÇÃO: Se item já existe (mesmo nome), soma quantidade/unidades
+    e funde observações — tudo atômico no script Lua, sem lock no cliente.
     """
     client = get_redis_client()
     raw_phone = "" if telefone is None else str(telefone).strip()
@@ -549,174 +1137,115 @@ def add_item_to_cart(telefone: str, item_json: str) -> bool:
     if client is None:
         return False
 
-    lock_token = None
     try:
         if raw_phone and raw_phone != telefone:
             _maybe_migrate_key(client, f"order_session:{raw_phone}", f"order_session:{telefone}")
             _maybe_migrate_key(client, f"cart:{raw_phone}", f"cart:{telefone}")
 
-        lock_token = _acquire_lock(client, _lock_key("cart", telefone), ttl_seconds=30, wait_seconds=5)
-        if not lock_token:
-            logger.warning(f"⏳ Timeout aguardando lock do carrinho para {telefone}")
-            return False
-
-        # Garante que existe sessão ativa
-        session = get_order_session(telefone)
-        if not session or session.get("status") != "building":
-            start_order_session(telefone)
-            session = get_order_session(telefone)
-
-        key = cart_key(telefone)
-        
-        # 1. Parse do novo item
-        import json
         try:
             new_item = json.loads(item_json)
         except Exception:
             logger.error(f"Item JSON inválido para {telefone}")
             return False
-        new_prod_name = new_item.get("produto", "").strip().lower()
-        
-        # 2. Ler itens existentes para deduplicação
-        current_items = get_cart_items(telefone)
-        found_index = -1
-        
-        for i, item in enumerate(current_items):
-            existing_name = item.get("produto", "").strip().lower()
-            # Match exato de nome (simples e seguro)
-            if existing_name == new_prod_name:
-                found_index = i
-                break
-        
-        if found_index >= 0:
-            # --- CENÁRIO: ATUALIZAÇÃO (MERGE) ---
-            existing_item = current_items[found_index]
-            
-            try:
-                qtd_old_raw = existing_item.get("quantidade", 0)
-                qtd_new_raw = new_item.get("quantidade", 0)
-                try:
-                    qtd_old = float(qtd_old_raw or 0)
-                except Exception:
-                    qtd_old = 0.0
-                try:
-                    qtd_new = float(qtd_new_raw or 0)
-                except Exception:
-                    qtd_new = 0.0
-
-                nova_qtd = qtd_old + qtd_new
-                existing_item["quantidade"] = nova_qtd
-                
-                # Somar unidades se houver
-                unidades_old_raw = existing_item.get("unidades", 0)
-                unidades_new_raw = new_item.get("unidades", 0)
-                try:
-                    unidades_old = int(unidades_old_raw or 0)
-                except Exception:
-                    unidades_old = 0
-                try:
-                    unidades_new = int(unidades_new_raw or 0)
-                except Exception:
-                    unidades_new = 0
-
-                if unidades_old or unidades_new:
-                    existing_item["unidades"] = unidades_old + unidades_new
-                
-                # Atualizar preço (assume que o novo preço é o vigente)
-                existing_item["preco"] = new_item.get("preco", existing_item.get("preco"))
-                
-                # Fundir observações se forem diferentes
-                obs_old = existing_item.get("observacao", "")
-                obs_new = new_item.get("observacao", "")
-                if obs_new and obs_new not in obs_old:
-                    existing_item["observacao"] = (f"{obs_old} {obs_new}").strip()
-                
-                logger.info(f"🔄 Item '{new_prod_name}' atualizado no carrinho (MERGE): {nova_qtd}")
-                
-                # ATUALIZAÇÃO SEGURA (LSET) - Não apaga o carrinho inteiro!
-                client.lset(key, found_index, json.dumps(existing_item, ensure_ascii=False))
-                    
-            except Exception as e:
-                logger.error(f"Erro ao fazer merge de itens: {e}")
-                # Fallback: Adiciona como novo se der erro no merge
-                client.rpush(key, item_json)
+        if not isinstance(new_item, dict):
+            logger.error(f"Item JSON inválido para {telefone}")
+            return False
 
+        # Garante que existe sessão ativa. Pedido já enviado continua na janela de
+        # alteração: o item entra no MESMO pedido (order_sync). Antes a adição abria
+        # uma sessão "building" com o carrinho antigo, e o próximo checkout duplicava
+        # o pedido; um pedido novo começa pela saudação (script "context")
+        session = get_order_session(telefone)
+        if not session or session.get("status") not in ("building", "sent"):
+            start_order_session(telefone)
+            session = get_order_session(telefone)
+
+        field = _cart_field(new_item.get("produto", ""))
+        created, merged_json = _cart_script_call(client, "add", telefone, [field, json.dumps(new_item, ensure_ascii=False), SESSION_TTL])
+        merged = json.loads(merged_json)
+        if int(created):
+            logger.info(f"🛒 Item '{new_item.get('produto', '')}' adicionado ao carrinho de {telefone}")
         else:
-            # --- CENÁRIO: NOVO ITEM ---
-            client.rpush(key, item_json)
-        
-        # Renova TTL do carrinho e da sessão
-        client.expire(key, SESSION_TTL)
+            logger.info(f"🔄 Item '{field[2:]}' atualizado no carrinho (MERGE): {merged.get('quantidade')}")
+
+        # Mantém o snapshot do turno coerente sem reler o carrinho
+        ctx = current_turn(telefone)
+        if ctx is not None and ctx.has("cart"):
+            items = [dict(i) for i in ctx.get("cart")]
+            for i, item in enumerate(items):
+                if _cart_field(item.get("produto", "")) == field:
+                    items[i] = merged
+                    break
+            else:
+                items.append(merged)
+            ctx.set("cart", items)
+
+        # Renova TTL da sessão (o do carrinho é renovado no script)
         refresh_session_ttl(telefone)
-        
+
         # --- AUTO-UPDATE para pedidos já enviados ---
         # Se o pedido já foi enviado (status='sent'), qualquer adição deve ser propagada para a API imediatamente.
         # Isso corrige o bug onde o agente diz "Adicionei" mas só adiciona no Redis e não na Dashboard.
         if session and session.get("status") == "sent":
-            try:
-                from tools.http_tools import overwrite_order
-                # Para garantir sincronia total, enviamos o carrinho COMPLETO
-                full_cart = get_cart_items(telefone)
-                payload_api = json.dumps({"itens": full_cart}, ensure_ascii=False)
-                
-                logger.info(f"🚀 Pedido {session.get('order_id')} já enviado: Disparando overwrite_order() para sync completo.")
-                alterar_result = overwrite_order(telefone, payload_api)
-                logger.info(f"✅ Auto-update resultado: {alterar_result}")
-                
-            except Exception as ex_api:
-                logger.error(f"❌ Falha no auto-update do pedido enviado: {ex_api}")
+            _sync_sent_order(telefone, "adição")
 
         return True
     except Exception as e:
         logger.error(f"Erro ao adicionar item ao carrinho: {e}")
         return False
-    finally:
-        try:
-            if client and lock_token:
-                _release_lock(client, _lock_key("cart", telefone), lock_token)
-        except Exception:
-            pass
 
 
 def get_cart_items(telefone: str) -> List[Dict]:
     """
-    Retorna todos os itens do carrinho como lista de dicionários.
+    Retorna todos os itens do carrinho como lista de dicionários (ordem de inserção).
     """
-    client = get_redis_client()
     raw_phone = "" if telefone is None else str(telefone).strip()
     telefone = normalize_phone(raw_phone)
+    ctx = current_turn(telefone)
+    if ctx is not None and ctx.has("cart"):
+        return [dict(item) for item in ctx.get("cart")]
+    client = get_redis_client()
     if client is None:
         return []
 
     try:
         if raw_phone and raw_phone != telefone:
             _maybe_migrate_key(client, f"cart:{raw_phone}", f"cart:{telefone}")
-        key = cart_key(telefone)
-        # LRANGE 0 -1 pega toda a lista
-        items_raw = client.lrange(key, 0, -1)
-        
-        items = []
-        for raw in items_raw:
-            try:
-                if isinstance(raw, str):
-                    items.append(json.loads(raw))
-            except:
-                continue
-                
+        items = _parse_cart(_cart_script_call(client, "get", telefone))
+        if ctx is not None:
+            ctx.set("cart", [dict(item) for item in items])
         return items
     except Exception as e:
         logger.error(f"Erro ao ler carrinho: {e}")
         return []
 
 
+def get_cart_totals(telefone: str) -> Dict[str, float]:
+    """
+    Agregados do carrinho em O(1) (campos mantidos pelos scripts):
+    {"itens": quantidade de itens distintos, "subtotal": soma de preço x quantidade}.
+    """
+    telefone = normalize_phone(telefone)
+    ctx = current_turn(telefone)
+    if ctx is not None and ctx.has("cart"):
+        items = ctx.get("cart")
+        cents = sum(int(float(i.get("preco", 0) or 0) * float(i.get("quantidade", 0) or 0) * 100 + 0.5) for i in items)
+        return {"itens": len(items), "subtotal": cents / 100.0}
+    client = get_redis_client()
+    if client is None:
+        return {"itens": 0, "subtotal": 0.0}
+    try:
+        count, cents = _run_cart(client, telefone, lambda: client.hmget(cart_key(telefone), "#count", "#cents"))
+        return {"itens": int(count or 0), "subtotal": int(cents or 0) / 100.0}
+    except Exception as e:
+        logger.error(f"Erro ao ler totais do carrinho: {e}")
+        return {"itens": 0, "subtotal": 0.0}
+
+
 def remove_item_from_cart(telefone: str, index: int) -> bool:
     """
-    Remove item pelo índice (0-based).
-    NOTA: Redis Lists não são ideais para remover por índice concorrente, 
-    mas para este caso de uso simples (1 usuário), funciona usando LSET + LREM 
-    ou apenas recriando a lista.
-    
-    Abordagem segura: Ler tudo, remover no python, reescrever.
+    Remove item pelo índice (0-based, ordem de inserção).
+    Atômico no script Lua (ZRANGE do índice + HDEL + agregados).
     """
     client = get_redis_client()
     raw_phone = "" if telefone is None else str(telefone).strip()
@@ -724,63 +1253,36 @@ def remove_item_from_cart(telefone: str, index: int) -> bool:
     if client is None:
         return False
 
-    lock_token = None
     try:
         if raw_phone and raw_phone != telefone:
             _maybe_migrate_key(client, f"cart:{raw_phone}", f"cart:{telefone}")
-
-        lock_token = _acquire_lock(client, _lock_key("cart", telefone), ttl_seconds=30, wait_seconds=5)
-        if not lock_token:
-            logger.warning(f"⏳ Timeout aguardando lock do carrinho para {telefone}")
+        if index < 0:
             return False
 
-        key = cart_key(telefone)
-        items = client.lrange(key, 0, -1)
-        
-        if 0 <= index < len(items):
-            # Elemento placeholder para marcar remoção
-            deleted_marker = "__DELETED__"
-            client.lset(key, index, deleted_marker)
-            client.lrem(key, 0, deleted_marker)
-            
-            # --- AUTO-UPDATE (Sync Deletions) ---
-            try:
-                session = get_order_session(telefone)
-                if session and session.get("status") == "sent":
-                    from tools.http_tools import overwrite_order
-                    # Ler carrinho atualizado
-                    full_cart_after = get_cart_items(telefone)
-                    payload_api = json.dumps({"itens": full_cart_after}, ensure_ascii=False)
-                    
-                    logger.info(f"🗑️ Item removido de pedido enviado: Disparando overwrite_order()")
-                    overwrite_order(telefone, payload_api)
-            except Exception as ex_del:
-                logger.error(f"❌ Falha no sync de remoção: {ex_del}")
+        removed = _cart_script_call(client, "remove_at", telefone, [int(index)])
+        _turn_invalidate(telefone, "cart")
+        if not removed:
+            return False
 
-            return True
-            
-        return False
+        logger.info(f"🗑️ Item '{json.loads(removed).get('produto', 'Item')}' removido do carrinho de {telefone}")
+        # --- AUTO-UPDATE (Sync Deletions) ---
+        _sync_sent_order(telefone, "remoção")
+        return True
     except Exception as e:
         logger.error(f"Erro ao remover item do carrinho: {e}")
         return False
-    finally:
-        try:
-            if client and lock_token:
-                _release_lock(client, _lock_key("cart", telefone), lock_token)
-        except Exception:
-            pass
 
 
 def update_item_quantity(telefone: str, index: int, quantidade_remover: float) -> dict:
     """
     Reduz a quantidade de um item no carrinho.
     Se a quantidade resultante for <= 0, remove o item completamente.
-    
+
     Args:
         telefone: Número do cliente
         index: Índice do item (0-based)
         quantidade_remover: Quantidade a ser removida (ex: 1 para tirar 1 unidade)
-    
+
     Returns:
         {
             "success": bool,
@@ -792,114 +1294,54 @@ def update_item_quantity(telefone: str, index: int, quantidade_remover: float) -
     client = get_redis_client()
     raw_phone = "" if telefone is None else str(telefone).strip()
     telefone = normalize_phone(raw_phone)
+    failed = {"success": False, "removed_completely": False, "new_quantity": 0, "item_name": ""}
     if client is None:
-        return {"success": False, "removed_completely": False, "new_quantity": 0, "item_name": ""}
+        return failed
 
-    lock_token = None
     try:
         if raw_phone and raw_phone != telefone:
             _maybe_migrate_key(client, f"cart:{raw_phone}", f"cart:{telefone}")
+        if index < 0:
+            return failed
 
-        lock_token = _acquire_lock(client, _lock_key("cart", telefone), ttl_seconds=30, wait_seconds=5)
-        if not lock_token:
-            logger.warning(f"⏳ Timeout aguardando lock do carrinho para {telefone}")
-            return {"success": False, "removed_completely": False, "new_quantity": 0, "item_name": ""}
+        res = _cart_script_call(client, "reduce_at", telefone, [int(index), float(quantidade_remover)])
+        _turn_invalidate(telefone, "cart")
+        if not res:
+            return failed
 
-        key = cart_key(telefone)
-        items = client.lrange(key, 0, -1)
-        
-        if not (0 <= index < len(items)):
-            return {"success": False, "removed_completely": False, "new_quantity": 0, "item_name": ""}
-        
-        # Parse do item
-        try:
-            item = json.loads(items[index])
-        except:
-            return {"success": False, "removed_completely": False, "new_quantity": 0, "item_name": ""}
-        
-        item_name = item.get("produto", "Item")
-        current_qty = float(item.get("quantidade", 1))
-        current_units = int(item.get("unidades", 0))
-        
-        # Calcular nova quantidade
-        new_qty = current_qty - quantidade_remover
-        
-        if new_qty <= 0:
-            # Remover item completamente
-            deleted_marker = "__DELETED__"
-            client.lset(key, index, deleted_marker)
-            client.lrem(key, 0, deleted_marker)
+        removed_completely, new_qty, item_name = bool(int(res[0])), float(res[1]), res[2]
+        if removed_completely:
             logger.info(f"🗑️ Item '{item_name}' removido completamente (quantidade <= 0)")
-            
-            result = {"success": True, "removed_completely": True, "new_quantity": 0, "item_name": item_name}
         else:
-            # Atualizar quantidade
-            item["quantidade"] = new_qty
-            
-            # Atualizar unidades proporcionalmente se aplicável
-            if current_units > 0:
-                proporcao = new_qty / current_qty
-                item["unidades"] = max(0, int(current_units * proporcao))
-            
-            # Salvar item atualizado
-            client.lset(key, index, json.dumps(item, ensure_ascii=False))
-            logger.info(f"📉 Item '{item_name}' atualizado: {current_qty} → {new_qty}")
-            
-            result = {"success": True, "removed_completely": False, "new_quantity": new_qty, "item_name": item_name}
-        
+            logger.info(f"📉 Item '{item_name}' atualizado: → {new_qty}")
+
         # --- AUTO-UPDATE (Sync Changes) ---
-        try:
-            session = get_order_session(telefone)
-            if session and session.get("status") == "sent":
-                from tools.http_tools import overwrite_order
-                full_cart_after = get_cart_items(telefone)
-                payload_api = json.dumps({"itens": full_cart_after}, ensure_ascii=False)
-                logger.info(f"🔄 Quantidade alterada em pedido enviado: Disparando overwrite_order()")
-                overwrite_order(telefone, payload_api)
-        except Exception as ex_upd:
-            logger.error(f"❌ Falha no sync de alteração: {ex_upd}")
-        
-        return result
-        
+        _sync_sent_order(telefone, "alteração de quantidade")
+
+        return {"success": True, "removed_completely": removed_completely, "new_quantity": new_qty, "item_name": item_name}
     except Exception as e:
         logger.error(f"Erro ao atualizar quantidade do item: {e}")
-        return {"success": False, "removed_completely": False, "new_quantity": 0, "item_name": ""}
-    finally:
-        try:
-            if client and lock_token:
-                _release_lock(client, _lock_key("cart", telefone), lock_token)
-        except Exception:
-            pass
+        return failed
 
 
 def clear_cart(telefone: str) -> bool:
-    """Remove todo o carrinho."""
+    """Remove todo o carrinho (hash + índice)."""
     client = get_redis_client()
     raw_phone = "" if telefone is None else str(telefone).strip()
     telefone = normalize_phone(raw_phone)
     if client is None:
         return False
 
-    lock_token = None
     try:
         if raw_phone and raw_phone != telefone:
             _maybe_migrate_key(client, f"cart:{raw_phone}", f"cart:{telefone}")
-        lock_token = _acquire_lock(client, _lock_key("cart", telefone), ttl_seconds=30, wait_seconds=5)
-        if not lock_token:
-            logger.warning(f"⏳ Timeout aguardando lock do carrinho para {telefone}")
-            return False
-        client.delete(cart_key(telefone))
+        client.delete(cart_key(telefone), cart_index_key(telefone))
+        _turn_set(telefone, "cart", [])
         logger.info(f"🛒 Carrinho limpo para {telefone}")
         return True
     except Exception as e:
         logger.error(f"Erro ao limpar carrinho: {e}")
         return False
-    finally:
-        try:
-            if client and lock_token:
-                _release_lock(client, _lock_key("cart", telefone), lock_token)
-        except Exception:
-            pass
 
 
 # ============================================
@@ -929,8 +1371,11 @@ def set_comprovante(telefone: str, url: str) -> bool:
         return False
     
     try:
-        key = comprovante_key(telefone)
-        client.set(key, url, ex=7200)  # 2 horas
+        if settings.redis_customer_hash:
+            customer_state.set_field(client, telefone, "comprovante", url, 7200)
+        else:
+            client.set(comprovante_key(telefone), url, ex=7200)  # 2 horas
+        _turn_set(telefone, "comprovante", url)
         logger.info(f"🧾 Comprovante PIX salvo para {telefone}: {url[:50]}...")
         return True
     except Exception as e:
@@ -945,14 +1390,21 @@ def get_comprovante(telefone: str) -> Optional[str]:
     Returns:
         URL do comprovante ou None
     """
-    client = get_redis_client()
     telefone = normalize_phone(telefone)
+    ctx = current_turn(telefone)
+    if ctx is not None and ctx.has("comprovante"):
+        return ctx.get("comprovante")
+    client = get_redis_client()
     if client is None:
         return None
     
     try:
-        key = comprovante_key(telefone)
-        url = client.get(key)
+        if settings.redis_customer_hash:
+            url = customer_state.get_field(client, telefone, "comprovante")
+        else:
+            url = client.get(comprovante_key(telefone))
+        if ctx is not None:
+            ctx.set("comprovante", url)
         if url:
             logger.info(f"🧾 Comprovante recuperado para {telefone}")
         return url
@@ -969,7 +1421,11 @@ def clear_comprovante(telefone: str) -> bool:
         return False
     
     try:
-        client.delete(comprovante_key(telefone))
+        if settings.redis_customer_hash:
+            customer_state.delete_fields(client, telefone, "comprovante")
+        else:
+            client.delete(comprovante_key(telefone))
+        _turn_set(telefone, "comprovante", None)
         logger.info(f"🧾 Comprovante limpo para {telefone}")
         return True
     except Exception as e:
@@ -996,8 +1452,11 @@ def set_address(telefone: str, endereco: str) -> bool:
         return False
     
     try:
-        key = address_key(telefone)
-        client.set(key, endereco, ex=7200)  # 2 horas
+        if settings.redis_customer_hash:
+            customer_state.set_field(client, telefone, "address", endereco, 7200)
+        else:
+            client.set(address_key(telefone), endereco, ex=7200)  # 2 horas
+        _turn_set(telefone, "address", endereco)
         logger.info(f"🏠 Endereço salvo para {telefone}: {endereco[:50]}...")
         return True
     except Exception as e:
@@ -1007,14 +1466,21 @@ def set_address(telefone: str, endereco: str) -> bool:
 
 def get_address(telefone: str) -> Optional[str]:
     """Recupera o endereço salvo do cliente."""
-    client = get_redis_client()
     telefone = normalize_phone(telefone)
+    ctx = current_turn(telefone)
+    if ctx is not None and ctx.has("address"):
+        return ctx.get("address")
+    client = get_redis_client()
     if client is None:
         return None
     
     try:
-        key = address_key(telefone)
-        addr = client.get(key)
+        if settings.redis_customer_hash:
+            addr = customer_state.get_field(client, telefone, "address")
+        else:
+            addr = client.get(address_key(telefone))
+        if ctx is not None:
+            ctx.set("address", addr)
         if addr:
             logger.info(f"🏠 Endereço recuperado para {telefone}")
         return addr
@@ -1031,7 +1497,11 @@ def clear_address(telefone: str) -> bool:
         return False
     
     try:
-        client.delete(address_key(telefone))
+        if settings.redis_customer_hash:
+            customer_state.delete_fields(client, telefone, "address")
+        else:
+            client.delete(address_key(telefone))
+        _turn_set(telefone, "address", None)
         logger.info(f"🏠 Endereço limpo para {telefone}")
         return True
     except Exception as e:
@@ -1055,6 +1525,35 @@ def get_saved_address(telefone: str) -> Optional[str]:
 # ============================================
 
 SUGGESTIONS_TTL = 600  # 10 minutos
+SUGGESTIONS_MAX = 60  # Limite de produtos no hash (os mais antigos saem primeiro)
+
+# Hash suggestions:{tel}: campo = nome normalizado, valor = "<ts_ms>|<json>".
+# KEYS: suggestions:{tel}; ARGV: ttl, limite, campo1, valor1, campo2, valor2...
+_SUGGESTIONS_SAVE_LUA = """
+local key, cap = KEYS[1], tonumber(ARGV[2])
+if redis.call('TYPE', key).ok ~= 'hash' then
+    redis.call('DEL', key)  -- formato antigo (JSON numa string)
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', key, ARGV[i], ARGV[i + 1])
+end
+local n = redis.call('HLEN', key)
+if n > cap then
+    local all = redis.call('HGETALL', key)
+    local items = {}
+    for i = 1, #all, 2 do
+        items[#items + 1] = {all[i], tonumber(string.match(all[i + 1], '^(%d+)|')) or 0}
+    end
+    table.sort(items, function(a, b) return a[2] < b[2] end)
+    for i = 1, n - cap do
+        redis.call('HDEL', key, items[i][1])
+    end
+    n = cap
+end
+redis.call('EXPIRE', key, ARGV[1])
+return n
+"""
+
 
 def suggestions_key(telefone: str) -> str:
     """Chave para armazenar produtos sugeridos."""
@@ -1065,10 +1564,13 @@ def save_suggestions(telefone: str, products: List[Dict]) -> bool:
     """
     Salva os produtos sugeridos pelo Analista para o cliente.
     O Vendedor pode recuperar esses dados quando o cliente confirmar.
+
+    Merge (mesmo nome normalizado sobrescreve), limite e TTL são aplicados
+    no Redis por script Lua: uma ida, sem ler/decodificar a lista anterior.
     
     Args:
         telefone: Número do cliente
-        products: Lista de produtos [{nome, preco, termo_busca}, ...]
+        products: Lista de produtos [{nome, preco, termo_busca, match_ok}, ...]
     
     Returns:
         True se salvo com sucesso
@@ -1080,62 +1582,94 @@ def save_suggestions(telefone: str, products: List[Dict]) -> bool:
         return False
     
     try:
-        key = suggestions_key(telefone)
-        
-        # 1. Recuperar existentes para merge
-        existing_data = client.get(key)
-        existing_products = []
-        if existing_data:
-            try:
-                existing_products = json.loads(existing_data)
-            except:
-                pass
-                
-        # 2. Merge com novos (deduplicando por nome)
-        # Mapa para deduplicar: chave = nome_lower
-        prod_map = {p.get("nome", "").lower(): p for p in existing_products}
-        
-        for new_p in products:
-            nome = new_p.get("nome", "").lower()
-            # Sobrescreve anterior se existir (assumindo que o novo é mais recente/melhor)
-            # Ou mantém ambos? Melhor sobrescrever se for o mesmo produto para atualizar preço
-            prod_map[nome] = new_p
-            
-        final_list = list(prod_map.values())
-        
-        # Salvar como JSON
-        client.set(key, json.dumps(final_list, ensure_ascii=False), ex=SUGGESTIONS_TTL)
-        logger.info(f"💡 {len(final_list)} sugestões salvas (Merge: {len(existing_products)} + {len(products)}) para {telefone}")
+        ts = int(time.time() * 1000)
+        entries: Dict[str, Dict] = {}
+        for p in products:
+            field = normalize_name(p.get("nome", ""))
+            if field:
+                entries[field] = {**p, "ts": ts}
+        if not entries:
+            return True
+
+        args: List[Any] = [SUGGESTIONS_TTL, SUGGESTIONS_MAX]
+        for field, entry in entries.items():
+            args.extend([field, f"{ts}|{json.dumps(entry, ensure_ascii=False)}"])
+        total = registered_script(client, "suggestions:save", _SUGGESTIONS_SAVE_LUA)(
+            keys=[suggestions_key(telefone)], args=args
+        )
+
+        ctx = current_turn(telefone)
+        if ctx is not None and ctx.has("suggestions"):
+            merged = {normalize_name(s.get("nome", "")): s for s in ctx.get("suggestions")}
+            merged.update(entries)
+            ordered = sorted(merged.values(), key=lambda s: s.get("ts", 0))[-SUGGESTIONS_MAX:]
+            ctx.set("suggestions", ordered)
+            ctx.invalidate("suggestions_index")
+        logger.info(f"💡 {total} sugestões no cache (+{len(entries)}) para {telefone}")
         return True
     except Exception as e:
         logger.error(f"Erro ao salvar sugestões: {e}")
         return False
 
 
+def _parse_suggestions(fields: Optional[Dict[str, str]]) -> List[Dict]:
+    """Converte o HGETALL do hash em lista (mais antigas primeiro)."""
+    products = []
+    for value in (fields or {}).values():
+        _, _, raw = value.partition("|")
+        try:
+            entry = json.loads(raw)
+        except Exception:
+            continue
+        if isinstance(entry, dict):
+            products.append(entry)
+    products.sort(key=lambda s: s.get("ts", 0))
+    return products
+
+
 def get_suggestions(telefone: str) -> List[Dict]:
     """
     Recupera os produtos sugeridos anteriormente para o cliente.
     
     Returns:
-        Lista de produtos [{nome, preco, termo_busca}, ...] ou lista vazia
+        Lista de produtos [{nome, preco, termo_busca, match_ok, ts}, ...] ou lista vazia
     """
+    ctx = current_turn(normalize_phone(telefone))
+    if ctx is not None and ctx.has("suggestions"):
+        return list(ctx.get("suggestions"))
     client = get_redis_client()
     if client is None:
         return []
     
     try:
-        key = suggestions_key(telefone)
-        data = client.get(key)
-        if data:
-            products = json.loads(data)
+        try:
+            products = _parse_suggestions(client.hgetall(suggestions_key(telefone)))
+        except redis.exceptions.ResponseError:
+            products = []  # Formato antigo (string): expira sozinho ou é trocado no próximo save
+        if ctx is not None:
+            ctx.set("suggestions", products)
+        if products:
             logger.info(f"💡 Sugestões recuperadas para {telefone}: {len(products)} produtos")
-            return products if isinstance(products, list) else []
-        return []
+        return list(products)
     except Exception as e:
         logger.error(f"Erro ao recuperar sugestões: {e}")
         return []
 
 
+def find_suggestion(telefone: str, produto: str) -> Tuple[Optional[Dict], bool]:
+    """
+    Sugestão correspondente ao produto via índice de trigramas: (sugestão, é_substring).
+    O índice é montado uma vez por turno (fica no contexto do turno).
+    """
+    ctx = current_turn(normalize_phone(telefone))
+    index = ctx.get("suggestions_index") if ctx is not None else None
+    if index is None:
+        index = SuggestionIndex(get_suggestions(telefone))
+        if ctx is not None:
+            ctx.set("suggestions_index", index)
+    return index.find(produto)
+
+
 def clear_suggestions(telefone: str) -> bool:
     """Remove as sugestões após serem usadas."""
     client = get_redis_client()
@@ -1144,6 +1678,8 @@ def clear_suggestions(telefone: str) -> bool:
     
     try:
         client.delete(suggestions_key(telefone))
+        _turn_set(normalize_phone(telefone), "suggestions", [])
+        _turn_invalidate(telefone, "suggestions_index")
         logger.info(f"💡 Sugestões limpas para {telefone}")
         return True
     except Exception as e:
@@ -1154,68 +1690,198 @@ def clear_suggestions(telefone: str) -> bool:
 # Circuit Breaker (Disjuntor de API)
 # ============================================
 
-def circuit_failure_key(service: str) -> str:
-    return f"circuit:failures:{service}"
-
-def circuit_open_key(service: str) -> str:
-    return f"circuit:open:{service}"
+# O estado fica em memória do processo (tools/circuit_breaker.py); o Redis só
+# é usado nas transições (pub/sub entre server e worker). Estas funções ficam
+# como atalho para quem já as chamava.
 
 def check_circuit_open(service: str) -> bool:
     """
     Verifica se o disjuntor está ABERTO (serviço fora do ar).
     Retorna True se estiver aberto (não deve chamar o serviço).
+    No meio-aberto, a primeira consulta é liberada como chamada de teste.
     """
-    client = get_redis_client()
-    if client is None: return False
-    
-    try:
-        # Se a chave circuit:open existir, o circuito está aberto
-        is_open = client.get(circuit_open_key(service))
-        if is_open:
-            logger.warning(f"⚡ Circuit Breaker ABERTO para {service}. Bloqueando chamada.")
-            return True
-        return False
-    except:
+    from tools.circuit_breaker import get_breaker
+
+    if get_breaker(service).allow():
         return False
+    logger.warning(f"⚡ Circuit Breaker ABERTO para {service}. Bloqueando chamada.")
+    return True
 
 def report_failure(service: str, threshold: int = 15, cooldown: int = 30) -> None:
     """
-    Reporta uma falha no serviço. Se atingir o threshold, abre o circuito.
-    Aumentado threshold (5->15) e reduzido cooldown (60->30) para evitar falsos positivos de "sistema fora".
+    Reporta uma falha no serviço. Se atingir o threshold (janela de 1 min), abre o circuito.
+    threshold/cooldown valem na criação do disjuntor do serviço.
+    """
+    from tools.circuit_breaker import get_breaker
+
+    get_breaker(service, threshold=threshold, cooldown=cooldown).record_failure()
+
+def report_success(service: str) -> None:
     """
+    Reporta sucesso: zera as falhas e, se estava meio-aberto, fecha o circuito.
+    """
+    from tools.circuit_breaker import get_breaker
+
+    get_breaker(service).record_success()
+
+
+# ============================================
+# Contexto do Turno (snapshot em uma ida ao Redis)
+# ============================================
+
+def _turn_set(telefone: str, field: str, value) -> None:
+    ctx = current_turn(normalize_phone(telefone))
+    if ctx is not None:
+        ctx.set(field, value)
+
+
+def _turn_invalidate(telefone: str, field: str) -> None:
+    ctx = current_turn(normalize_phone(telefone))
+    if ctx is not None:
+        ctx.invalidate(field)
+
+
+def _expire_or_defer(client: redis.Redis, telefone: str, key: str, ttl_seconds: int) -> None:
+    """EXPIRE imediato fora de turno; dentro do turno, vai para o flush final (dedup por chave)."""
+    ctx = current_turn(normalize_phone(telefone))
+    if ctx is not None:
+        ctx.defer(f"expire:{key}", "expire", key, ttl_seconds)
+        return
+    client.expire(key, ttl_seconds)
+
+
+def _queue_turn_reads(pipe, telefone: str, history_key: Optional[str]) -> None:
+    pipe.get(order_session_key(telefone))
+    pipe.hgetall(cart_key(telefone))
+    pipe.zrange(cart_index_key(telefone), 0, -1)
+    pipe.hgetall(suggestions_key(telefone))
+    if settings.redis_customer_hash:
+        # Estado pequeno do cliente num único HGETALL (+ HTTL do cooldown no Redis >= 7.4)
+        customer_state.queue_snapshot_reads(pipe, telefone, customer_state.field_ttl_supported(get_redis_client()))
+    else:
+        pipe.get(address_key(telefone))
+        pipe.get(comprovante_key(telefone))
+        pipe.ttl(cooldown_key(telefone))
+    if history_key:
+        pipe.lrange(history_key, 0, -1)
+
+
+def _customer_turn_results(results: List) -> List:
+    """Converte as leituras do hash cust:{tel} no mesmo formato das chaves separadas."""
+    native = customer_state.native_field_ttl()
+    width = 2 if native else 1
+    raw = results[4:4 + width]
+    if any(isinstance(r, Exception) for r in raw):
+        values = [raw[0]] * 3
+    else:
+        fields, cooldown_ttl = customer_state.parse_snapshot(raw, native)
+        values = [fields.get("address"), fields.get("comprovante"), cooldown_ttl]
+    return list(results[:4]) + values + list(results[4 + width:])
+
+
+def _fill_turn_context(ctx: TurnContext, results: List, history_key: Optional[str]) -> None:
+    if settings.redis_customer_hash:
+        results = _customer_turn_results(results)
+    # Leitura que falhou (ex: WRONGTYPE) fica fora do snapshot: a função lê direto do Redis
+    ok = [not isinstance(r, Exception) for r in results]
+    session_raw, cart_fields, cart_order, sugg_raw, addr, comprovante, cooldown_ttl = results[:7]
+    if ok[0]:
+        try:
+            ctx.set("session", json.loads(session_raw) if session_raw else None)
+        except Exception:
+            pass
+    if ok[1] and ok[2]:
+        ctx.set("cart", _cart_items_from_hash(cart_fields, cart_order))
+    if ok[3]:
+        ctx.set("suggestions", _parse_suggestions(sugg_raw))
+    if ok[4]:
+        ctx.set("address", addr)
+    if ok[5]:
+        ctx.set("comprovante", comprovante)
+    if ok[6]:
+        ctx.set("cooldown_ttl", cooldown_ttl if isinstance(cooldown_ttl, int) else -2)
+    if history_key and ok[7]:
+        ctx.set("history_key", history_key)
+        ctx.set("history", list(results[7] or []))
+
+
+def begin_agent_turn(telefone: str, history_key: Optional[str] = None,
+                     ttl_seconds: int = 600, wait_seconds: int = 120) -> Tuple[Optional[str], Optional[TurnContext]]:
+    """
+    Adquire o lock do agente e carrega o snapshot do turno na MESMA ida ao Redis
+    (MULTI: ACQUIRE_LOCK_SCRIPT + leituras de sessão, carrinho, sugestões,
+    endereço, comprovante, cooldown e histórico).
+
+    Se o lock estiver ocupado (ou houver fila), o turno já entrou na fila FIFO:
+    espera a vez como acquire_agent_lock, com o mesmo token, e recarrega.
+    Retorna (lock_token, ctx). lock_token None = ocupado; ctx None = sem Redis.
+    O contexto fica ativo até finish_agent_turn().
+    """
+    telefone = normalize_phone(telefone)
     client = get_redis_client()
-    if client is None: return
+    if client is None:
+        return "NOLOCK", None
 
+    ctx = TurnContext(telefone)
+    lock_key = _lock_key("agent", telefone)
+    ctx.ctx_token = begin_turn(ctx)
     try:
-        fkey = circuit_failure_key(service)
-        # Incrementa contador de falhas (TTL 60s para janela de falhas)
-        failures = client.incr(fkey)
-        if failures == 1:
-            client.expire(fkey, 60) # Janela de 1 min para acumular falhas
-            
-        if failures >= threshold:
-            # Abre o circuito!
-            okey = circuit_open_key(service)
-            client.set(okey, "1", ex=cooldown)
-            logger.critical(f"⚡⚡ CIRCUIT BREAKER DISPARADO: {service} falhou {failures}x. Pausando por {cooldown}s.")
-            # Limpa contador para reiniciar ciclo após cooldown
-            client.delete(fkey)
-            
+        token = uuid.uuid4().hex
+        pipe = client.pipeline(transaction=True)
+        # Mesmo script do acquire_agent_lock: respeita quem já está na fila
+        registered_script(client, "lock:acquire", ACQUIRE_LOCK_SCRIPT)(
+            keys=lock_keys(lock_key),
+            args=[token, max(1, int(ttl_seconds)) * 1000, int(time.time() * 1000), LOCK_HEARTBEAT_MS],
+            client=pipe,
+        )
+        _queue_turn_reads(pipe, telefone, history_key)
+        results = pipe.execute(raise_on_error=False)
+        if isinstance(results[0], Exception):
+            raise results[0]
+        if not results[0]:
+            # Na fila: o que foi lido pode mudar até chegar a vez deste turno
+            token = _acquire_lock(client, lock_key, ttl_seconds=ttl_seconds, wait_seconds=wait_seconds, token=token)
+            if not token:
+                end_turn(ctx.ctx_token)
+                return None, None
+            pipe = client.pipeline(transaction=False)
+            _queue_turn_reads(pipe, telefone, history_key)
+            results = [True] + pipe.execute(raise_on_error=False)
+        _fill_turn_context(ctx, results[1:], history_key)
     except Exception as e:
-        logger.error(f"Erro no circuit breaker (fail): {e}")
+        logger.error(f"Erro ao carregar contexto do turno para {telefone}: {e}")
+        end_turn(ctx.ctx_token)
+        return acquire_agent_lock(telefone, ttl_seconds=ttl_seconds, wait_seconds=wait_seconds), None
+    ctx.lock_token = token
+    return token, ctx
 
-def report_success(service: str) -> None:
+
+def finish_agent_turn(telefone: str, lock_token: Optional[str], ctx: Optional[TurnContext]) -> None:
     """
-    Reporta sucesso. Se o circuito estava instável, reseta contadores.
+    Fim do turno: escritas adiadas + liberação do lock numa única ida ao Redis,
+    desativa o contexto e registra a métrica de round trips do turno.
     """
+    telefone = normalize_phone(telefone)
     client = get_redis_client()
-    if client is None: return
-
     try:
-        # Se houve sucesso, podemos limpar a contagem de falhas recente
-        # Isso implementa uma recuperação "Half-Open" implícita: se passar uma, zera as falhas.
-        fkey = circuit_failure_key(service)
-        if client.exists(fkey):
-            client.delete(fkey)
+        if client is not None:
+            pipe = client.pipeline(transaction=False)
+            for command, args in (ctx.drain() if ctx else []):
+                getattr(pipe, command)(*args)
+            lock_key = None
+            if lock_token and lock_token != "NOLOCK":
+                lock_key = _lock_key("agent", telefone)
+                pipe.eval(RELEASE_LOCK_SCRIPT, 3, *lock_keys(lock_key), *release_lock_args(lock_token))
+            results = pipe.execute()
+            if lock_key is not None and results:
+                wake_lock_waiter(client, lock_key, results[-1])
     except Exception as e:
-        logger.error(f"Erro no circuit breaker (success): {e}")
+        logger.error(f"Erro ao finalizar turno de {telefone}: {e}")
+    finally:
+        if ctx is not None:
+            metrics.record("redis.round_trips_per_turn", ctx.round_trips)
+            logger.info(f"📡 Redis: {ctx.round_trips} round trips no turno de {telefone}")
+            try:
+                end_turn(ctx.ctx_token)
+            except Exception:
+                pass
@@ -0,0 +1,88 @@
+"""
+Formato dos resultados de ferramenta entregues ao LLM
+
+O resultado de cada ferramenta fica no histórico e volta como entrada em
+todos os passos seguintes do ReAct. Em JSON, cada produto repete os nomes
+dos campos (e o estoque por EAN vinha com indent=2), então 8-25 produtos
+custam centenas de tokens por passo.
+
+Com settings.tool_result_format = "compact" (padrão) o resultado vira uma
+tabela: uma linha de cabeçalho e uma linha por produto, campos separados
+por "|", números arredondados e só os campos que o prompt usa:
+
+    id|nome|preco|unidade|estoque|match_ok
+    8812|LEITE INTEGRAL ITALAC 1L|5.49|UN|12|1
+
+"json" mantém o formato antigo (lista JSON). A conversão acontece só na
+borda da ferramenta: o JSON interno (sugestões, cache de EAN) não muda.
+"""
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+from config.settings import settings
+
+SEARCH_COLUMNS = ("id", "nome", "preco", "unidade", "estoque", "match_ok")
+# vl_produto duplica preco; disponibilidade é sempre true (indisponíveis já saem filtrados)
+ESTOQUE_COLUMNS = ("id", "produto", "preco", "vl_produto_normal", "qtd_produto", "emb", "fracionado")
+EMPTY_RESULT = "Nenhum produto encontrado."
+
+
+def use_compact() -> bool:
+    return (settings.tool_result_format or "").strip().lower() == "compact"
+
+
+def _cell(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        return f"{value:.2f}".rstrip("0").rstrip(".")
+    return str(value).replace("|", "/").replace("\n", " ").strip()
+
+
+def render_table(records: List[Dict[str, Any]], columns: Optional[Sequence[str]] = None) -> str:
+    """Cabeçalho + uma linha por registro. Sem columns, usa todas as chaves (na ordem em que aparecem)."""
+    if columns is None:
+        columns = list(dict.fromkeys(k for r in records for k in r))
+    lines = ["|".join(columns)]
+    lines.extend("|".join(_cell(r.get(c)) for c in columns) for r in records)
+    return "\n".join(lines)
+
+
+def _stock(value: Any) -> float:
+    """Estoque com 2 casas (_cell); fracionado positivo (ex: 0.35 kg nos frios) nunca vira 0 = indisponível."""
+    estoque = float(value or 0)
+    return 0.01 if 0 < estoque < 0.01 else estoque
+
+
+def render_products(items: List[Dict[str, Any]]) -> str:
+    """Resultado da busca_produto_tool. Avisos (ex: ambiguidade de categoria) vão antes da tabela."""
+    if not use_compact():
+        return json.dumps(items, ensure_ascii=False)
+    avisos = [f"⚠️ {i['aviso']}" for i in items if i.get("aviso")]
+    produtos = [{**i, "estoque": _stock(i.get("estoque"))} for i in items if not i.get("aviso")]
+    body = render_table(produtos, SEARCH_COLUMNS) if produtos else EMPTY_RESULT
+    return "\n".join(avisos + [body])
+
+
+def render_estoque(raw: str) -> str:
+    """
+    Resultado de estoque()/estoque_preco() (JSON guardado em cache). Mensagens
+    de erro (texto) e o modo "json" passam sem mudança.
+    """
+    if not use_compact():
+        return raw
+    try:
+        data = json.loads(raw)
+    except (TypeError, ValueError):
+        return raw
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or not all(isinstance(d, dict) for d in data):
+        return raw
+    if not data:
+        return EMPTY_RESULT
+    # Resposta da API de EAN (campos conhecidos) ou da consulta por nome (campos variam)
+    columns = ESTOQUE_COLUMNS if any("qtd_produto" in d or "vl_produto" in d for d in data) else None
+    return render_table(data, columns)
@@ -0,0 +1,78 @@
+"""
+Índice de trigramas das sugestões do Analista (auto-healing de preço no add_item_tool)
+
+As sugestões ficam no hash suggestions:{tel} (campo = nome normalizado).
+O índice é montado uma vez a partir desse hash (e guardado no contexto do
+turno): busca exata por nome normalizado é um acesso ao dict, e a busca
+aproximada só compara (substring / difflib) os candidatos que compartilham
+trigramas com o produto, em vez de varrer todas as sugestões.
+"""
+import difflib
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+FUZZY_MIN_RATIO = 0.6
+
+
+def normalize_name(nome: str) -> str:
+    """Nome normalizado (minúsculo, sem acento, espaços simples) = campo no hash."""
+    text = unicodedata.normalize("NFKD", (nome or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SuggestionIndex:
+    """Sugestões por nome normalizado + índice trigrama -> nomes."""
+
+    def __init__(self, entries: List[Dict]):
+        # Mais recentes primeiro: em empate de substring, vence a última busca
+        ordered = sorted(entries, key=lambda e: e.get("ts", 0), reverse=True)
+        self.by_key: Dict[str, Dict] = {}
+        self.rank: Dict[str, int] = {}
+        self.grams: Dict[str, Set[str]] = defaultdict(set)
+        for entry in ordered:
+            key = normalize_name(entry.get("nome", ""))
+            if not key or key in self.by_key:
+                continue
+            self.rank[key] = len(self.by_key)
+            self.by_key[key] = entry
+            for gram in trigrams(key):
+                self.grams[gram].add(key)
+
+    def __len__(self) -> int:
+        return len(self.by_key)
+
+    def _candidates(self, key: str) -> List[str]:
+        found: Set[str] = set()
+        for gram in trigrams(key):
+            found |= self.grams.get(gram, set())
+        return sorted(found, key=self.rank.__getitem__)
+
+    def find(self, produto: str) -> Tuple[Optional[Dict], bool]:
+        """
+        Melhor sugestão para o produto: (sugestão, é_substring).
+        Substring (um nome contém o outro) tem prioridade; senão, o maior
+        difflib ratio acima de FUZZY_MIN_RATIO entre os candidatos.
+        """
+        key = normalize_name(produto)
+        if not key:
+            return None, False
+        if key in self.by_key:
+            return self.by_key[key], True
+        candidates = self._candidates(key)
+        for cand in candidates:
+            if key in cand or cand in key:
+                return self.by_key[cand], True
+        best, best_score = None, FUZZY_MIN_RATIO
+        for cand in candidates:
+            ratio = difflib.SequenceMatcher(None, key, cand).ratio()
+            if ratio > best_score:
+                best, best_score = cand, ratio
+        return (self.by_key[best], False) if best else (None, False)
@@ -0,0 +1,95 @@
+"""
+Contexto do turno do agente (snapshot do Redis carregado em uma única ida)
+
+No início do turno, redis_tools.begin_agent_turn() lê carrinho, sessão,
+sugestões, endereço, comprovante, cooldown e histórico num só pipeline.
+As leituras das tools são servidas deste snapshot; escritas "adiáveis"
+(renovação de TTL, append do histórico) são acumuladas e enviadas em lote
+no fim do turno (redis_tools.finish_agent_turn).
+
+O contexto ativo fica num ContextVar, então vale também para as tools que o
+LangGraph executa em threads (o contexto é copiado para o executor).
+"""
+import contextvars
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+_current: contextvars.ContextVar[Optional["TurnContext"]] = contextvars.ContextVar("turn_context", default=None)
+
+
+class TurnContext:
+    """Snapshot do estado do cliente durante um turno + escritas pendentes."""
+
+    def __init__(self, telefone: str):
+        self.telefone = telefone
+        self.values: Dict[str, Any] = {}
+        # Comandos adiados: (chave_dedup, comando, args). Mesma chave = último vence
+        self.pending: Dict[str, Tuple[str, tuple]] = {}
+        self.pending_lists: List[Tuple[str, tuple]] = []
+        self.round_trips = 0
+        self._lock = threading.Lock()  # Tools paralelas do LangGraph rodam em threads
+        self.lock_token: Optional[str] = None
+        self.ctx_token: Optional[contextvars.Token] = None
+
+    def get(self, field: str, default: Any = None) -> Any:
+        return self.values.get(field, default)
+
+    def has(self, field: str) -> bool:
+        return field in self.values
+
+    def set(self, field: str, value: Any) -> None:
+        self.values[field] = value
+
+    def invalidate(self, field: str) -> None:
+        self.values.pop(field, None)
+
+    def defer(self, dedup_key: str, command: str, *args) -> None:
+        """Adia um comando idempotente (ex: EXPIRE) para o flush do fim do turno."""
+        with self._lock:
+            self.pending[dedup_key] = (command, args)
+
+    def defer_append(self, command: str, *args) -> None:
+        """Adia um comando de append (ordem preservada, sem dedup)."""
+        with self._lock:
+            self.pending_lists.append((command, args))
+
+    def discard_key(self, key: str) -> None:
+        """Descarta escritas pendentes de uma chave (ex: histórico limpo no meio do turno)."""
+        with self._lock:
+            self.pending_lists = [c for c in self.pending_lists if not c[1] or c[1][0] != key]
+            self.pending = {k: c for k, c in self.pending.items() if not c[1] or c[1][0] != key}
+
+    def drain(self) -> List[Tuple[str, tuple]]:
+        """Retorna e limpa os comandos pendentes (appends primeiro, depois TTLs)."""
+        with self._lock:
+            commands = list(self.pending_lists) + list(self.pending.values())
+            self.pending_lists.clear()
+            self.pending.clear()
+        return commands
+
+
+def begin_turn(ctx: TurnContext) -> contextvars.Token:
+    return _current.set(ctx)
+
+
+def end_turn(token: contextvars.Token) -> None:
+    _current.reset(token)
+
+
+def current_turn(telefone: Optional[str] = None) -> Optional[TurnContext]:
+    """Contexto ativo (opcionalmente só se for do mesmo telefone)."""
+    ctx = _current.get()
+    if ctx is None:
+        return None
+    if telefone is not None and ctx.telefone != telefone:
+        return None
+    return ctx
+
+
+def count_round_trip() -> None:
+    """Contabiliza uma ida ao Redis no turno ativo (chamado pelo cliente Redis)."""
+    ctx = _current.get()
+    if ctx is not None:
+        with ctx._lock:
+            ctx.round_trips += 1
+
@@ -4,17 +4,89 @@ WhatsApp API - UAZAPI Integration
 Integração com a API UAZAPI para envio/recebimento de mensagens WhatsApp.
 
 Documentação: https://docs.uazapi.com/
+
+- WhatsAppAPI: cliente síncrono (requests.Session keep-alive), para o server e scripts
+- AsyncWhatsAppAPI: mesma interface em async (httpx.AsyncClient), para o
+  worker ARQ — pool keep-alive compartilhado, timeout por endpoint e retry
 """
 
+import asyncio
+import random
 import requests
 import json
 import re
 from typing import Optional, Dict, Any
+
+import httpx
+
 from config.settings import settings
 from config.logger import setup_logger
+from tools import metrics
+from tools.circuit_breaker import get_breaker
 
 logger = setup_logger(__name__)
 
+# Timeout total (s) por endpoint; a conexão em si tem UAZAPI_CONNECT_TIMEOUT
+ENDPOINT_TIMEOUTS = {
+    "/send/text": 15.0,
+    "/send/media": 30.0,
+    "/message/presence": 5.0,
+    "/message/markread": 5.0,
+    "/message/download": 30.0,
+}
+UAZAPI_CONNECT_TIMEOUT = 3.0
+
+# Endpoints sem efeito colateral duplicável: retry em qualquer falha transitória.
+# Nos envios (/send/*) só há retry quando a requisição certamente não chegou
+# à UAZAPI (falha de conexão / pool) ou foi recusada com 429.
+IDEMPOTENT_ENDPOINTS = {"/message/presence", "/message/markread", "/message/download"}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+UAZAPI_SERVICE = "uazapi"  # Nome do circuit breaker (falha = 5xx ou erro de rede após os retries)
+
+
+_sync_session: Optional[requests.Session] = None
+
+
+def get_sync_session() -> requests.Session:
+    """Session requests compartilhada (keep-alive) do cliente síncrono."""
+    global _sync_session
+    if _sync_session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=settings.uazapi_http_max_connections
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _sync_session = session
+    return _sync_session
+
+
+def _media_type(mimetype: Optional[str]) -> str:
+    """Tipo de mídia da UAZAPI a partir do mimetype (padrão: image)."""
+    if mimetype:
+        if "video" in mimetype:
+            return "video"
+        if "audio" in mimetype:
+            return "audio"
+        if "pdf" in mimetype or "document" in mimetype:
+            return "document"
+    return "image"
+
+
+def _parse_download(data: Any) -> Optional[Dict[str, str]]:
+    """Normaliza a resposta do /message/download para {"base64", "mimetype"}."""
+    # UAZAPI pode retornar em diferentes formatos
+    if isinstance(data, dict):
+        # Formato: { "success": true, "data": { "base64": "...", "mimetype": "..." } }
+        if data.get("success") and "data" in data:
+            return data["data"]
+        # Formato direto: { "base64": "...", "mimetype": "..." }
+        if "base64" in data:
+            return data
+    logger.warning(f"⚠️ Formato de resposta inesperado: {str(data)[:200]}")
+    return None
+
 
 class WhatsAppAPI:
     """
@@ -89,7 +161,7 @@ class WhatsAppAPI:
         logger.info(f"📤 Enviando texto para {clean_num}: {text[:50]}...")
         
         try:
-            resp = requests.post(url, headers=self._get_headers(), json=payload, timeout=15)
+            resp = get_sync_session().post(url, headers=self._get_headers(), json=payload, timeout=15)
             
             if resp.status_code == 200:
                 logger.info(f"✅ Mensagem enviada para {clean_num}")
@@ -118,14 +190,7 @@ class WhatsAppAPI:
         clean_num = self._clean_number(to)
         
         # Determinar tipo de mídia
-        mediatype = "image"  # Default
-        if mimetype:
-            if "video" in mimetype:
-                mediatype = "video"
-            elif "audio" in mimetype:
-                mediatype = "audio"
-            elif "pdf" in mimetype or "document" in mimetype:
-                mediatype = "document"
+        mediatype = _media_type(mimetype)
         
         # Usar URL ou Base64
         media_content = base64_data if base64_data else media_url
@@ -141,7 +206,7 @@ class WhatsAppAPI:
         logger.info(f"📷 Enviando mídia ({mediatype}) para {clean_num}")
         
         try:
-            resp = requests.post(url, headers=self._get_headers(), json=payload, timeout=30)
+            resp = get_sync_session().post(url, headers=self._get_headers(), json=payload, timeout=30)
             
             if resp.status_code == 200:
                 logger.info(f"✅ Mídia enviada para {clean_num}")
@@ -176,7 +241,7 @@ class WhatsAppAPI:
         }
         
         try:
-            requests.post(url, headers=self._get_headers(), json=payload, timeout=5)
+            get_sync_session().post(url, headers=self._get_headers(), json=payload, timeout=5)
             logger.debug(f"⌨️ Presença '{presence}' enviada para {clean_num}")
             return True
         except Exception:
@@ -201,7 +266,7 @@ class WhatsAppAPI:
         logger.info(f"👀 Marcando como lido: {message_id}")
         
         try:
-            resp = requests.post(url, headers=self._get_headers(), json=payload, timeout=5)
+            resp = get_sync_session().post(url, headers=self._get_headers(), json=payload, timeout=5)
             if resp.status_code == 200:
                 logger.info(f"✅ Mensagem marcada como lida")
                 return True
@@ -236,22 +301,10 @@ class WhatsAppAPI:
         logger.info(f"🖼️ Baixando mídia: {message_id}")
         
         try:
-            resp = requests.post(url, headers=self._get_headers(), json=payload, timeout=30)
+            resp = get_sync_session().post(url, headers=self._get_headers(), json=payload, timeout=30)
             
             if resp.status_code == 200:
-                data = resp.json()
-                
-                # UAZAPI pode retornar em diferentes formatos
-                if isinstance(data, dict):
-                    # Formato: { "success": true, "data": { "base64": "...", "mimetype": "..." } }
-                    if data.get("success") and "data" in data:
-                        return data["data"]
-                    # Formato direto: { "base64": "...", "mimetype": "..." }
-                    if "base64" in data:
-                        return data
-                
-                logger.warning(f"⚠️ Formato de resposta inesperado: {str(data)[:200]}")
-                return None
+                return _parse_download(resp.json())
             else:
                 logger.error(f"❌ Erro download mídia ({resp.status_code}): {resp.text[:200]}")
                 return None
@@ -261,5 +314,209 @@ class WhatsAppAPI:
             return None
 
 
+_async_http: Optional[httpx.AsyncClient] = None
+_async_http_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Cliente httpx compartilhado (singleton por event loop): todas as instâncias de
+    AsyncWhatsAppAPI e os downloads do worker reaproveitam as conexões keep-alive.
+    """
+    global _async_http, _async_http_loop
+
+    loop = asyncio.get_running_loop()
+    if _async_http is not None and _async_http_loop is loop and not _async_http.is_closed:
+        return _async_http
+
+    limits = httpx.Limits(
+        max_connections=settings.uazapi_http_max_connections,
+        max_keepalive_connections=settings.uazapi_http_max_connections,
+        keepalive_expiry=30.0,
+    )
+    _async_http = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(15.0, connect=UAZAPI_CONNECT_TIMEOUT))
+    _async_http_loop = loop
+    logger.info(f"🔌 Pool HTTP async criado (max={settings.uazapi_http_max_connections})")
+    return _async_http
+
+
+async def close_async_http() -> None:
+    """Fecha o pool HTTP assíncrono (shutdown do worker)."""
+    global _async_http, _async_http_loop
+    if _async_http is not None:
+        try:
+            await _async_http.aclose()
+        except Exception:
+            pass
+    _async_http, _async_http_loop = None, None
+
+
+class AsyncWhatsAppAPI(WhatsAppAPI):
+    """
+    Variante assíncrona da WhatsAppAPI (mesmos métodos, em async).
+
+    Não bloqueia o event loop do worker: uma chamada lenta à UAZAPI não
+    segura os outros jobs. Cada endpoint tem seu timeout (ENDPOINT_TIMEOUTS)
+    e até settings.uazapi_http_retries novas tentativas com backoff. Com a
+    UAZAPI fora do ar, o circuit breaker "uazapi" corta as chamadas (None).
+    """
+
+    async def _post(self, endpoint: str, payload: Dict[str, Any]) -> Optional[httpx.Response]:
+        """POST com timeout do endpoint e retry. None = falhou após as tentativas."""
+        client = get_async_http_client()
+        timeout = httpx.Timeout(ENDPOINT_TIMEOUTS.get(endpoint, 15.0), connect=UAZAPI_CONNECT_TIMEOUT)
+        idempotent = endpoint in IDEMPOTENT_ENDPOINTS
+        attempts = 1 + max(0, settings.uazapi_http_retries)
+        circuit = get_breaker(UAZAPI_SERVICE)
+        if not circuit.allow():
+            logger.warning(f"⚡ Circuit Breaker ABERTO para UAZAPI. {endpoint} não enviado.")
+            return None
+
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                with metrics.timer(f"uazapi.http{endpoint.replace('/', '.')}"):
+                    resp = await client.post(
+                        f"{self.base_url}{endpoint}", headers=self._get_headers(), json=payload, timeout=timeout
+                    )
+                if last or resp.status_code not in RETRY_STATUS or (not idempotent and resp.status_code != 429):
+                    if resp.status_code >= 500:
+                        circuit.record_failure()
+                    else:
+                        circuit.record_success()
+                    return resp
+                reason = f"HTTP {resp.status_code}"
+            except httpx.HTTPError as e:
+                if last or not (idempotent or isinstance(e, _NOT_SENT_ERRORS)):
+                    metrics.incr("uazapi.http.errors")
+                    circuit.record_failure()
+                    logger.error(f"❌ Erro UAZAPI {endpoint}: {type(e).__name__}: {e}")
+                    return None
+                reason = type(e).__name__
+            metrics.incr("uazapi.http.retries")
+            backoff = 0.3 * (2 ** attempt) + random.uniform(0, 0.2)
+            logger.warning(f"🔁 UAZAPI {endpoint}: {reason}, nova tentativa em {backoff:.1f}s")
+            await asyncio.sleep(backoff)
+        return None
+
+    async def send_text(self, to: str, text: str) -> bool:
+        """Envia mensagem de texto (POST /send/text). Suporta <BREAK> para múltiplas mensagens."""
+        if not self.base_url or not self.token:
+            logger.error("❌ UAZAPI não configurada! Mensagem NÃO enviada.")
+            return False
+
+        if "<BREAK>" in text:
+            parts = text.split("<BREAK>")
+            logger.info(f"🔄 Mensagem multi-parte: {len(parts)} partes")
+            success_all = True
+            for i, part in enumerate(parts):
+                part = part.strip()
+                if not part:
+                    continue
+                if i > 0:
+                    await asyncio.sleep(2.0)  # Delay entre mensagens
+                if not await self.send_text(to, part):
+                    success_all = False
+            return success_all
+
+        clean_num = self._clean_number(to)
+        payload = {
+            "number": clean_num,
+            "text": text,
+            "delay": 0,
+            "presence": True,  # Mostra "digitando..." antes de enviar
+            "linkpreview": True
+        }
+        logger.info(f"📤 Enviando texto para {clean_num}: {text[:50]}...")
+
+        resp = await self._post("/send/text", payload)
+        if resp is not None and resp.status_code == 200:
+            logger.info(f"✅ Mensagem enviada para {clean_num}")
+            return True
+        if resp is not None:
+            logger.error(f"❌ Erro UAZAPI ({resp.status_code}): {resp.text[:300]}")
+        return False
+
+    async def send_media(self, to: str, media_url: str = None, caption: str = "",
+                         base64_data: str = None, mimetype: str = "image/jpeg") -> bool:
+        """Envia mídia (POST /send/media) por URL ou base64."""
+        if not self.base_url or not self.token:
+            logger.error("❌ UAZAPI não configurada!")
+            return False
+
+        clean_num = self._clean_number(to)
+        mediatype = _media_type(mimetype)
+        payload = {
+            "number": clean_num,
+            "mediatype": mediatype,
+            "media": base64_data if base64_data else media_url,
+            "caption": caption,
+            "presence": True
+        }
+        logger.info(f"📷 Enviando mídia ({mediatype}) para {clean_num}")
+
+        resp = await self._post("/send/media", payload)
+        if resp is not None and resp.status_code == 200:
+            logger.info(f"✅ Mídia enviada para {clean_num}")
+            return True
+        if resp is not None:
+            logger.error(f"❌ Erro envio mídia ({resp.status_code}): {resp.text[:300]}")
+        return False
+
+    async def send_presence(self, to: str, presence: str = "composing") -> bool:
+        """Envia status de presença (POST /message/presence): composing, recording, paused."""
+        if not self.base_url or not self.token:
+            return False
+
+        clean_num = self._clean_number(to)
+        payload = {"number": clean_num, "presence": presence, "delay": 5000}
+        resp = await self._post("/message/presence", payload)
+        if resp is None:
+            return False
+        logger.debug(f"⌨️ Presença '{presence}' enviada para {clean_num}")
+        return True
+
+    async def mark_as_read(self, chat_id: str, message_id=None) -> bool:
+        """Marca mensagens como lidas (POST /message/markread). Aceita um ID ou lista de IDs."""
+        if not self.base_url or not self.token or not message_id:
+            return False
+
+        payload = {"id": [message_id] if isinstance(message_id, str) else message_id}
+        logger.info(f"👀 Marcando como lido: {message_id}")
+
+        resp = await self._post("/message/markread", payload)
+        if resp is not None and resp.status_code == 200:
+            logger.info(f"✅ Mensagem marcada como lida")
+            return True
+        if resp is not None:
+            logger.warning(f"⚠️ Erro mark_as_read ({resp.status_code})")
+        return False
+
+    async def get_media_base64(self, message_id: str) -> Optional[Dict[str, str]]:
+        """Baixa mídia de uma mensagem recebida (POST /message/download)."""
+        if not self.base_url or not self.token or not message_id:
+            return None
+
+        payload = {
+            "id": message_id,
+            "return_link": False,
+            "return_base64": True,
+            "generate_mp3": True  # Converte áudio para MP3 se necessário
+        }
+        logger.info(f"🖼️ Baixando mídia: {message_id}")
+
+        resp = await self._post("/message/download", payload)
+        if resp is None:
+            return None
+        if resp.status_code != 200:
+            logger.error(f"❌ Erro download mídia ({resp.status_code}): {resp.text[:200]}")
+            return None
+        try:
+            return _parse_download(resp.json())
+        except ValueError as e:
+            logger.error(f"❌ Erro ao baixar mídia: {e}")
+            return None
+
+
 # Instância global
 whatsapp = WhatsAppAPI()
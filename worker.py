@@ -3,10 +3,8 @@ ARQ Worker para processar mensagens em fila
 Evita rate limits do Gemini processando no máximo N mensagens simultâneas
 """
 import asyncio
-import time
-import random
-import re
-from typing import Dict, Any
+import json
+from typing import Dict, Any, Callable, Optional
 from arq import create_pool
 from arq.connections import RedisSettings
 from urllib.parse import urlparse
@@ -14,10 +12,13 @@ from urllib.parse import urlparse
 from config.settings import settings
 from config.logger import setup_logger
 from agent_multiagent import run_agent
-from tools.whatsapp_api import WhatsAppAPI
+from tools.whatsapp_api import AsyncWhatsAppAPI, close_async_http
+from tools import metrics
+from tools import order_outbox, outbound, phone_jobs, redis_async
+from tools.redis_async import get_async_redis_client
 
 logger = setup_logger(__name__)
-whatsapp = WhatsAppAPI()
+whatsapp = AsyncWhatsAppAPI()  # Não bloqueia o event loop (os outros jobs seguem rodando)
 
 
 async def process_message(ctx: Dict[str, Any], telefone: str, mensagem: str, message_id: str = None) -> str:
@@ -36,30 +37,21 @@ async def process_message(ctx: Dict[str, Any], telefone: str, mensagem: str, mes
     Returns:
         Status da execução
     """
+    incorporadas, geracao = [], None
+    if settings.worker_phone_serialization:
+        # Mensagens estacionadas enquanto este job esperava na fila entram nele
+        mensagem, message_id, incorporadas, geracao = await phone_jobs.start_job(telefone, mensagem, message_id)
+    abertura = None
     try:
-        num = re.sub(r"\D", "", telefone)
-        
-        # 1. Simular "Lendo" (Delay Humano)
-        tempo_leitura = random.uniform(2.0, 4.0)
-        await asyncio.sleep(tempo_leitura)
-        
-        # 2. Marcar como LIDO (Azul) - Suporte a múltiplos IDs
-        if message_id:
-            mids = message_id if isinstance(message_id, list) else [message_id]
-            logger.info(f"👀 Marcando chat {telefone} como lido... (MIDs: {len(mids)})")
-            
-            for mid in mids:
-                if mid:
-                    whatsapp.mark_as_read(telefone, message_id=mid)
-                    # Pequeno delay entre requests para não floodar (se forem muitos)
-                    if len(mids) > 1: await asyncio.sleep(0.1)
-            
-            await asyncio.sleep(0.8)  # Delay tático para UX
-        
-        # 3. Começar a "Digitar"
-        whatsapp.send_presence(num, "composing")
+        # 1-3. "Lendo" (2-4s) -> LIDO (azul) -> "Digitando": agendado no despachante
+        # (timers fora do slot); o processamento começa já, em paralelo
+        timeline = outbound.opening_timeline(phone_jobs.as_mid_list(message_id))
+        digitando_em = timeline[-1]["at"]
+        abertura = await _schedule(telefone, timeline)
         
         # 3.5 Processar mídia se for placeholder ([MEDIA:TYPE:ID])
+        # Download/análise (server.py) são síncronos: rodam em thread para não bloquear o event loop
+        loop = asyncio.get_event_loop()
         if mensagem.startswith("[MEDIA:"):
             try:
                 # Parse: [MEDIA:IMAGE:3EB08C4C6042...]
@@ -73,7 +65,7 @@ async def process_message(ctx: Dict[str, Any], telefone: str, mensagem: str, mes
                     if media_type == "image":
                         # Importar função de análise do server.py
                         from server import analyze_image
-                        analysis = analyze_image(media_id, None)
+                        analysis = await loop.run_in_executor(None, analyze_image, media_id, None)
                         if analysis:
                             mensagem = f"[Análise da imagem]: {analysis}"
                             logger.info(f"✅ Imagem analisada: {analysis[:50]}...")
@@ -81,7 +73,7 @@ async def process_message(ctx: Dict[str, Any], telefone: str, mensagem: str, mes
                             mensagem = "[Imagem recebida, mas não foi possível analisar]"
                     elif media_type == "audio":
                         from server import transcribe_audio
-                        transcription = transcribe_audio(media_id)
+                        transcription = await loop.run_in_executor(None, transcribe_audio, media_id)
                         if transcription:
                             mensagem = f"[Áudio]: {transcription}"
                             logger.info(f"✅ Áudio transcrito: {transcription[:50]}...")
@@ -89,7 +81,7 @@ async def process_message(ctx: Dict[str, Any], telefone: str, mensagem: str, mes
                             mensagem = "[Áudio recebido, mas não foi possível transcrever]"
                     elif media_type == "document":
                         from server import process_pdf
-                        pdf_text = process_pdf(media_id)
+                        pdf_text = await loop.run_in_executor(None, process_pdf, media_id)
                         if pdf_text:
                             mensagem = f"[Conteúdo PDF]: {pdf_text[:1200]}"
                         else:
@@ -100,122 +92,150 @@ async def process_message(ctx: Dict[str, Any], telefone: str, mensagem: str, mes
         
         # 4. Processamento IA (síncrono - run_agent não é async)
         # Rodamos em thread_pool para não bloquear o event loop
-        loop = asyncio.get_event_loop()
-        res = await loop.run_in_executor(None, run_agent, telefone, mensagem)
+        preempt_check = _preemption_check(telefone, geracao)
+        res = await loop.run_in_executor(None, run_agent, telefone, mensagem, preempt_check)
+
+        # 4.1 Preempção: mensagem nova chegou durante o turno (ou antes do envio) -> refaz UMA vez.
+        # A checagem do envio é feita pelo agente antes de gravar a resposta no histórico
+        preempted = res.get("error") == "preempted"
+        if preempted or res.get("error") == "preempted_send":
+            res, novas = await _restart_turn(loop, telefone, res, preempted)
+            incorporadas += novas
         txt = res.get("output", "Erro ao processar.")
         
-        # 5. Parar "Digitar"
-        whatsapp.send_presence(num, "paused")
-        await asyncio.sleep(0.5)
-        
-        # 6. Enviar Mensagem (também síncrono)
-        await loop.run_in_executor(None, _send_whatsapp_message, telefone, txt)
+        # 5-6. Parar "Digitar" e enviar (mesma fila do telefone: sai depois da abertura)
+        if abertura is not None:
+            await abertura
+        await _send_whatsapp_message(telefone, txt, digitando_em)
         
         logger.info(f"✅ Mensagem processada com sucesso: {telefone}")
+        await _chain_next_job(ctx, telefone)
         return "success"
         
     except Exception as e:
         logger.error(f"❌ Erro ao processar mensagem de {telefone}: {e}", exc_info=True)
-        # Parar digitando em caso de erro
+        # Parar digitando em caso de erro (depois da abertura, se ela ainda estiver em curso)
         try:
-            whatsapp.send_presence(telefone, "paused")
+            if abertura is not None:
+                await abertura
+            await _schedule(telefone, [{"type": "presence", "presence": "paused"}])
         except:
             pass
+        if ctx.get("job_try", 1) >= WorkerSettings.max_tries:
+            # Última tentativa: libera o telefone para as mensagens estacionadas
+            await _chain_next_job(ctx, telefone)
+        elif incorporadas:
+            # O retry recebe só os args originais: as incorporadas voltam para a fila
+            await phone_jobs.unpark(telefone, incorporadas)
         raise  # ARQ vai fazer retry automático
 
+    except asyncio.CancelledError:
+        # job_timeout do ARQ (ou shutdown do worker) cancela a coroutine. CancelledError não é
+        # Exception: sem isto jobq:{tel} ficaria "running" até o TTL e as mensagens
+        # estacionadas nesse meio tempo não teriam job nenhum para processá-las
+        logger.error(f"⏱️ Job de {telefone} cancelado (timeout/shutdown); liberando o telefone")
+        try:
+            await _schedule(telefone, [{"type": "presence", "presence": "paused"}])
+        except Exception:
+            pass
+        await phone_jobs.unpark(telefone, incorporadas)
+        await _chain_next_job(ctx, telefone)
+        raise
 
-def _send_whatsapp_message(telefone: str, mensagem: str) -> bool:
-    """Helper síncrono para enviar mensagem (com detecção de múltiplas imagens)"""
-    import requests
-    import base64
-    import re
-    
-    # Regex para encontrar todas as URLs de imagem (jpg, png, jpeg, webp)
-    # OTIMIZADO: Evita pontuação final (.,;!) e captura múltiplos
-    regex = r'(https?://[^\s]+\.(?:jpg|jpeg|png|webp))'
-    urls_encontradas = re.findall(regex, mensagem, re.IGNORECASE)
-    
-    if urls_encontradas:
-        # Texto limpo: remove todos os links para não ficar redundante no WhatsApp
-        texto_limpo = mensagem
-        for url in urls_encontradas:
-            # Substitui links seguidos opcionalmente por quebras de linha/espaços
-            texto_limpo = re.sub(re.escape(url) + r'[\s\n]*', '', texto_limpo).strip()
-            
-        logger.info(f"📸 Detectadas {len(urls_encontradas)} URLs de imagem. Texto limpo: {texto_limpo[:50]}...")
-        
-        # 1. Enviar primeiro o TEXTO como mensagem separada (se houver texto)
-        if texto_limpo:
-            whatsapp.send_text(telefone, texto_limpo)
-            # Pequeno delay para a mensagem de texto chegar primeiro
-            time.sleep(1.0)
-            
-        # 2. Enviar cada imagem sequencialmente
-        for i, image_url in enumerate(urls_encontradas):
-            logger.info(f"⬇️ Baixando imagem [{i+1}/{len(urls_encontradas)}]: {image_url}")
-            
-            try:
-                # Baixar imagem
-                img_resp = requests.get(image_url, timeout=15)
-                img_resp.raise_for_status()
-                
-                # Converter para Base64
-                img_b64 = base64.b64encode(img_resp.content).decode('utf-8')
-                mime = img_resp.headers.get("Content-Type", "image/jpeg")
-                
-                # Enviar como mídia (sem caption agora, pois o texto já foi enviado)
-                whatsapp.send_media(telefone, caption="", base64_data=img_b64, mimetype=mime)
-                
-                # Pequeno delay entre imagens
-                if i < len(urls_encontradas) - 1:
-                    time.sleep(1.2)
-            
-            except Exception as e:
-                logger.error(f"❌ Erro ao baixar/enviar imagem {image_url}: {e}")
-                # Fallback: Tentar enviar via URL
-                whatsapp.send_media(telefone, media_url=image_url, caption="")
-        
-        return True
-    
-    # Mensagem normal (sem imagem)
-    max_len = 500
-    msgs = []
-    
-    if len(mensagem) > max_len:
-        paragrafos = mensagem.split('\n\n')
-        curr = ""
-        
-        for p in paragrafos:
-            if len(p) > max_len:
-                if curr:
-                    msgs.append(curr.strip())
-                    curr = ""
-                linhas = p.split('\n')
-                for linha in linhas:
-                    if len(curr) + len(linha) + 1 <= max_len:
-                        curr += linha + "\n"
-                    else:
-                        if curr: msgs.append(curr.strip())
-                        curr = linha + "\n"
-            elif len(curr) + len(p) + 2 <= max_len:
-                curr += p + "\n\n"
-            else:
-                if curr: msgs.append(curr.strip())
-                curr = p + "\n\n"
-        
-        if curr: msgs.append(curr.strip())
+
+def _preemption_check(telefone: str, geracao) -> Optional[Callable[[], bool]]:
+    """Checagem síncrona (roda na thread do agente): a geração do telefone avançou desde o início do job?"""
+    if not settings.agent_preemption or geracao is None:
+        return None
+    return lambda: phone_jobs.current_generation(telefone) > geracao
+
+
+async def _restart_turn(loop, telefone: str, res: Dict[str, Any], preempted: bool):
+    """
+    Refaz o turno com as mensagens que chegaram durante o anterior (sem nova preempção).
+    O histórico já tem a mensagem original; as tools já executadas (carrinho) foram preservadas.
+    """
+    stage = "step" if preempted else "send"
+    novas_texto, novas_mids, novas, _ = await phone_jobs.start_job(telefone, "", None)
+    metrics.incr(f"agent.preempted.{stage}")
+    metrics.incr("agent.preempt.duplicate_replies_avoided")
+    metrics.incr("agent.preempt.tokens_saved_est", res.get("tokens_saved_est", 0))
+    logger.info(f"⏭️ Turno de {telefone} refeito ({stage}) com {len(novas)} mensagem(ns) nova(s)")
+
+    if novas_mids:
+        await _schedule(telefone, [{"type": "read", "mids": novas_mids}])
+
+    if preempted:
+        nota = "[O cliente complementou enquanto você processava a mensagem anterior. Responda às duas juntas; o que você já fez (ex: itens no carrinho) continua valendo, confira antes de repetir.]"
     else:
-        msgs = [mensagem]
-    
+        nota = "[O cliente complementou antes de receber sua última resposta, que NÃO foi enviada. Responda considerando as duas mensagens juntas.]"
+    mensagem = f"{nota}\n{novas_texto}" if novas_texto else nota
+    res = await loop.run_in_executor(None, run_agent, telefone, mensagem)
+    return res, novas
+
+
+async def _chain_next_job(ctx: Dict[str, Any], telefone: str) -> None:
+    """Enfileira UM job com tudo que chegou para o telefone durante a execução (ou libera o telefone)."""
+    if not settings.worker_phone_serialization:
+        return
+    nxt = await phone_jobs.finish_job(telefone)
+    if not nxt:
+        return
+    texto, mids = nxt
     try:
-        for i, msg in enumerate(msgs):
-            whatsapp.send_text(telefone, msg)
-            if i < len(msgs) - 1:
-                time.sleep(random.uniform(0.8, 1.5))
+        # Contexto de sessão recalculado agora (o do momento em que a mensagem chegou já mudou)
+        order_ctx = await redis_async.get_order_context(telefone, texto)
+        if order_ctx:
+            texto = f"{order_ctx}\n\n{texto}"
+        job = await ctx["redis"].enqueue_job("process_message", telefone, texto, mids)
+        logger.info(f"⛓️ Job encadeado para {telefone}: {job.job_id if job else '?'} ({len(mids)} MIDs)")
+    except Exception as e:
+        logger.error(f"❌ Erro ao encadear job de {telefone}: {e}")
+
+
+async def _schedule(telefone: str, parts) -> Optional[asyncio.Task]:
+    """
+    Agenda eventos de saída no despachante. Sem despachante, executa numa task
+    local (o chamador aguarda a task antes do próximo evento do mesmo chat).
+    """
+    if await outbound.enqueue_parts(telefone, parts):
+        return None
+    return asyncio.create_task(outbound.deliver_reply(whatsapp, telefone, parts))
+
+
+async def _send_whatsapp_message(telefone: str, mensagem: str, typing_from: Optional[float] = None) -> bool:
+    """Entrega a resposta ao despachante (libera o slot); sem Redis, envia aqui mesmo."""
+    if await outbound.enqueue_reply(telefone, mensagem, typing_from):
         return True
+    return await outbound.deliver_reply(whatsapp, telefone, outbound.reply_timeline(mensagem, typing_from))
+
+
+async def publish_metrics(ctx: Dict[str, Any]) -> None:
+    """Publica o snapshot de métricas do worker no Redis (agregado pelo GET /metrics do server)."""
+    client = await get_async_redis_client()
+    if client is None:
+        return
+    try:
+        await client.set(metrics.metrics_key("worker"), json.dumps(metrics.snapshot()), ex=metrics.METRICS_TTL)
     except Exception as e:
-        logger.error(f"Erro envio: {e}")
-        return False
+        logger.debug(f"Falha ao publicar métricas do worker: {e}")
+
+
+async def startup(ctx: Dict[str, Any]) -> None:
+    """Publica as métricas iniciais e sobe o despachante de mensagens e o consumidor do outbox de pedidos."""
+    await publish_metrics(ctx)
+    if settings.outbound_dispatcher:
+        ctx["outbound"] = outbound.OutboundDispatcher(whatsapp)
+        ctx["outbound"].start()
+    order_outbox.start_consumer()
+
+
+async def shutdown(ctx: Dict[str, Any]) -> None:
+    """Termina os envios em curso (mensagens e pedidos) e fecha o pool HTTP da UAZAPI (conexões keep-alive)."""
+    if ctx.get("outbound") is not None:
+        await ctx["outbound"].stop()
+    await asyncio.to_thread(order_outbox.stop_consumer)
+    await close_async_http()
 
 
 class WorkerSettings:
@@ -248,6 +268,9 @@ class WorkerSettings:
     
     # Configurações de saúde e monitoramento
     health_check_interval = 30  # Verifica saúde a cada 30s
+    on_startup = startup
+    on_shutdown = shutdown
+    after_job_end = publish_metrics  # Snapshot de métricas (pool Redis, tempos) a cada job
     keep_result = 3600  # Mantém resultado por 1h
     
     # Nome da fila (Removido para usar o padrão arq:queue e casar com o server.py)